@@ -14,6 +14,7 @@
 
 import json
 import logging
+import urllib
 import zlib
 
 import google.appengine.ext.ndb as ndb
@@ -21,54 +22,94 @@ import google.appengine.ext.ndb as ndb
 
 GCS_API_URL = 'https://storage.googleapis.com'
 STORAGE_API_URL = 'https://www.googleapis.com/storage/v1/b'
+CHUNK_SIZE = 4 * 1024 * 1024  # bytes fetched per request by stream()
 
 
 @ndb.tasklet
-def get(url):
+def fetch(url, extra_headers=None):
+    """
+    Asynchronously GET a URL, retrying on transient errors.
+
+    Returns:
+        a Future that resolves to the urlfetch result, or None if every
+        retry failed.
+    """
     context = ndb.get_context()
     headers = {'accept-encoding': 'gzip, *', 'x-goog-api-version': '2'}
+    if extra_headers:
+        headers.update(extra_headers)
     for retry in xrange(6):
         result = yield context.urlfetch(url, headers=headers)
         status = result.status_code
         if status == 429 or 500 <= status < 600:
             yield ndb.sleep(2 ** retry)
             continue
-        if status in (200, 206):
-            content = result.content
-            if result.headers.get('content-encoding') == 'gzip':
-                content = zlib.decompress(result.content, 15 | 16)
-            raise ndb.Return(content)
-        logging.error("unable to fetch '%s': status code %d", url, status)
+        raise ndb.Return(result)
+
+
+def decode_content(result):
+    content = result.content
+    if result.headers.get('content-encoding') == 'gzip':
+        content = zlib.decompress(result.content, 15 | 16)
+    return content
+
+
+@ndb.tasklet
+def get(url, extra_headers=None):
+    result = yield fetch(url, extra_headers)
+    if result is None:
         raise ndb.Return(None)
+    if result.status_code in (200, 206):
+        raise ndb.Return(decode_content(result))
+    logging.error("unable to fetch '%s': status code %d", url, result.status_code)
+    raise ndb.Return(None)
 
 
-def read(path):
+def read(path, start=None, end=None):
     """
-    Asynchronously reads a file from GCS.
+    Asynchronously reads a file, or a byte range of a file, from GCS.
 
     NOTE: for large files (>10MB), this may return a truncated response due to
-    urlfetch API limits. We don't want to read large files currently, so this
-    is not yet a problem.
+    urlfetch API limits. Use stream() or a range to read large files.
 
     Args:
         path: the location of the object to read
+        start: the offset of the first byte to read. If negative, the last
+            -start bytes of the file are read instead.
+        end: the offset of the last byte to read, inclusive.
     Returns:
         a Future that resolves to the file's data, or None if an error occurred.
+        GCS ignores ranges for gzip-encoded objects, so the full data may be
+        returned even if a range was requested.
     """
     url = GCS_API_URL + path
-    return get(url)
+    if start is None and end is None:
+        return get(url)
+    if start is not None and start < 0:
+        byte_range = 'bytes=%d' % start
+    else:
+        byte_range = 'bytes=%d-%s' % (start or 0, '' if end is None else end)
+    return get(url, {'range': byte_range})
+
+
+def read_tail(path, size):
+    """Asynchronously reads the last size bytes of a file from GCS. See read."""
+    return read(path, -size)
 
 
 @ndb.tasklet
-def listdirs(path):
+def listdirs(path, consume=None):
     """
     Asynchronously list directories present on GCS.
 
-    NOTE: This returns at most 1000 results. The API supports pagination, but
-    it's not implemented here.
+    Every page of results is fetched. Only the fields needed are requested,
+    to keep each page small.
 
     Args:
         path: the GCS bucket directory to list subdirectories of
+        consume: if given, a function called with the list of directories in
+            each page as it arrives, so work on them can start before later
+            pages are listed.
     Returns:
         a Future that resolves to a list of directories, or None if an error
         occurred.
@@ -77,9 +118,60 @@ def listdirs(path):
         path += '/'
     assert path[0] != '/'
     bucket, prefix = path.split('/', 1)
-    url = '%s/%s/o?delimiter=/&prefix=%s' % (STORAGE_API_URL, bucket, prefix)
-    res = yield get(url)
-    if res is None:
-        raise ndb.Return(None)
-    prefixes = json.loads(res).get('prefixes', [])
-    raise ndb.Return(['%s/%s' % (bucket, prefix) for prefix in prefixes])
+    url = '%s/%s/o?delimiter=/&prefix=%s&fields=nextPageToken,prefixes' % (
+        STORAGE_API_URL, bucket, prefix)
+    dirs = []
+    page_token = None
+    while True:
+        page_url = url
+        if page_token:
+            page_url += '&pageToken=%s' % urllib.quote(page_token, '')
+        res = yield get(page_url)
+        if res is None:
+            raise ndb.Return(None)
+        page = json.loads(res)
+        page_dirs = ['%s/%s' % (bucket, p) for p in page.get('prefixes', [])]
+        if consume:
+            consume(page_dirs)
+        dirs.extend(page_dirs)
+        page_token = page.get('nextPageToken')
+        if not page_token:
+            raise ndb.Return(dirs)
+
+
+@ndb.tasklet
+def stream(path, consume, chunk_size=CHUNK_SIZE):
+    """
+    Asynchronously reads a file from GCS in chunks, using ranged requests.
+
+    Each chunk is passed to consume as soon as it arrives, so the whole object
+    is never held in memory at once. Objects that GCS serves without honoring
+    the range (e.g., gzip-encoded ones) are passed to consume in one piece.
+
+    Args:
+        path: the location of the object to read
+        consume: a function called with each chunk of data, in order.
+        chunk_size: the maximum number of bytes to request at once.
+    Returns:
+        a Future that resolves to True if the whole object was consumed, or
+        False if an error occurred.
+    """
+    url = GCS_API_URL + path
+    offset = 0
+    while True:
+        result = yield fetch(url, {
+            'range': 'bytes=%d-%d' % (offset, offset + chunk_size - 1)})
+        if result is None:
+            raise ndb.Return(False)
+        status = result.status_code
+        if status == 416:  # offset is exactly the size of the object
+            break
+        if status not in (200, 206):
+            logging.error("unable to fetch '%s': status code %d", url, status)
+            raise ndb.Return(False)
+        data = decode_content(result)
+        consume(data)
+        if status == 200 or len(data) < chunk_size:
+            break
+        offset += len(data)
+    raise ndb.Return(True)
@@ -31,7 +31,7 @@ def write(path, data):
         f.write(data)
 
 
-def install_handler(stub, structure, base='pr-logs/pull/'):
+def install_handler(stub, structure, base='pr-logs/pull/', page_size=None):
     '''
     Add a stub to mock out GCS JSON API ListObject requests-- with
     just enough detail for our code.
@@ -43,6 +43,8 @@ def install_handler(stub, structure, base='pr-logs/pull/'):
         structure: a dictionary of {paths: subdirectory names}.
             This will be transformed into the (more verbose) form
             that the ListObject API returns.
+        page_size: if set, the most prefixes to return in one response, with
+            a nextPageToken to request the rest.
     '''
     prefixes_for_paths = {}
 
@@ -59,7 +61,14 @@ def install_handler(stub, structure, base='pr-logs/pull/'):
         parsed = urlparse.urlparse(url)
         param_dict = urlparse.parse_qs(parsed.query, True)
         prefix = param_dict['prefix'][0]
-        return json.dumps({'prefixes': prefixes_for_paths[prefix]})
+        prefixes = prefixes_for_paths[prefix]
+        if not page_size:
+            return json.dumps({'prefixes': prefixes})
+        start = int(param_dict.get('pageToken', ['0'])[0])
+        page = {'prefixes': prefixes[start:start + page_size]}
+        if start + page_size < len(prefixes):
+            page['nextPageToken'] = str(start + page_size)
+        return json.dumps(page)
 
     def fetch_stub(url, payload, method, headers, request, response,
                    follow_redirects=False, deadline=None,
@@ -92,8 +101,34 @@ class GCSAsyncTest(unittest.TestCase):
         self.assertEqual(gcs_async.read('/foo/bar').get_result(), 'test data')
         self.assertEqual(gcs_async.read('/foo/quux').get_result(), None)
 
+    def test_read_range(self):
+        write('/foo/bar', 'test data')
+        self.assertEqual(gcs_async.read('/foo/bar', 2, 5).get_result(), 'st d')
+        self.assertEqual(gcs_async.read('/foo/bar', 5).get_result(), 'data')
+        self.assertEqual(gcs_async.read_tail('/foo/bar', 3).get_result(), 'ata')
+
+    def test_stream(self):
+        write('/foo/bar', 'test data')
+        chunks = []
+        self.assertTrue(
+            gcs_async.stream('/foo/bar', chunks.append, chunk_size=4).get_result())
+        self.assertEqual(chunks, ['test', ' dat', 'a'])
+        self.assertFalse(gcs_async.stream('/foo/quux', chunks.append).get_result())
+
     def test_listdirs(self):
         install_handler(self.testbed.get_stub('urlfetch'),
             {'foo/': ['bar', 'baz']}, base='base/')
         self.assertEqual(gcs_async.listdirs('buck/base/foo/').get_result(),
             ['buck/base/foo/bar/', 'buck/base/foo/baz/'])
+
+    def test_listdirs_paginated(self):
+        install_handler(self.testbed.get_stub('urlfetch'),
+            {'foo/': ['a', 'b', 'c', 'd', 'e']}, base='base/', page_size=2)
+        pages = []
+        self.assertEqual(
+            gcs_async.listdirs('buck/base/foo/', pages.append).get_result(),
+            ['buck/base/foo/%s/' % d for d in 'abcde'])
+        self.assertEqual(pages, [
+            ['buck/base/foo/a/', 'buck/base/foo/b/'],
+            ['buck/base/foo/c/', 'buck/base/foo/d/'],
+            ['buck/base/foo/e/']])
@@ -13,6 +13,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+
 import jinja2
 
 import kubelet_parser
@@ -21,9 +23,11 @@ import regex
 CONTEXT = 4
 
 
-def hilight(line, hilight_words):
-    # Join all the words that need to be bolded into one regex
-    words_re = regex.combine_wordsRE(hilight_words)
+def escape(line):
+    return unicode(jinja2.escape(line))
+
+
+def hilight(line, words_re):
     line = words_re.sub(r'<span class="keyword">\1</span>', line)
     return '<span class="hilight">%s</span>' % line
 
@@ -31,6 +35,9 @@ def hilight(line, hilight_words):
 def log_html(lines, matched_lines, hilight_words, skip_fmt):
     output = []
 
+    # Join all the words that need to be bolded into one regex
+    words_re = regex.combine_wordsRE(hilight_words)
+
     matched_lines.append(len(lines))  # sentinel value
 
     last_match = None
@@ -58,12 +65,127 @@ def log_html(lines, matched_lines, hilight_words, skip_fmt):
         if match == len(lines):
             break
         output.extend(lines[max(previous_end, match - CONTEXT): match])
-        output.append(hilight(lines[match], hilight_words))
+        output.append(hilight(lines[match], words_re))
         last_match = match
 
     return output
 
 
+class LogDigester(object):
+    """
+    Incrementally digest a build log, producing the same HTML as digest().
+
+    Text can be fed in arbitrary chunks. Each chunk's raw text is searched
+    once for matches, instead of every line separately, and only lines that
+    are emitted get HTML-escaped. Lines that can't be emitted anymore are
+    dropped, so memory use is bounded by the size of the output rather than
+    the size of the log.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, skip_fmt=lambda l: '... skipping %d lines ...' % l,
+                 error_re=regex.error_re,
+                 hilight_words=("error", "fatal", "failed", "build timed out")):
+        self.skip_fmt = skip_fmt
+        self.error_re = error_re
+        self.words_re = regex.combine_wordsRE(hilight_words)
+        self.output = []
+        self.partial = u''  # an incomplete line from the end of the last chunk
+        self.lineno = 0
+        self.trailing = 0  # context lines still to emit after the last match
+        self.pending = collections.deque()  # raw lines since the last emitted one
+        self.pending_count = 0
+
+    def feed(self, text):
+        text = self.partial + text
+        end = text.rfind('\n')
+        if end == -1:
+            self.partial = text
+            return
+        self.partial = text[end + 1:]
+        self.scan(text[:end])
+
+    def scan(self, text):
+        """Process newline-separated lines, searching the text once for matches."""
+        pos = 0
+        while True:
+            match = self.error_re.search(text, pos)
+            if not match:
+                break
+            start = text.rfind('\n', pos, match.start()) + 1 or pos
+            end = text.find('\n', match.start())
+            if end == -1:
+                end = len(text)
+            if start > pos:
+                self.add_context(text[pos:start - 1])
+            self.add_match(text[start:end])
+            pos = end + 1
+            if pos > len(text):
+                return
+        self.add_context(text[pos:])
+
+    def add_match(self, line):
+        self.emit_skipped()
+        self.output.extend(escape(l) for l in self.pending)
+        self.output.append(hilight(escape(line), self.words_re))
+        self.pending.clear()
+        self.pending_count = 0
+        self.trailing = CONTEXT
+        self.lineno += 1
+
+    def add_context(self, text):
+        """Add newline-separated lines that don't match."""
+        count = text.count('\n') + 1
+        self.lineno += count
+        start = 0
+        while self.trailing and count:
+            end = text.find('\n', start)
+            if end == -1:
+                end = len(text)
+            self.output.append(escape(text[start:end]))
+            start = end + 1
+            count -= 1
+            self.trailing -= 1
+        if not count:
+            return
+        self.pending_count += count
+        if len(self.pending) + count > 100 + CONTEXT:
+            # Only the leading context will be emitted once a match is over
+            # 100 lines away, so don't keep more lines than that around.
+            tail = text[start:].rsplit('\n', CONTEXT)[-min(count, CONTEXT):]
+            self.pending.extend(tail)
+            while len(self.pending) > CONTEXT:
+                self.pending.popleft()
+        else:
+            self.pending.extend(text[start:].split('\n'))
+
+    def emit_skipped(self):
+        """Emit the pending lines before the leading context of a match."""
+        skip_amount = self.pending_count - CONTEXT
+        if skip_amount > 100:
+            self.output.append('<span class="skip">%s</span>' % self.skip_fmt(skip_amount))
+        elif skip_amount > 1:
+            skip_id = 'skip_%s' % self.lineno
+            self.output.append('<span class="skip"><a href="javascript:show_skipped(\'%s\')"'
+                % skip_id)
+            self.output.append('onclick="this.style.display=\'none\'">%s</a></span>'
+                % self.skip_fmt(skip_amount))
+            self.output.append('<div id="%s" style="display:none;"><p><span class="skipped">'
+                % skip_id)
+            self.output.extend(escape(l) for l in list(self.pending)[:skip_amount])
+            self.output.append('</span></p></div>')
+        elif skip_amount == 1:  # pointless say we skipped 1 line
+            self.output.append(escape(self.pending[0]))
+        while len(self.pending) > CONTEXT:
+            self.pending.popleft()
+
+    def close(self):
+        """Return the digested HTML for all the text fed."""
+        self.scan(self.partial)
+        self.emit_skipped()
+        return '\n'.join(self.output)
+
+
 def digest(data, skip_fmt=lambda l: '... skipping %d lines ...' % l,
       objref_dict=None, filters=None, error_re=regex.error_re):
     """
@@ -72,8 +194,6 @@ def digest(data, skip_fmt=lambda l: '... skipping %d lines ...' % l,
 
     This is similar to the output of `grep -C4` with an appropriate regex.
     """
-    lines = unicode(jinja2.escape(data)).split('\n')
-
     if filters is None:
         filters = {'Namespace': '', 'UID': '', 'pod': ''}
 
@@ -82,10 +202,13 @@ def digest(data, skip_fmt=lambda l: '... skipping %d lines ...' % l,
         hilight_words = [filters["pod"]]
 
     if not (filters["UID"] or filters["Namespace"]):
-        matched_lines = [n for n, line in enumerate(lines) if error_re.search(line)]
-    else:
-        matched_lines, hilight_words = kubelet_parser.parse(lines,
-            hilight_words, filters, objref_dict)
+        digester = LogDigester(skip_fmt, error_re, hilight_words)
+        digester.feed(data)
+        return digester.close()
+
+    lines = unicode(jinja2.escape(data)).split('\n')
+    matched_lines, hilight_words = kubelet_parser.parse(lines,
+        hilight_words, filters, objref_dict)
 
     output = log_html(lines, matched_lines, hilight_words, skip_fmt)
 
@@ -74,6 +74,13 @@ class LogParserTest(unittest.TestCase):
             filters={"pod": "pod", "UID": "", "Namespace": ""}),
             's2 ( 0 1 ) 2 3 4 5 pod 6 7 8 9')
 
+    def test_incremental(self):
+        data = '0 1 2 3 4 5 error 6 7 8 9 10 11 12 13 error-2 14'.replace(' ', '\n')
+        digester = log_parser.LogDigester()
+        for n in xrange(0, len(data), 3):
+            digester.feed(data[n:n + 3])
+        self.assertEqual(digester.close(), log_parser.digest(data))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -14,17 +14,26 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import codecs
+import collections
+import cPickle
 import functools
 import json
 import logging
 import re
 import os
+import random
+import threading
+import time
+import zlib
+from xml.etree.ElementTree import TreeBuilder
 
 import webapp2
 import jinja2
 import yaml
 
-from google.appengine.api import memcache, urlfetch
+from google.appengine.api import memcache, taskqueue, urlfetch
+from google.appengine.ext import deferred
 
 import defusedxml.ElementTree as ET
 import cloudstorage as gcs
@@ -33,6 +42,7 @@ import gcs_async
 import filters as jinja_filters
 import log_parser
 import kubelet_parser
+import models
 import pull_request
 import regex
 
@@ -72,78 +82,353 @@ def pad_numbers(s):
     return re.sub(r'\d+', lambda m: m.group(0).rjust(16, '0'), s)
 
 
-def memcache_memoize(prefix, expires=60 * 60, neg_expires=60):
+class LRUCache(object):
+    """A bounded, thread-safe cache that evicts the least recently used key."""
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.entries[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# Values too large for a single memcache entry are compressed and split into
+# shards of at most this size, referenced by a ShardedEntry stored at the key.
+SHARD_SIZE = 1000 * 1000
+MAX_SHARDS = 16
+
+ShardedEntry = collections.namedtuple(
+    'ShardedEntry', ['fresh_until', 'stale_until', 'shard_keys'])
+
+
+class Memoizer(object):
+    """
+    Memoize a function's results in an in-instance LRU cache and memcache.
+
+    Values are cached as (fresh_until, stale_until, data) entries. Stale
+    entries are still returned, while a deferred task recomputes them.
+
+    Entries too large for memcache are compressed and sharded across several
+    keys, which are read back with a single get_multi.
+
+    Only one computation per key runs at a time: concurrent requests on this
+    instance wait for it to finish, and requests on other instances poll
+    memcache for its result while it holds a lease.
+    """
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+
+    LEASE = 15  # seconds to wait for another instance's computation
+    POLL = 0.25  # seconds between checks for another instance's result
+
+    def __init__(self, func, prefix, expires, neg_expires, stale, local_size):
+        self.func = func
+        self.prefix = prefix
+        self.expires = expires
+        self.neg_expires = neg_expires
+        self.stale = stale
+        self.local = LRUCache(local_size)
+        self.lock = threading.Lock()
+        self.inflight = {}  # {key: threading.Event set when computed}
+        # setting the namespace based on the current version prevents different
+        # versions from sharing cache values -- meaning there's no need to worry
+        # about incompatible old key/value pairs
+        self.namespace = os.environ['CURRENT_VERSION_ID']
+
+    def __call__(self, arg):
+        key = '%s%s' % (self.prefix, arg)
+        entry = self.lookup(key)
+        if entry is None:
+            return self.compute(key, arg)
+        fresh_until, _, data = entry
+        if fresh_until < time.time():
+            self.schedule_refresh(arg)
+        return data
+
+    def lookup(self, key):
+        """Return the unexpired cache entry for key, or None."""
+        entry = self.local.get(key)
+        if entry is None or entry[0] < time.time():
+            # Check memcache, where another instance may have refreshed it.
+            shared = memcache.get(key, namespace=self.namespace)
+            if isinstance(shared, ShardedEntry):
+                shared = self.load_shards(shared)
+            if shared is not None:
+                entry = shared
+                self.local.put(key, entry)
+        if entry is None or entry[1] < time.time():
+            return None
+        return entry
+
+    def store(self, key, data):
+        now = time.time()
+        if data:
+            expires, stale = self.expires, self.stale
+        else:
+            expires, stale = self.neg_expires, 0
+        entry = (now + expires, now + expires + stale, data)
+        self.local.put(key, entry)
+        try:
+            memcache.set(key, entry, expires + stale, namespace=self.namespace)
+        except ValueError:  # too large for one entry
+            self.store_shards(key, entry, expires + stale)
+
+    def store_shards(self, key, entry, expires):
+        fresh_until, stale_until, data = entry
+        data = zlib.compress(cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL))
+        if len(data) > SHARD_SIZE * MAX_SHARDS:
+            logging.error('unable to write %s to memcache: %d bytes compressed',
+                          key, len(data))
+            return
+        # Shard keys are unique to this write, so readers never mix shards
+        # from different versions of the value.
+        generation = '%x' % random.getrandbits(32)
+        shards = collections.OrderedDict()
+        for n, start in enumerate(xrange(0, len(data), SHARD_SIZE)):
+            shard_key = '%s#%s#%d' % (key, generation, n)
+            shards[shard_key] = data[start:start + SHARD_SIZE]
+        if memcache.set_multi(shards, expires, namespace=self.namespace):
+            logging.error('unable to write shards of %s to memcache', key)
+            return
+        memcache.set(key, ShardedEntry(fresh_until, stale_until, shards.keys()),
+                     expires, namespace=self.namespace)
+
+    def load_shards(self, manifest):
+        """Return the entry stored by store_shards, or None if shards are missing."""
+        shards = memcache.get_multi(manifest.shard_keys, namespace=self.namespace)
+        if len(shards) != len(manifest.shard_keys):
+            return None
+        data = ''.join(shards[shard_key] for shard_key in manifest.shard_keys)
+        data = cPickle.loads(zlib.decompress(data))
+        return manifest.fresh_until, manifest.stale_until, data
+
+    def compute(self, key, arg):
+        """Compute and cache the value for arg, unless it's already underway."""
+        with self.lock:
+            done = self.inflight.get(key)
+            leader = done is None
+            if leader:
+                done = self.inflight[key] = threading.Event()
+        if not leader:
+            done.wait(self.LEASE)
+            entry = self.lookup(key)
+            if entry is not None:
+                return entry[2]
+            return self.func(arg)  # the computation failed, try it ourselves
+        try:
+            return self.compute_leased(key, arg)
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            done.set()
+
+    def compute_leased(self, key, arg):
+        lease_key = 'lease://' + key
+        if not memcache.add(lease_key, 1, self.LEASE, namespace=self.namespace):
+            # Another instance is computing it, so wait for its result.
+            for _ in xrange(int(self.LEASE / self.POLL)):
+                time.sleep(self.POLL)
+                entry = self.lookup(key)
+                if entry is not None:
+                    return entry[2]
+        try:
+            data = self.func(arg)
+            self.store(key, data)
+        finally:
+            # Release the lease even on errors, so other instances don't
+            # wait out the whole lease before trying themselves.
+            memcache.delete(lease_key, namespace=self.namespace)
+        return data
+
+    def schedule_refresh(self, arg):
+        """Recompute a stale value in a deferred task, unless one is queued."""
+        refresh_key = 'refresh://%s%s' % (self.prefix, arg)
+        if not memcache.add(refresh_key, 1, self.LEASE, namespace=self.namespace):
+            return
+        try:
+            deferred.defer(refresh_memoized, self.prefix, arg)
+        except taskqueue.Error:
+            logging.exception('unable to schedule refresh of %s', refresh_key)
+
+
+MEMOIZED = {}  # {prefix: Memoizer}
+
+
+def refresh_memoized(prefix, arg):
+    """Recompute and cache a memoized value. Run in deferred tasks."""
+    urlfetch.set_default_fetch_deadline(60)
+    memo = MEMOIZED[prefix]
+    memo.store('%s%s' % (prefix, arg), memo.func(arg))
+
+
+def memcache_memoize(prefix, expires=60 * 60, neg_expires=60, stale=0,
+                     local_size=100):
     """Decorate a function to memoize its results using memcache.
 
     The function must take a single string as input, and return a pickleable
-    type.
+    type. Results are also kept in a per-instance LRU cache.
 
     Args:
         prefix: A prefix for memcache keys to use for memoization.
         expires: How long to memoized values, in seconds.
         neg_expires: How long to memoize falsey values, in seconds
+        stale: How long after expiring to keep returning a value, in seconds,
+            while it's recomputed in the background.
+        local_size: How many values to keep in the per-instance cache.
     Returns:
         A decorator closure to wrap the function.
     """
-    # setting the namespace based on the current version prevents different
-    # versions from sharing cache values -- meaning there's no need to worry
-    # about incompatible old key/value pairs
-    namespace = os.environ['CURRENT_VERSION_ID']
     def wrapper(func):
+        memo = Memoizer(func, prefix, expires, neg_expires, stale, local_size)
+        MEMOIZED[prefix] = memo
         @functools.wraps(func)
         def wrapped(arg):
-            key = '%s%s' % (prefix, arg)
-            data = memcache.get(key, namespace=namespace)
-            if data is not None:
-                return data
-            else:
-                data = func(arg)
-                try:
-                    if data:
-                        memcache.add(key, data, expires, namespace=namespace)
-                    else:
-                        memcache.add(key, data, neg_expires, namespace=namespace)
-                except ValueError:
-                    logging.exception('unable to write to memcache')
-                return data
+            return memo(arg)
         return wrapped
     return wrapper
 
 
-@memcache_memoize('gs-ls://', expires=60)
-def gcs_ls(path):
-    """Enumerate files in a GCS directory. Returns a list of FileStats."""
+def list_dir(path):
+    """Enumerate files in a GCS directory, uncached. Returns a list of FileStats."""
     if path[-1] != '/':
         path += '/'
     return list(gcs.listbucket(path, delimiter='/'))
 
 
+@memcache_memoize('gs-ls://', expires=60, stale=60 * 10)
+def gcs_ls(path):
+    """
+    Enumerate files in a GCS directory. Returns a list of FileStats.
+
+    Listings can be up to 11 minutes stale: use list_dir for anything that
+    will be stored for good.
+    """
+    return list_dir(path)
+
+
+class JunitTarget(object):
+    """
+    An XMLParser target that collects failures as each testcase closes.
+
+    Only the testcase currently being parsed is built into a tree, so the
+    memory used doesn't grow with the size of the JUnit file.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.failures = []
+        self.depth = 0
+        self.root = None
+        self.suite_name = None
+        self.case = None  # a TreeBuilder for the current testcase
+        self.case_depth = None
+
+    def is_testcase(self, tag):
+        if self.root == 'testsuite':
+            return self.depth == 2
+        return self.root == 'testsuites' and self.depth == 3 and tag == 'testcase'
+
+    def start(self, tag, attrib):
+        self.depth += 1
+        if self.case is not None:
+            self.case.start(tag, attrib)
+        elif self.depth == 1:
+            self.root = tag
+            if tag not in ('testsuite', 'testsuites'):
+                logging.error('unable to find failures, unexpected tag %s', tag)
+        elif self.root == 'testsuites' and self.depth == 2:
+            self.suite_name = attrib['name']
+        elif self.is_testcase(tag):
+            self.case = TreeBuilder()
+            self.case.start(tag, attrib)
+            self.case_depth = self.depth
+
+    def data(self, data):
+        if self.case is not None:
+            self.case.data(data)
+
+    def end(self, tag):
+        if self.case is not None:
+            self.case.end(tag)
+            if self.depth == self.case_depth:
+                self.add_failures(self.case.close())
+                self.case = None
+        self.depth -= 1
+
+    def add_failures(self, child):
+        name = child.attrib['name']
+        if self.root == 'testsuites':
+            name = '%s %s' % (self.suite_name, name)
+        duration = float(child.attrib['time'])
+        for param in child.findall('failure'):
+            self.failures.append((name, duration, param.text, self.filename))
+
+    def close(self):
+        pass
+
+
+class JunitParser(object):
+    """
+    Incrementally parse JUnit XML into (name, duration, text, filename) tuples.
+
+    Data can be fed in arbitrary chunks. Each call returns the failures
+    from testcases that were completed by that chunk.
+    """
+    def __init__(self, filename):
+        self.target = JunitTarget(filename)
+        self.parser = ET.DefusedXMLParser(target=self.target)
+
+    def drain(self):
+        failures = self.target.failures
+        self.target.failures = []
+        return failures
+
+    def feed(self, data):
+        self.parser.feed(data)
+        return self.drain()
+
+    def close(self):
+        self.parser.close()
+        return self.drain()
+
+
+def feed_junit(parser, parsed, data):
+    """Parse a chunk of a JUnit file, collecting its failures in parsed."""
+    parsed.extend(parser.feed(data))
+
+
 def parse_junit(xml, filename):
     """Generate failed tests as a series of (name, duration, text, filename) tuples."""
-    tree = ET.fromstring(xml)
-    if tree.tag == 'testsuite':
-        for child in tree:
-            name = child.attrib['name']
-            time = float(child.attrib['time'])
-            for param in child.findall('failure'):
-                yield name, time, param.text, filename
-    elif tree.tag == 'testsuites':
-        for testsuite in tree:
-            suite_name = testsuite.attrib['name']
-            for child in testsuite.findall('testcase'):
-                name = '%s %s' % (suite_name, child.attrib['name'])
-                time = float(child.attrib['time'])
-                for param in child.findall('failure'):
-                    yield name, time, param.text, filename
-    else:
-        logging.error('unable to find failures, unexpected tag %s', tree.tag)
+    parser = JunitParser(filename)
+    for failure in parser.feed(xml):
+        yield failure
+    for failure in parser.close():
+        yield failure
 
 
-@memcache_memoize('build-details://', expires=60 * 60 * 4)
+# Details can be several MB each, so only a few are kept per instance.
+@memcache_memoize('build-details://', expires=60 * 60 * 4, local_size=4)
 def build_details(build_dir):
     """
     Collect information from a build directory.
 
+    The details of finished builds are stored as a models.BuildSummary, so
+    they only need to be computed from GCS once.
+
     Args:
         build_dir: GCS path containing a build's results.
     Returns:
@@ -152,6 +437,27 @@ def build_details(build_dir):
         failures: list of (name, duration, text) tuples
         build_log: a hilighted portion of errors in the build log. May be None.
     """
+    details = models.BuildSummary.load(build_dir)
+    if details:
+        return details
+    details, complete = compute_build_details(build_dir)
+    if details and complete:
+        _, finished, failures, build_log = details
+        # Only finished builds are immutable-- but a failed build with
+        # nothing to show for it may still be uploading its artifacts.
+        if finished and (failures or build_log or finished.get('result') == 'SUCCESS'):
+            models.BuildSummary.store(build_dir, details)
+    return details
+
+
+def compute_build_details(build_dir):
+    """
+    Read and parse a build's results from GCS. See build_details.
+
+    Returns:
+        (details, complete), where complete is whether every junit file (and
+        the build log, if it was needed) was read successfully.
+    """
     started_fut = gcs_async.read(build_dir + '/started.json')
     finished = gcs_async.read(build_dir + '/finished.json').get_result()
     started = started_fut.get_result()
@@ -160,33 +466,66 @@ def build_details(build_dir):
     if started and not finished:
         finished = 'null'
     elif not (started and finished):
-        return
+        return None, False
     started = json.loads(started)
     finished = json.loads(finished)
 
-    failures = []
-    junit_paths = [f.filename for f in gcs_ls('%s/artifacts' % build_dir)
+    # The details of finished builds are stored for good, so they're computed
+    # from a fresh listing, not one taken while artifacts were uploading.
+    junit_paths = [f.filename for f in list_dir('%s/artifacts' % build_dir)
                    if re.match(r'junit_.*\.xml', os.path.basename(f.filename))]
+    failures, complete = read_junit_failures(junit_paths)
 
-    junit_futures = {}
+    build_log = None
+    if finished and finished.get('result') != 'SUCCESS' and len(failures) == 0:
+        build_log = digest_build_log(build_dir)
+        complete = complete and build_log is not None
+    return (started, finished, failures, build_log), complete
+
+
+def read_junit_failures(junit_paths):
+    """
+    Stream and parse JUnit files, returning (failures, complete).
+
+    Each file is parsed as its chunks arrive, rather than holding every
+    file's contents (and their parsed trees) in memory at once. A file's
+    failures are only kept if all of it could be read.
+    """
+    junit_futures = []
     for f in junit_paths:
-        junit_futures[gcs_async.read(f)] = f
+        parser = JunitParser(f)
+        parsed = []
+        consume = functools.partial(feed_junit, parser, parsed)
+        junit_futures.append((gcs_async.stream(f, consume), parser, parsed))
 
-    for future in junit_futures:
-        junit = future.get_result()
-        if junit is None:
-            continue
-        failures.extend(parse_junit(junit, junit_futures[future]))
+    failures = []
+    complete = True
+    for future, parser, parsed in junit_futures:
+        if future.get_result():
+            failures.extend(parsed)
+            failures.extend(parser.close())
+        else:
+            complete = False
     failures.sort()
+    return failures, complete
 
-    build_log = None
-    if finished and finished.get('result') != 'SUCCESS' and len(failures) == 0:
-        build_log = gcs_async.read(build_dir + '/build-log.txt').get_result()
-        if build_log:
-            build_log = log_parser.digest(build_log.decode('utf8', 'replace'))
-            logging.info('fallback log parser emitted %d lines',
-                         build_log.count('\n'))
-    return started, finished, failures, build_log
+
+def digest_build_log(build_dir):
+    """
+    Return the hilighted errors of a build's log, or None if it couldn't be read.
+
+    Build logs can be hundreds of megabytes, so they're digested as they
+    stream in instead of being read whole.
+    """
+    digester = log_parser.LogDigester()
+    decoder = codecs.getincrementaldecoder('utf8')('replace')
+    consume = lambda data: digester.feed(decoder.decode(data))
+    if not gcs_async.stream(build_dir + '/build-log.txt', consume).get_result():
+        return None
+    digester.feed(decoder.decode('', final=True))
+    build_log = digester.close()
+    logging.info('fallback log parser emitted %d lines', build_log.count('\n'))
+    return build_log
 
 
 @memcache_memoize('log-file://', expires=60*60*4)
@@ -215,7 +554,7 @@ def parse_log_file(log_filename, pod, filters=None, make_dict=False, objref_dict
         error_re=pod_re, filters=filters, objref_dict=objref_dict)
 
 
-@memcache_memoize('pr-details://', expires=60 * 3)
+@memcache_memoize('pr-details://', expires=60 * 3, stale=60 * 30)
 def pr_builds(pr):
     """
     Get information for all builds run by a PR.
@@ -230,15 +569,20 @@ def pr_builds(pr):
     def base(path):
         return os.path.basename(os.path.dirname(path))
 
-    jobs_futures = [(job, gcs_async.listdirs(job)) for job in jobs_dirs_fut.get_result()]
     futures = []
 
-    for job, builds_fut in jobs_futures:
-        for build in builds_fut.get_result():
+    def read_builds(job, builds):
+        # Start reading each page of builds while later pages are listed.
+        for build in builds:
             sta_fut = gcs_async.read('/%sstarted.json' % build)
             fin_fut = gcs_async.read('/%sfinished.json' % build)
             futures.append([base(job), base(build), sta_fut, fin_fut])
 
+    builds_futures = [gcs_async.listdirs(job, functools.partial(read_builds, job))
+                      for job in jobs_dirs_fut.get_result()]
+    for builds_fut in builds_futures:
+        builds_fut.get_result()
+
     futures.sort(key=lambda (job, build, s, f): (job, pad_numbers(build)), reverse=True)
 
     jobs = {}
@@ -312,8 +656,9 @@ class BuildListHandler(RenderingHandler):
     def get(self, prefix, job):
         self.check_bucket(prefix)
         job_dir = '/%s/%s/' % (prefix, job)
-        fstats = gcs_ls(job_dir)
-        fstats.sort(key=lambda f: pad_numbers(f.filename), reverse=True)
+        # Sorted copies, since the cached listing is shared between requests.
+        fstats = sorted(gcs_ls(job_dir), key=lambda f: pad_numbers(f.filename),
+                        reverse=True)
         self.render('build_list.html',
                     dict(job=job, job_dir=job_dir, fstats=fstats))
 
@@ -380,8 +725,7 @@ class JobListHandler(RenderingHandler):
     def get(self, prefix):
         self.check_bucket(prefix)
         jobs_dir = '/%s' % prefix
-        fstats = gcs_ls(jobs_dir)
-        fstats.sort()
+        fstats = sorted(gcs_ls(jobs_dir))
         self.render('job_list.html', dict(jobs_dir=jobs_dir, fstats=fstats))
 
 
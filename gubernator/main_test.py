@@ -22,14 +22,19 @@ To run these tests:
 """
 
 import os
+import threading
+import time
 import unittest
 
 import webtest
 
 import cloudstorage as gcs
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
 
 import main
 import gcs_async
+import models
 import gcs_async_test
 
 write = gcs_async_test.write
@@ -94,6 +99,14 @@ class ParseJunitTest(unittest.TestCase):
     def test_bad_xml(self):
         self.assertEqual(self.parse('''<body />'''), [])
 
+    def test_incremental(self):
+        parser = main.JunitParser("fp")
+        failures = []
+        for n in xrange(0, len(JUNIT_SUITE), 7):
+            failures.extend(parser.feed(JUNIT_SUITE[n:n + 7]))
+        failures.extend(parser.close())
+        self.assertEqual(failures, self.parse(JUNIT_SUITE))
+
 
 class TestBase(unittest.TestCase):
     def init_stubs(self):
@@ -104,6 +117,12 @@ class TestBase(unittest.TestCase):
         self.testbed.init_datastore_v3_stub()
         # redirect GCS calls to the local proxy
         gcs_async.GCS_API_URL = gcs.common.local_api_url()
+        self.clear_cache()
+
+    def clear_cache(self):
+        self.testbed.init_memcache_stub()
+        for memo in main.MEMOIZED.itervalues():
+            memo.local.clear()
 
 
 class AppTest(TestBase):
@@ -163,6 +182,27 @@ class AppTest(TestBase):
         response = self.get_build_page()
         self.assertIn('No Test Failures', response)
 
+    def break_stream(self, filename):
+        """Make streams of filename fail after reading most of JUNIT_SUITE."""
+        real_stream = gcs_async.stream
+        def stream(path, consume, *args):
+            if not path.endswith(filename):
+                return real_stream(path, consume, *args)
+            consume(JUNIT_SUITE[:JUNIT_SUITE.index('</testsuite>')])
+            future = ndb.Future()
+            future.set_result(False)
+            return future
+        gcs_async.stream = stream
+        self.addCleanup(setattr, gcs_async, 'stream', real_stream)
+
+    def test_build_junit_stream_failed(self):
+        """Test that failures from a partly read junit file are dropped."""
+        self.break_stream('junit_01.xml')
+        response = self.get_build_page()
+        self.assertNotIn('Error Goes Here', response)
+        # The incomplete details are only memoized, not stored for good.
+        self.assertIsNone(models.BuildSummary.load(self.BUILD_DIR[:-1]))
+
     def test_build_show_log(self):
         """Test that builds that failed with no failures show the build log."""
         gcs.delete(self.BUILD_DIR + 'artifacts/junit_01.xml')
@@ -173,7 +213,7 @@ class AppTest(TestBase):
         response = self.get_build_page()
         self.assertNotIn('Error lines', response)
 
-        self.testbed.init_memcache_stub()  # clear cached result
+        self.clear_cache()
         write(self.BUILD_DIR + 'build-log.txt',
               u'ERROR: test \u039A\n\n\n\n\n\n\n\n\nblah'.encode('utf8'))
         response = self.get_build_page()
@@ -213,10 +253,37 @@ class AppTest(TestBase):
         response2 = self.get_build_page()
         self.assertEqual(str(response), str(response2))
 
+    def test_build_summary(self):
+        """Test that finished builds are served from their stored summary."""
+        # A listing cached while the artifacts were uploading isn't used.
+        gcs.delete(self.BUILD_DIR + 'artifacts/junit_01.xml')
+        main.gcs_ls(self.BUILD_DIR + 'artifacts')
+        init_build(self.BUILD_DIR)
+        response = self.get_build_page()
+        self.clear_cache()
+        gcs.delete(self.BUILD_DIR + 'artifacts/junit_01.xml')
+        response2 = self.get_build_page()
+        self.assertIn('Error Goes Here', response2)
+        self.assertEqual(str(response), str(response2))
+
+    def test_build_summary_unfinished(self):
+        """Test that unfinished builds aren't stored as summaries."""
+        build_dir = '/kubernetes-jenkins/logs/job-still-running/1234/'
+        init_build(build_dir, finished=False)
+        app.get('/build' + build_dir)
+        self.assertIsNone(models.BuildSummary.load(build_dir[:-1]))
+
     def test_build_list(self):
-        """Test that the job page shows a list of builds."""
-        response = app.get('/builds' + os.path.dirname(self.BUILD_DIR[:-1]))
+        """Test that the job page shows a list of builds, newest first."""
+        job_dir = os.path.dirname(self.BUILD_DIR[:-1]) + '/'
+        init_build(job_dir + '1235/')
+        listing = [f.filename for f in main.gcs_ls(job_dir)]
+        response = app.get('/builds' + job_dir[:-1])
         self.assertIn('/1234/">1234</a>', response)
+        self.assertLess(response.body.index('/1235/'),
+                        response.body.index('/1234/'))
+        # The cached listing, shared by other requests, isn't reordered.
+        self.assertEqual([f.filename for f in main.gcs_ls(job_dir)], listing)
 
     def test_job_list(self):
         """Test that the job list shows our job."""
@@ -240,6 +307,96 @@ class AppTest(TestBase):
         self.assertIn("Event(api.ObjectReference{Name", response)
 
 
+class MemoizeTest(TestBase):
+    def setUp(self):
+        self.init_stubs()
+        self.testbed.init_taskqueue_stub()
+        self.calls = []
+
+        @main.memcache_memoize('test://', expires=60, stale=60)
+        def double(arg):
+            self.calls.append(arg)
+            return arg * 2
+        self.double = double
+        self.memo = main.MEMOIZED['test://']
+
+    def test_cached(self):
+        self.assertEqual(self.double('a'), 'aa')
+        self.assertEqual(self.double('a'), 'aa')
+        self.testbed.init_memcache_stub()
+        self.assertEqual(self.double('a'), 'aa')  # from the local cache
+        self.assertEqual(self.calls, ['a'])
+
+    def test_local_size(self):
+        self.memo.local.size = 1
+        self.double('a')
+        self.double('b')
+        self.assertIsNone(self.memo.local.get('test://a'))
+        self.assertEqual(self.double('a'), 'aa')  # from memcache
+        self.assertEqual(self.calls, ['a', 'b'])
+
+    def test_single_flight(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        @main.memcache_memoize('test-slow://')
+        def slow(arg):
+            self.calls.append(arg)
+            started.set()
+            release.wait(5)
+            return arg * 2
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(slow('a')))
+                   for _ in range(2)]
+        threads[0].start()
+        started.wait(5)
+        threads[1].start()
+        time.sleep(0.1)  # let the second caller wait on the first
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['aa', 'aa'])
+        self.assertEqual(self.calls, ['a'])  # computed only once
+
+    def test_lease_released_on_error(self):
+        @main.memcache_memoize('test-fail://')
+        def fail(arg):
+            self.calls.append(arg)
+            raise ValueError(arg)
+
+        with self.assertRaises(ValueError):
+            fail('a')
+        memo = main.MEMOIZED['test-fail://']
+        self.assertIsNone(memcache.get('lease://test-fail://a',
+                                       namespace=memo.namespace))
+
+    def test_sharded(self):
+        big = os.urandom(3 * 1000 * 1000)  # incompressible, so it's sharded
+
+        @main.memcache_memoize('test-big://')
+        def get_big(arg):
+            self.calls.append(arg)
+            return big
+
+        self.assertEqual(get_big('a'), big)
+        main.MEMOIZED['test-big://'].local.clear()
+        self.assertEqual(get_big('a'), big)  # from memcache
+        self.assertEqual(self.calls, ['a'])
+
+    def test_stale(self):
+        self.memo.store('test://a', 'stale')
+        fresh_until, stale_until, data = self.memo.local.get('test://a')
+        self.memo.local.put('test://a', (fresh_until - 90, stale_until - 90, data))
+        self.testbed.init_memcache_stub()
+        self.assertEqual(self.double('a'), 'stale')
+        self.assertEqual(self.double('a'), 'stale')
+        tasks = self.testbed.get_stub('taskqueue').get_filtered_tasks()
+        self.assertEqual(len(tasks), 1)  # only one refresh is scheduled
+        main.refresh_memoized('test://', 'a')
+        self.assertEqual(self.double('a'), 'aa')
+
+
 class PRTest(TestBase):
     BUILDS = {
         'build': [('12', {'version': 'bb', 'timestamp': 1467147654}, None),
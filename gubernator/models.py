@@ -0,0 +1,60 @@
+# Copyright 2016 The Kubernetes Authors All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+
+
+class BuildSummary(ndb.Model):
+    """
+    The computed results of a finished build, keyed by its GCS directory.
+
+    A finished build's artifacts don't change, so once this is written a
+    single datastore get replaces reading started.json, finished.json, and
+    every junit file again after memcache evicts the details.
+    """
+    # Bump this when the format of the stored details changes, so entities
+    # written by older versions are recomputed instead of misinterpreted.
+    VERSION = 1
+
+    # memcache_memoize already caches the details, don't store them twice.
+    _use_memcache = False
+
+    version = ndb.IntegerProperty(indexed=False)
+    started = ndb.JsonProperty(indexed=False)
+    finished = ndb.JsonProperty(indexed=False)
+    failures = ndb.JsonProperty(indexed=False, compressed=True)
+    build_log = ndb.TextProperty(compressed=True)
+
+    @classmethod
+    def load(cls, build_dir):
+        """Return the stored (started, finished, failures, build_log), or None."""
+        summary = cls.get_by_id(build_dir)
+        if summary is None or summary.version != cls.VERSION:
+            return None
+        failures = [tuple(failure) for failure in summary.failures]
+        return summary.started, summary.finished, failures, summary.build_log
+
+    @classmethod
+    def store(cls, build_dir, details):
+        """Save details, as returned by build_details, for build_dir."""
+        started, finished, failures, build_log = details
+        summary = cls(id=build_dir, version=cls.VERSION, started=started,
+                      finished=finished, failures=failures, build_log=build_log)
+        try:
+            summary.put()
+        except datastore_errors.BadRequestError:  # entity too large
+            logging.exception('unable to store summary for %s', build_dir)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+# Copyright 2016 The Kubernetes Authors All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A persistent store of collected builds, so gen_json can run incrementally."""
+
+import json
+import sqlite3
+
+
+class BuildStore(object):
+    """
+    A SQLite database of test results, keyed by (bucket, job, build).
+
+    Each job also has a cursor: the newest build collected for it. Builds at
+    or below the cursor don't need to be fetched again.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS builds (
+                bucket TEXT,
+                job TEXT,
+                build TEXT,
+                timestamp INTEGER,
+                tests TEXT,  -- JSON list of [name, time, failed, skipped]
+                PRIMARY KEY (bucket, job, build)
+            );
+            CREATE INDEX IF NOT EXISTS builds_by_timestamp ON builds (timestamp);
+            CREATE TABLE IF NOT EXISTS cursors (
+                bucket TEXT,
+                job TEXT,
+                build INTEGER,
+                PRIMARY KEY (bucket, job)
+            );
+        ''')
+
+    def get_cursors(self, bucket):
+        """Returns a set of (job, build) pairs for the newest build of each job."""
+        rows = self.db.execute(
+            'SELECT job, build FROM cursors WHERE bucket = ?', (bucket,))
+        return {(job, str(build)) for job, build in rows}
+
+    def add_build(self, bucket, job, build, timestamp, tests):
+        """
+        Saves a build's results, advancing its job's cursor.
+
+        Args:
+            tests: a list of (name, time, failed, skipped) tuples.
+        """
+        self.db.execute(
+            'INSERT OR REPLACE INTO builds VALUES (?, ?, ?, ?, ?)',
+            (bucket, job, build, timestamp, json.dumps(tests)))
+        self.db.execute(
+            'INSERT OR IGNORE INTO cursors VALUES (?, ?, ?)',
+            (bucket, job, int(build)))
+        self.db.execute(
+            'UPDATE cursors SET build = MAX(build, ?) WHERE bucket = ? AND job = ?',
+            (int(build), bucket, job))
+
+    def remove_old_builds(self, min_timestamp):
+        """Deletes builds older than min_timestamp. Cursors are kept."""
+        cursor = self.db.execute(
+            'DELETE FROM builds WHERE timestamp < ?', (min_timestamp,))
+        return cursor.rowcount
+
+    def get_jobs(self, bucket, names):
+        """
+        Loads the builds of every job in a bucket, in the format of tests.json.
+
+        Args:
+            bucket: the GCS path containing the jobs.
+            names: an IndexedList to index test names with.
+        Returns:
+            {job: {build: {'timestamp': int, 'tests': [...]}}}
+        """
+        jobs = {}
+        rows = self.db.execute(
+            'SELECT job, build, timestamp, tests FROM builds WHERE bucket = ?',
+            (bucket,))
+        for job, build, timestamp, tests in rows:
+            results = []
+            for name, duration, failed, skipped in json.loads(tests):
+                result = {'name': names.index(name), 'time': duration}
+                if failed:
+                    result['failed'] = True
+                if skipped:
+                    result['skipped'] = True
+                results.append(result)
+            jobs.setdefault(job, {})[build] = {
+                'timestamp': timestamp, 'tests': results}
+        return jobs
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
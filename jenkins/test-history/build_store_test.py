@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+# Copyright 2016 The Kubernetes Authors All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for build_store."""
+
+import unittest
+
+import build_store
+import gen_json
+
+
+BUCKET = 'gs://kubernetes-jenkins/logs/'
+
+
+class BuildStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.store = build_store.BuildStore(':memory:')
+
+    def test_cursors(self):
+        self.assertEqual(self.store.get_cursors(BUCKET), set())
+        self.store.add_build(BUCKET, 'fake', '9', 100, [])
+        self.store.add_build(BUCKET, 'fake', '10', 200, [])
+        self.store.add_build(BUCKET, 'fake', '8', 50, [])
+        self.store.add_build(BUCKET, 'other', '3', 50, [])
+        self.store.add_build('gs://bucket1/', 'fake', '1', 50, [])
+        self.assertEqual(self.store.get_cursors(BUCKET),
+                         {('fake', '10'), ('other', '3')})
+
+    def test_get_jobs(self):
+        self.store.add_build(BUCKET, 'fake', '123', 100, [
+            ('Foo', 3.0, False, False),
+            ('Bad', 4.0, True, False),
+            ('Lazy', 0.0, False, True)])
+        names = gen_json.IndexedList(['Bad'])
+        self.assertEqual(self.store.get_jobs(BUCKET, names), {
+            'fake': {'123': {'timestamp': 100, 'tests': [
+                {'name': 1, 'time': 3.0},
+                {'name': 0, 'time': 4.0, 'failed': True},
+                {'name': 2, 'time': 0.0, 'skipped': True}]}}})
+        self.assertEqual(names, ['Bad', 'Foo', 'Lazy'])
+
+    def test_remove_old_builds(self):
+        self.store.add_build(BUCKET, 'fake', '1', 100, [])
+        self.store.add_build(BUCKET, 'fake', '2', 200, [])
+        self.assertEqual(self.store.remove_old_builds(150), 1)
+        self.assertEqual(list(self.store.get_jobs(BUCKET, gen_json.IndexedList())['fake']),
+                         ['2'])
+        # the cursor doesn't move back
+        self.store.remove_old_builds(250)
+        self.assertEqual(self.store.get_cursors(BUCKET), {('fake', '2')})
+
+
+if __name__ == '__main__':
+    unittest.main()
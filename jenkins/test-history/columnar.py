@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+# Copyright 2016 The Kubernetes Authors All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A compact columnar alternative to the tests.json format.
+
+Each job's results are stored as three packed arrays, one entry per test run:
+test name indexes (uint32), durations (float32), and status bits. A JSON
+header at the end of the file lists the test names and, for every job, its
+builds and where its arrays are. Readers mmap the file and only unpack the
+jobs they ask for.
+
+Layout: MAGIC, job arrays..., header JSON, header offset (uint64).
+"""
+
+import array
+import json
+import mmap
+import struct
+import sys
+
+import stream_json
+
+MAGIC = 'TESTCOL1'
+TRAILER = struct.Struct('<Q')
+
+FAILED = 1
+SKIPPED = 2
+
+
+def _packed(typecode, values):
+    arr = array.array(typecode, values)
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr.tostring()
+
+
+def _unpacked(typecode, data):
+    arr = array.array(typecode)
+    arr.fromstring(data)
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr
+
+
+def is_columnar(path):
+    """Returns whether path is a file in the columnar format."""
+    with open(path, 'rb') as buf:
+        return buf.read(len(MAGIC)) == MAGIC
+
+
+class Writer(object):
+    """Writes jobs a bucket at a time, followed by the test names."""
+
+    def __init__(self, path):
+        self.out = open(path, 'wb')
+        self.out.write(MAGIC)
+        self.buckets = {}
+
+    def write_bucket(self, bucket, jobs):
+        """Appends a bucket's jobs: {job: {build: {...}}}, as in tests.json."""
+        self.buckets.setdefault(bucket, {})
+        for job, builds in sorted(jobs.iteritems()):
+            self.write_job(bucket, job, builds)
+
+    def write_job(self, bucket, job, builds):
+        """Appends a job's builds: {build: {'timestamp': int, 'tests': [...]}}."""
+        entries = []
+        names = []
+        times = []
+        statuses = []
+        for build, info in sorted(builds.iteritems()):
+            entries.append([build, info.get('timestamp'), len(info['tests'])])
+            for test in info['tests']:
+                names.append(test['name'])
+                times.append(test['time'])
+                statuses.append((FAILED if test.get('failed') else 0) |
+                                (SKIPPED if test.get('skipped') else 0))
+        self.buckets.setdefault(bucket, {})[job] = {
+            'builds': entries,
+            'offset': self.out.tell(),
+            'count': len(names),
+        }
+        self.out.write(_packed('I', names))
+        self.out.write(_packed('f', times))
+        self.out.write(_packed('B', statuses))
+
+    def close(self, test_names):
+        """Writes the header and closes the file."""
+        offset = self.out.tell()
+        json.dump({'test_names': test_names, 'buckets': self.buckets},
+                  self.out, sort_keys=True)
+        self.out.write(TRAILER.pack(offset))
+        self.out.close()
+
+
+def open_reader(path):
+    """Returns a Reader for path, which is in either this or the JSON format."""
+    if is_columnar(path):
+        return Reader(path)
+    return stream_json.Reader(path)
+
+
+def write(path, tests):
+    """Writes a dict in the tests.json format to path."""
+    writer = Writer(path)
+    for bucket, jobs in sorted(tests['buckets'].iteritems()):
+        writer.write_bucket(bucket, jobs)
+    writer.close(tests['test_names'])
+
+
+class Reader(object):
+    """Reads jobs out of a memory-mapped columnar file."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as buf:
+            self.mm = mmap.mmap(buf.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(MAGIC)] != MAGIC:
+            raise ValueError('%s is not a columnar test file' % path)
+        offset, = TRAILER.unpack(self.mm[-TRAILER.size:])
+        header = json.loads(self.mm[offset:-TRAILER.size])
+        self.test_names = header['test_names']
+        self.buckets = header['buckets']
+
+    def list_jobs(self):
+        """Generates (bucket, job, builds) for each job, ordered by bucket."""
+        for bucket, jobs in sorted(self.buckets.iteritems()):
+            for job in sorted(jobs):
+                yield bucket, job, self.get_job(bucket, job)
+
+    def list_columns(self):
+        """Generates (bucket, job, columns) for each job; see get_columns."""
+        for bucket, jobs in sorted(self.buckets.iteritems()):
+            for job in sorted(jobs):
+                yield bucket, job, self.get_columns(bucket, job)
+
+    def get_columns(self, bucket, job):
+        """
+        Returns a job's results as columns.
+
+        Returns:
+            (builds, names, times, statuses), where builds is a list of
+            [build, timestamp, count] and the others are arrays with an
+            entry for every test run, ordered by build.
+        """
+        info = self.buckets[bucket][job]
+        start, count = info['offset'], info['count']
+        names = _unpacked('I', self.mm[start:start + 4 * count])
+        start += 4 * count
+        times = _unpacked('f', self.mm[start:start + 4 * count])
+        start += 4 * count
+        statuses = _unpacked('B', self.mm[start:start + count])
+        return info['builds'], names, times, statuses
+
+    def get_job(self, bucket, job):
+        """Returns a job's builds, in the tests.json format."""
+        builds, names, times, statuses = self.get_columns(bucket, job)
+        out = {}
+        n = 0
+        for build, timestamp, count in builds:
+            tests = []
+            for i in xrange(n, n + count):
+                result = {'name': names[i], 'time': times[i]}
+                if statuses[i] & FAILED:
+                    result['failed'] = True
+                if statuses[i] & SKIPPED:
+                    result['skipped'] = True
+                tests.append(result)
+            n += count
+            out[build] = {'timestamp': timestamp, 'tests': tests}
+        return out
+
+    def load(self):
+        """Returns the whole file as a dict in the tests.json format."""
+        buckets = {bucket: {} for bucket in self.buckets}
+        for bucket, job, builds in self.list_jobs():
+            buckets[bucket][job] = builds
+        return {'test_names': self.test_names, 'buckets': buckets}
+
+    def close(self):
+        self.mm.close()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+# Copyright 2016 The Kubernetes Authors All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for columnar."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import columnar
+
+
+TEST_DATA = {
+    'test_names': ['test1', 'test2'],
+    'buckets': {
+        'gs://kubernetes-jenkins/logs/': {
+            'kubernetes-release': {
+                '3': {'timestamp': 30, 'tests': [{'name': 0, 'time': 3.5}]},
+                '4': {'timestamp': 40, 'tests': [
+                    {'name': 1, 'time': 63.25, 'failed': True}]},
+            },
+            'kubernetes-debug': {
+                '5': {'timestamp': 50, 'tests': []},
+                '6': {'timestamp': 60, 'tests': [
+                    {'name': 0, 'time': 0.0, 'skipped': True},
+                    {'name': 1, 'time': 3.5, 'failed': True},
+                ]},
+            },
+        },
+    },
+}
+
+
+class ColumnarTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='test-history-')
+        self.path = os.path.join(self.tmpdir, 'tests.col')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        columnar.write(self.path, TEST_DATA)
+        self.assertTrue(columnar.is_columnar(self.path))
+        reader = columnar.Reader(self.path)
+        self.assertEqual(reader.load(), TEST_DATA)
+        reader.close()
+
+    def test_columns(self):
+        columnar.write(self.path, TEST_DATA)
+        reader = columnar.Reader(self.path)
+        builds, names, times, statuses = reader.get_columns(
+            'gs://kubernetes-jenkins/logs/', 'kubernetes-debug')
+        self.assertEqual(builds, [['5', 50, 0], ['6', 60, 2]])
+        self.assertEqual(list(names), [0, 1])
+        self.assertEqual(list(times), [0.0, 3.5])
+        self.assertEqual(list(statuses), [columnar.SKIPPED, columnar.FAILED])
+        reader.close()
+
+    def test_not_columnar(self):
+        with open(self.path, 'w') as buf:
+            buf.write('{"test_names": []}')
+        self.assertFalse(columnar.is_columnar(self.path))
+        self.assertRaises(ValueError, columnar.Reader, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -22,15 +22,24 @@ from __future__ import print_function
 
 import argparse
 import collections
+import hashlib
+import itertools
 import json
+import multiprocessing
 import os
 import re
+import signal
 import sys
 import time
 
 import jinja2
+import numpy
 import yaml
 
+import columnar
+import inverted_index
+import rollup
+
 
 BLOCKING_JOBS = [
     'kubelet-gce-e2e-ci',
@@ -103,16 +112,62 @@ def gubernator_url(bucket, job, build, test_name=''):
         bucket[5:], job, build, slugify(test_name))
 
 
+def test_page(test_name):
+    """Returns the file name of the page listing the jobs a test fails in."""
+    return 'test-{}.html'.format(
+        hashlib.sha1(test_name.encode('utf-8')).hexdigest()[:16])
+
+JINJA_ENV.globals['test_page'] = test_page
+
+
+JobColumns = collections.namedtuple('JobColumns', [
+    'builds',     # build names
+    'ids',        # for each run: the index of its test's name
+    'times',      # ... its duration
+    'failed',     # ... whether it ran and failed
+    'ran',        # ... whether it wasn't skipped
+    'positions',  # ... the index of its build
+])
+
+
+def job_columns(job_data):
+    """Flattens a job's builds from the JSON format into JobColumns."""
+    builds = list(job_data)
+    runs = [test for build in builds for test in job_data[build]['tests']]
+    ids = numpy.fromiter((test['name'] for test in runs), int, len(runs))
+    times = numpy.fromiter((test['time'] for test in runs), float, len(runs))
+    failed = numpy.fromiter(('failed' in test for test in runs), bool, len(runs))
+    ran = ~numpy.fromiter(('skipped' in test for test in runs), bool, len(runs))
+    positions = numpy.repeat(
+        numpy.arange(len(builds)),
+        [len(job_data[build]['tests']) for build in builds])
+    return JobColumns(builds, ids, times, failed & ran, ran, positions)
+
+
+def columnar_job_columns(builds, names, times, statuses):
+    """Converts a job's columns from columnar.Reader into JobColumns."""
+    statuses = numpy.frombuffer(statuses, numpy.uint8)
+    ran = statuses & columnar.SKIPPED == 0
+    return JobColumns(
+        [build for build, _, _ in builds],
+        numpy.frombuffer(names, numpy.uint32),
+        numpy.frombuffer(times, numpy.float32).astype(float),
+        (statuses & columnar.FAILED != 0) & ran,
+        ran,
+        numpy.repeat(numpy.arange(len(builds)),
+                     [count for _, _, count in builds]))
+
+
 def job_results(bucket, prefix, job_name, job_data, test_names):
     """Generates a JobSummary namedtuple along with a list of test results.
 
-    This function is a bit of a monolith and should probably be cleared up.
+    Runs are aggregated per test with numpy, rather than one at a time.
 
     Args:
         bucket: The bucket name.
         prefix: The contributor prefix to prepend to the job name.
         job_name: The job name.
-        job_data: The JSON data as returned by list_jobs.
+        job_data: The JSON data as returned by list_jobs, or JobColumns.
         test_names: The JSON test names data.
     Returns:
         A (JobSummary, tests) tuple where tests is a list of dicts with this
@@ -126,57 +181,51 @@ def job_results(bucket, prefix, job_name, job_data, test_names):
         }]
     """
     full_job_name = '{}{}'.format(prefix, job_name)
-    num_failed = 0
-    num_passed = 0
+    if not isinstance(job_data, JobColumns):
+        job_data = job_columns(job_data)
+    builds, ids, times, failed, ran, positions = job_data
+
+    # Aggregate per test name index in one pass over the columns.
+    num_tests = int(ids.max()) + 1 if len(ids) else 0
+    test_runs = numpy.bincount(ids[ran], minlength=num_tests)
+    test_failed = numpy.bincount(ids[failed], minlength=num_tests)
+    test_duration = numpy.bincount(
+        ids[ran], weights=times[ran], minlength=num_tests)
+    test_latest = numpy.full(num_tests, -1, int)
+    numpy.maximum.at(test_latest, ids[failed], positions[failed])
+
+    failed_builds = numpy.bincount(positions[failed], minlength=len(builds))
+    num_failed = int(numpy.count_nonzero(failed_builds))
+    num_passed = len(builds) - num_failed
     latest_failure = None
-    test_summaries = {}
-    for build in job_data:
-        build_passed = True
-        tests_data = job_data[build]['tests']
-        for test in tests_data:
-            test_id = test['name']
-            if test_id not in test_summaries:
-                test_summaries[test_id] = {
-                    'name': test_names[test_id],
-                    'runs': 0,
-                    'passed': 0,
-                    'failed': 0,
-                    'duration': 0.0,
-                    'latest_failure': None,
-                }
-            if 'skipped' in test:
-                pass
-            else:
-                test_summaries[test_id]['runs'] += 1
-                test_summaries[test_id]['duration'] += test['time']
-                if 'failed' in test:
-                    test_summaries[test_id]['latest_failure'] = build
-                    latest_failure = build
-                    build_passed = False
-                    test_summaries[test_id]['failed'] += 1
-                else:
-                    test_summaries[test_id]['passed'] += 1
-        if build_passed:
-            num_passed += 1
-        else:
-            num_failed += 1
+    if failed.any():
+        latest_failure = gubernator_url(
+            bucket, job_name, builds[positions[failed].max()])
+
     stable = 0
     unstable = 0
     broken = 0
     tests = []
-    for test in sorted(test_summaries.values(), key=lambda t: t['name'].lower()):
-        if test['latest_failure'] is not None:
-            test['latest_failure'] = gubernator_url(bucket, job_name, test['latest_failure'], test['name'])
-        if test['runs'] > 0:
-            tests.append(test)
-            if test['failed'] == 0:
-                stable += 1
-            elif test['failed'] < test['runs']:
-                unstable += 1
-            else:
-                broken += 1
-    if latest_failure is not None:
-        latest_failure = gubernator_url(bucket, job_name, latest_failure)
+    for n in numpy.flatnonzero(test_runs):
+        name = test_names[n]
+        test = {
+            'name': name,
+            'runs': int(test_runs[n]),
+            'passed': int(test_runs[n] - test_failed[n]),
+            'failed': int(test_failed[n]),
+            'duration': float(test_duration[n]),
+            'latest_failure': None,
+        }
+        if test_latest[n] >= 0:
+            test['latest_failure'] = gubernator_url(
+                bucket, job_name, builds[test_latest[n]], name)
+        tests.append(test)
+        if test['failed'] == 0:
+            stable += 1
+        elif test['failed'] < test['runs']:
+            unstable += 1
+        else:
+            broken += 1
     job_summary = JobSummary(
         full_job_name,
         num_passed,
@@ -186,7 +235,7 @@ def job_results(bucket, prefix, job_name, job_data, test_names):
         stable,
         unstable,
         broken)
-    tests.sort(key=lambda t: (t['failed'], t['passed']), reverse=True)
+    tests.sort(key=lambda t: (-t['failed'], -t['passed'], t['name'].lower()))
     return job_summary, tests
 
 
@@ -197,60 +246,225 @@ def list_jobs(data):
             yield bucket, name, job
 
 
-def merge_bad_tests(bad_tests, new_tests):
-    """Merge unstable and broken tests from new_tests into bad_tests.
+def test_jobs(index, test_id, test_name):
+    """Summarizes a test's runs in each job, using a TestIndex.
+
+    Args:
+        index: a built TestIndex, whose jobs are (bucket, prefix, job name,
+            build names) tuples.
+        test_id: the test's name index.
+        test_name: the test's name.
+    Returns:
+        A list of dicts for the jobs the test ran in, sorted by failure count,
+        passed count, then job name: [{
+            'job': 'kubernetes-e2e-gce',
+            'runs': 1,
+            'passed': 1,
+            'failed': 0,
+            'latest_failure': None or 'https://gubernater-link...',
+        }]
+    """
+    postings = index.lookup(test_id)
+    ran = postings.statuses & columnar.SKIPPED == 0
+    failed = (postings.statuses & columnar.FAILED != 0) & ran
+    jobs = []
+    for job_no in numpy.unique(postings.jobs[ran]):
+        bucket, prefix, job_name, builds = index.jobs[job_no]
+        in_job = postings.jobs == job_no
+        runs = int(numpy.count_nonzero(in_job & ran))
+        job_failed = int(numpy.count_nonzero(in_job & failed))
+        latest_failure = None
+        if job_failed:
+            latest_failure = gubernator_url(
+                bucket, job_name,
+                builds[postings.builds[in_job & failed].max()], test_name)
+        jobs.append({
+            'job': '{}{}'.format(prefix, job_name),
+            'runs': runs,
+            'passed': runs - job_failed,
+            'failed': job_failed,
+            'latest_failure': latest_failure,
+        })
+    jobs.sort(key=lambda j: (-j['failed'], -j['passed'], j['job']))
+    return jobs
+
+
+def blocking_failures(test_name, jobs):
+    """Sums a test's results in the BLOCKING_JOBS it failed in.
 
     Args:
-        bad_tests: Dictionary from test name to test results.
-        new_tests: List of new test results to merge.
+        test_name: the test's name.
+        jobs: the test's results in each job, as returned by test_jobs.
+    Returns:
+        A dict like test_jobs', with 'name' instead of 'job', or None if
+        the test didn't fail in any blocking job.
+    """
+    failing = [job for job in jobs
+               if job['failed'] > 0 and job['job'] in BLOCKING_JOBS]
+    if not failing:
+        return None
+    return {
+        'name': test_name,
+        'runs': sum(job['runs'] for job in failing),
+        'passed': sum(job['passed'] for job in failing),
+        'failed': sum(job['failed'] for job in failing),
+        'latest_failure': failing[0]['latest_failure'],
+    }
+
+
+def init_worker(test_names, rollups_path=None):
+    """Sets up a process to render jobs in."""
+    # Test names are shared by every job, so they're sent to each worker
+    # once rather than with every job.
+    global WORKER_TEST_NAMES, WORKER_ROLLUPS
+    WORKER_TEST_NAMES = test_names
+    WORKER_ROLLUPS = rollups_path and rollup.RollupStore(rollups_path)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # make Ctrl-C kill the worker
+
+
+def write_page(template_name, context, page_path, old_hash):
+    """
+    Renders a template to page_path, unless the page's contents didn't change.
+
     Returns:
-        Nothing, modifies bad_tests in place.
+        (page hash, whether the page was written)
+    """
+    template_source = JINJA_ENV.loader.get_source(JINJA_ENV, template_name)[0]
+    page_hash = hashlib.sha1(template_source.encode('utf-8') + json.dumps(
+        context, sort_keys=True)).hexdigest()
+    if page_hash == old_hash and os.path.exists(page_path):
+        return page_hash, False
+    html = JINJA_ENV.get_template(template_name).render(context)
+    with open(page_path, 'w') as page_file:
+        page_file.write(html.encode('utf-8'))
+    return page_hash, True
+
+
+def render_job((bucket, prefix, job_name, job_data, out_dir, old_hash)):
     """
-    for new_test in new_tests:
-        if new_test['failed'] > 0:
-            name = new_test['name']
-            if name not in bad_tests:
-                bad_tests[name] = {
-                    'name': name,
-                    'runs': 0,
-                    'passed': 0,
-                    'failed': 0,
-                    'latest_failure': None,
-                }
-            bad_tests[name]['runs'] += new_test['runs']
-            bad_tests[name]['passed'] += new_test['passed']
-            bad_tests[name]['failed'] += new_test['failed']
-            bad_tests[name]['latest_failure'] = new_test['latest_failure']
-
-
-def main(in_path, buckets_path, out_dir):
-    """Uses in_path and buckets_path to write a static report under out_dir."""
-    with open(in_path) as data_file:
-        data = json.load(data_file)
-
-    templates_path = '{}/templates'.format(os.path.abspath(os.path.dirname(__file__)))
+    Summarizes a job, and writes its page if the page's contents changed.
+
+    Returns:
+        (JobSummary, page hash, whether the page was written)
+    """
+    full_name = '{}{}'.format(prefix, job_name)
+    job, tests = job_results(bucket, prefix, job_name, job_data, WORKER_TEST_NAMES)
+    page_hash = None
+    written = False
+    if job.tests > 0:
+        context = {
+            'job_name': job_name,
+            'tests': tests,
+        }
+        if WORKER_ROLLUPS:
+            # Daily counts from earlier runs, to compare against.
+            rates = WORKER_ROLLUPS.get_rates(bucket, job_name, time.time())
+            for test in tests:
+                test['rates'] = rates.get(test['name'])
+            context['windows'] = rollup.WINDOWS
+        page_hash, written = write_page(
+            'job.html', context, '{}/suite-{}.html'.format(out_dir, full_name),
+            old_hash)
+    return job, page_hash, written
+
+
+def render_test((test_name, jobs, out_dir, old_hash)):
+    """
+    Writes the page of the jobs a test ran in, if its contents changed.
+
+    Returns:
+        (page name, page hash, whether the page was written)
+    """
+    page = test_page(test_name)
+    context = {
+        'test_name': test_name,
+        'jobs': jobs,
+    }
+    page_hash, written = write_page(
+        'test.html', context, '{}/{}'.format(out_dir, page), old_hash)
+    return page, page_hash, written
+
+
+def main(in_path, buckets_path, out_dir, processes=1, rollups_path=None):
+    """Uses in_path and buckets_path to write a static report under out_dir.
+
+    Job pages are rendered in a pool of processes. Each page's contents are
+    hashed, and pages whose hash didn't change since the last run aren't
+    written again. If rollups_path is set, job pages also show each test's
+    failures today and over the last 7 and 30 calendar days (UTC).
+
+    Every run is also added to a TestIndex, which the failing tests' pages
+    and the table of tests failing in BLOCKING_JOBS are made from.
+    """
+    # Jobs are read one at a time, from either the JSON or columnar format.
+    reader = columnar.open_reader(in_path)
+
+    hashes_path = os.path.join(out_dir, 'page-hashes.json')
+    old_hashes = {}
+    if os.path.exists(hashes_path):
+        with open(hashes_path) as hashes_file:
+            old_hashes = json.load(hashes_file)
+    hashes = {}
 
     summaries = []
-    bad_tests = {}
+    index = inverted_index.TestIndex()
     with open(buckets_path) as buckets_file:
         prefixes = load_prefixes(buckets_file)
-    for bucket, job_name, job_data in list_jobs(data):
-        if bucket not in prefixes:
-            raise ValueError('Unknown bucket: {}'.format(bucket))
-        prefix = prefixes[bucket]
-        full_name = '{}{}'.format(prefix, job_name)
-        job, tests = job_results(bucket, prefix, job_name, job_data, data['test_names'])
-        if full_name in BLOCKING_JOBS:
-            merge_bad_tests(bad_tests, tests)
+    if isinstance(reader, columnar.Reader):
+        jobs = ((bucket, job_name, columnar_job_columns(*columns))
+                for bucket, job_name, columns in reader.list_columns())
+    else:
+        jobs = reader.list_jobs()
+
+    def list_tasks():
+        for bucket, job_name, job_data in jobs:
+            if bucket not in prefixes:
+                raise ValueError('Unknown bucket: {}'.format(bucket))
+            prefix = prefixes[bucket]
+            full_name = '{}{}'.format(prefix, job_name)
+            if not isinstance(job_data, JobColumns):
+                job_data = job_columns(job_data)
+            index.add_job((bucket, prefix, job_name, job_data.builds),
+                          job_data.ids, job_data.positions, job_data.failed,
+                          job_data.ran)
+            yield (bucket, prefix, job_name, job_data, out_dir,
+                   old_hashes.get(full_name))
+
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, init_worker,
+                                    (reader.test_names, rollups_path))
+        imap = pool.imap
+    else:
+        init_worker(reader.test_names, rollups_path)
+        imap = itertools.imap
+    written = 0
+    for job, page_hash, page_written in imap(render_job, list_tasks()):
         summaries.append(job)
-        if job.tests > 0:
-            job_template = JINJA_ENV.get_template('job.html')
-            job_html = job_template.render({
-                'job_name': job_name,
-                'tests': tests,
-            })
-            with open('{}/suite-{}.html'.format(out_dir, full_name), 'w') as job_file:
-                job_file.write(job_html)
+        if page_hash:
+            hashes[job.name] = page_hash
+        written += page_written
+    print('wrote %d of %d job pages' % (written, len(hashes)))
+
+    # Every job has been added by now, so the index can be built.
+    index.build()
+    bad_tests = []
+    test_tasks = []
+    for test_id in index.failing_tests():
+        test_name = reader.test_names[test_id]
+        jobs = test_jobs(index, test_id, test_name)
+        bad_test = blocking_failures(test_name, jobs)
+        if bad_test:
+            bad_tests.append(bad_test)
+        test_tasks.append((test_name, jobs, out_dir,
+                           old_hashes.get(test_page(test_name))))
+    written = 0
+    for page, page_hash, page_written in imap(render_test, test_tasks):
+        hashes[page] = page_hash
+        written += page_written
+    if processes > 1:
+        pool.close()
+    print('wrote %d of %d test pages' % (written, len(test_tasks)))
+
     summaries.sort()
     blocking_job_summaries = filter(lambda s: s.name in BLOCKING_JOBS, summaries)
 
@@ -258,10 +472,12 @@ def main(in_path, buckets_path, out_dir):
     index_html = index_template.render({
         'last_updated': time.strftime('%a %b %d %T %Z'),
         'job_groups': [blocking_job_summaries, summaries],
-        'bad_tests': sorted(bad_tests.values(), key=lambda t: t['failed'] / (t['passed'] + t['failed']), reverse=True),
+        'bad_tests': sorted(bad_tests, key=lambda t: t['failed'] / (t['passed'] + t['failed']), reverse=True),
     })
     with open('{}/index.html'.format(out_dir), 'w') as index_file:
         index_file.write(index_html)
+    with open(hashes_path, 'w') as hashes_file:
+        json.dump(hashes, hashes_file, sort_keys=True)
 
 
 def get_options(argv):
@@ -273,9 +489,15 @@ def get_options(argv):
                         help='JSON test data to read for input')
     parser.add_argument('--buckets', required=True,
                         help='JSON GCS buckets to read for test results')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='how many processes to render pages with')
+    parser.add_argument('--rollups',
+                        help='SQLite daily counts written by gen_json, to show '
+                             'flake rates over longer windows')
     return parser.parse_args(argv)
 
 
 if __name__ == '__main__':
     OPTIONS = get_options(sys.argv[1:])
-    main(OPTIONS.input, OPTIONS.buckets, OPTIONS.output_dir)
+    main(OPTIONS.input, OPTIONS.buckets, OPTIONS.output_dir, OPTIONS.processes,
+         OPTIONS.rollups)
@@ -21,11 +21,15 @@ import os
 import shutil
 import StringIO
 import tempfile
+import time
 import unittest
 
 import yaml
 
+import columnar
 import gen_html
+import inverted_index
+import rollup
 
 
 TEST_DATA = {
@@ -102,6 +106,30 @@ class GenHtmlTest(unittest.TestCase):
         self.assertEqual(summary.failed, 0)
         self.assertEqual(summary.tests, 0)
 
+    def test_job_results_columnar(self):
+        """Test that job_results gives the same results from columnar data."""
+        temp_dir = tempfile.mkdtemp(prefix='kube-test-hist-')
+        try:
+            path = os.path.join(temp_dir, 'tests.col')
+            columnar.write(path, TEST_DATA)
+            reader = columnar.Reader(path)
+            for bucket, job, columns in reader.list_columns():
+                summary, tests = gen_html.job_results(
+                    bucket, '', job, gen_html.columnar_job_columns(*columns),
+                    TEST_DATA['test_names'])
+                expected_summary, expected_tests = gen_html.job_results(
+                    bucket, '', job, TEST_DATA['buckets'][bucket][job],
+                    TEST_DATA['test_names'])
+                self.assertEqual(summary, expected_summary)
+                # Durations are stored with single precision.
+                for test, expected in zip(tests, expected_tests):
+                    self.assertAlmostEqual(test.pop('duration'),
+                                           expected.pop('duration'), places=4)
+                self.assertEqual(tests, expected_tests)
+            reader.close()
+        finally:
+            shutil.rmtree(temp_dir)
+
     def test_list_jobs(self):
         """Test that list_jobs gives job data of the right length."""
         expecteds = [
@@ -116,33 +144,66 @@ class GenHtmlTest(unittest.TestCase):
             self.assertEqual(expected[1], actual[1])
             self.assertEqual(expected[2], len(actual[2]))
 
-    def test_merge_bad_tests(self):
-        """Test that merge_bad_tests merges failed tests."""
-        def check(bad, new, expected):
-            gen_html.merge_bad_tests(bad, new)
-            self.assertEqual(bad, expected)
-
-        check({}, [], {})
-        check({}, [{'failed': 0}], {})
-        failed_test = {
-            'failed': 1,
-            'name': 'failed_test',
-            'runs': 1,
-            'passed': 0,
-            'latest_failure': None,
-        }
-        check({}, [failed_test], {'failed_test': failed_test})
-        check({'failed_test': failed_test}, [failed_test], {
-            'failed_test': {
-                'failed': 2,
-                'name': 'failed_test',
-                'runs': 2,
+    def build_index(self):
+        index = inverted_index.TestIndex()
+        for bucket, job, job_data in sorted(gen_html.list_jobs(TEST_DATA)):
+            columns = gen_html.job_columns(job_data)
+            prefix = TEST_BUCKETS_DATA[bucket]['prefix']
+            index.add_job((bucket, prefix, job, columns.builds), columns.ids,
+                          columns.positions, columns.failed, columns.ran)
+        index.build()
+        return index
+
+    def test_test_jobs(self):
+        """Test that test_jobs summarizes a test in every job it ran in."""
+        index = self.build_index()
+        self.assertEqual(index.failing_tests(), [1])
+        self.assertEqual(gen_html.test_jobs(index, 1, 'test2'), [
+            {
+                'job': 'kubernetes-debug',
+                'runs': 1,
                 'passed': 0,
-                'latest_failure': None,
-            }
+                'failed': 1,
+                'latest_failure': gen_html.gubernator_url(
+                    'gs://kubernetes-jenkins/logs/', 'kubernetes-debug', '6',
+                    'test2'),
+            },
+            {
+                'job': 'kubernetes-release',
+                'runs': 1,
+                'passed': 0,
+                'failed': 1,
+                'latest_failure': gen_html.gubernator_url(
+                    'gs://kubernetes-jenkins/logs/', 'kubernetes-release', '4',
+                    'test2'),
+            },
+        ])
+        # The skipped run in rktnetes$kubernetes-release isn't counted.
+        jobs = gen_html.test_jobs(index, 0, 'test1')
+        self.assertEqual([(j['job'], j['runs'], j['failed']) for j in jobs], [
+            ('kubernetes-debug', 2, 0), ('kubernetes-release', 1, 0)])
+
+    def test_blocking_failures(self):
+        """Test that blocking_failures sums failures in blocking jobs."""
+        def job(name, runs, failed):
+            return {'job': name, 'runs': runs, 'passed': runs - failed,
+                    'failed': failed, 'latest_failure': name + '-url'}
+
+        self.assertIsNone(gen_html.blocking_failures('t', []))
+        self.assertIsNone(gen_html.blocking_failures('t', [
+            job('kubernetes-e2e-gce', 5, 0), job('some-job', 2, 2)]))
+        self.assertEqual(gen_html.blocking_failures('t', [
+            job('kubernetes-e2e-gce', 5, 3),
+            job('kubernetes-e2e-gke', 4, 1),
+            job('kubernetes-build', 5, 0),
+            job('some-job', 2, 2),
+        ]), {
+            'name': 't',
+            'runs': 9,
+            'passed': 5,
+            'failed': 4,
+            'latest_failure': 'kubernetes-e2e-gce-url',
         })
-        check({'failed_test2': failed_test}, [failed_test], {
-            'failed_test2': failed_test, 'failed_test': failed_test})
 
     def test_get_options(self):
         """Test argument parsing works correctly."""
@@ -194,20 +255,86 @@ class GenHtmlTest(unittest.TestCase):
 
     def test_main(self):
         """Test main() creates pages."""
+        self.check_main(lambda path: json.dump(TEST_DATA, open(path, 'w')))
+
+    def test_main_columnar(self):
+        """Test main() reads columnar input."""
+        self.check_main(lambda path: columnar.write(path, TEST_DATA))
+
+    def check_main(self, write_tests, processes=1):
         temp_dir = tempfile.mkdtemp(prefix='kube-test-hist-')
         try:
             tests_json = os.path.join(temp_dir, 'tests.json')
-            with open(tests_json, 'w') as buf:
-                json.dump(TEST_DATA, buf)
+            write_tests(tests_json)
             buckets_yaml = os.path.join(temp_dir, 'buckets.yaml')
             with open(buckets_yaml, 'w') as buf:
                 yaml.dump(TEST_BUCKETS_DATA, buf)
-            gen_html.main(tests_json, buckets_yaml, temp_dir)
+            gen_html.main(tests_json, buckets_yaml, temp_dir, processes)
             for page in (
                     'index',
                     'suite-kubernetes-release',
                     'suite-kubernetes-debug'):
                 self.assertTrue(os.path.exists('%s/%s.html' % (temp_dir, page)))
+            test_page = '%s/%s' % (temp_dir, gen_html.test_page('test2'))
+            self.assertIn('suite-kubernetes-debug.html', open(test_page).read())
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_main_rollups(self):
+        """Test main() shows failures over longer windows."""
+        temp_dir = tempfile.mkdtemp(prefix='kube-test-hist-')
+        try:
+            rollups_path = os.path.join(temp_dir, 'rollups.db')
+            rollups = rollup.RollupStore(rollups_path)
+            rollups.add_build('gs://kubernetes-jenkins/logs/', 'kubernetes-debug',
+                              '1', time.time() - 3 * rollup.DAY,
+                              [('test1', 1.0, True, False)] * 3)
+            rollups.close()
+            tests_json = os.path.join(temp_dir, 'tests.json')
+            with open(tests_json, 'w') as buf:
+                json.dump(TEST_DATA, buf)
+            buckets_yaml = os.path.join(temp_dir, 'buckets.yaml')
+            with open(buckets_yaml, 'w') as buf:
+                yaml.dump(TEST_BUCKETS_DATA, buf)
+            gen_html.main(tests_json, buckets_yaml, temp_dir,
+                          rollups_path=rollups_path)
+            page = open('%s/suite-kubernetes-debug.html' % temp_dir).read()
+            self.assertIn('Failed Today (UTC)', page)
+            self.assertIn('Failed in 30 Days (UTC)', page)
+            self.assertIn('3/3', page)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_main_processes(self):
+        """Test main() renders pages in a process pool."""
+        self.check_main(lambda path: json.dump(TEST_DATA, open(path, 'w')), 2)
+
+    def test_main_unchanged(self):
+        """Test main() only rewrites pages that changed."""
+        temp_dir = tempfile.mkdtemp(prefix='kube-test-hist-')
+        try:
+            tests_json = os.path.join(temp_dir, 'tests.json')
+            buckets_yaml = os.path.join(temp_dir, 'buckets.yaml')
+            with open(buckets_yaml, 'w') as buf:
+                yaml.dump(TEST_BUCKETS_DATA, buf)
+            release = '%s/suite-kubernetes-release.html' % temp_dir
+            debug = '%s/suite-kubernetes-debug.html' % temp_dir
+
+            with open(tests_json, 'w') as buf:
+                json.dump(TEST_DATA, buf)
+            gen_html.main(tests_json, buckets_yaml, temp_dir)
+            for path in (release, debug):
+                with open(path, 'w') as buf:
+                    buf.write('unchanged')
+
+            data = json.loads(json.dumps(TEST_DATA))
+            data['buckets']['gs://kubernetes-jenkins/logs/']['kubernetes-debug'][
+                '7'] = {'tests': [{'name': 0, 'time': 1.0}]}
+            with open(tests_json, 'w') as buf:
+                json.dump(data, buf)
+            gen_html.main(tests_json, buckets_yaml, temp_dir)
+            self.assertEqual(open(release).read(), 'unchanged')
+            self.assertNotEqual(open(debug).read(), 'unchanged')
         finally:
             shutil.rmtree(temp_dir)
 
@@ -22,52 +22,167 @@ Writes the JSON out to tests.json.
 from __future__ import print_function
 
 import argparse
+import calendar
+import collections
+import itertools
 import json
 import logging
 import os
 import re
+import Queue
 import random
-import signal
 import sys
+import threading
 import time
 import urllib2
 from xml.etree import ElementTree
 
-import multiprocessing
+from multiprocessing.pool import ThreadPool
 import requests
+import requests.adapters
 import yaml
 
+import build_store
+import columnar
+import response_cache
+import rollup
+import stream_json
+
 
 MAX_AGE = 60 * 60 * 24  # 1 day
 
 
-class GCSClient(object):
+class ConcurrencyLimiter(object):
+    """
+    Limits how many requests are in flight, adapting to GCS's throttling.
+
+    The limit is halved whenever a request is throttled (a 429, 5xx or
+    connection error), and grows back by one for about every limit's worth
+    of requests that succeed.
+
+    Counts retries, and the seconds requests spent backing off before
+    retrying. Waiting for the limit isn't counted, since requests wait
+    for a free slot whenever the limit is full, throttled or not.
+    """
+    # Halve the limit at most once this many seconds, so the requests that
+    # were in flight when GCS started throttling only count once.
+    DECREASE_INTERVAL = 1.0
+
+    def __init__(self, limit):
+        self.max_limit = limit
+        self.limit = float(limit)
+        self.in_flight = 0
+        self.last_decrease = 0
+        self.retries = 0
+        self.throttled = 0.0
+        self.cond = threading.Condition()
+
+    def __enter__(self):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+
+    def __exit__(self, *exc):
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify_all()
+
+    def succeed(self):
+        """Records a successful request."""
+        with self.cond:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def throttle(self, retry):
+        """Records a throttled request, returning how long to wait to retry."""
+        with self.cond:
+            self.retries += 1
+            now = time.time()
+            if now - self.last_decrease > self.DECREASE_INTERVAL:
+                self.limit = max(1.0, self.limit / 2)
+                self.last_decrease = now
+            delay = random.random() * min(60, 2 ** retry)
+            self.throttled += delay
+        return delay
+
 
-    def __init__(self, jobs_dir, metadata=None):
+class GCSClient(object):
+    # How many finish times to fetch concurrently when finding daily builds.
+    FETCH_THREADS = 10
+    # When listing finish times, builds whose finished.json was uploaded
+    # within this many seconds of the cutoff have it read to be sure.
+    LISTING_SLACK = 60 * 60
+
+    def __init__(self, jobs_dir, metadata=None, connections=10, cache=None,
+                 limiter=None):
         self.jobs_dir = jobs_dir
         self.metadata = metadata or {}
+        # The session is shared by every fetching thread, so keep enough
+        # connections open that they don't have to reconnect per request.
         self.session = requests.Session()
-
-    def request(self, path, params, as_json=True):
+        self.session.mount('https://', requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=connections))
+        # A ResponseCache for object downloads, or None.
+        self.cache = cache
+        # Clients for different buckets can share a limiter, since they
+        # share GCS's rate limits.
+        self.limiter = limiter or ConcurrencyLimiter(connections)
+
+    def request(self, path, params, as_json=True, immutable=False):
         """GETs a JSON resource from GCS, with retries on failure.
 
         Retries are based on guidance from
         cloud.google.com/storage/docs/gsutil/addlhelp/RetryHandlingStrategy
+        and are paced by the client's ConcurrencyLimiter, which also backs
+        off the number of requests in flight.
+
+        If there's a cache, object downloads are kept in it, and revalidated
+        with conditional requests unless they're immutable.
         """
         url = 'https://www.googleapis.com/storage/v1/b/%s' % path
+        cached = None
+        if self.cache and params.get('alt') == 'media':
+            cached = self.cache.get(url)
+            if cached and cached.immutable:
+                return self._decode(cached.body, as_json)
+        headers = {}
+        if cached:
+            params = dict(params)
+            if cached.etag:
+                headers['If-None-Match'] = cached.etag
+            if cached.generation:
+                params['ifGenerationNotMatch'] = cached.generation
         for retry in xrange(23):
             try:
-                resp = self.session.get(url, params=params, stream=False)
-                if 400 <= resp.status_code < 500 and resp.status_code != 429:
+                with self.limiter:
+                    resp = self.session.get(url, params=params,
+                                            headers=headers, stream=False)
+                if resp.status_code == 429 or resp.status_code >= 500:
+                    time.sleep(self.limiter.throttle(retry))
+                    continue
+                self.limiter.succeed()
+                if resp.status_code == 304 and cached:
+                    if immutable:
+                        self.cache.put(url, cached._replace(immutable=True))
+                    return self._decode(cached.body, as_json)
+                if 400 <= resp.status_code < 500:
                     return None
-                resp.raise_for_status()
-                if as_json:
-                    return resp.json()
-                else:
-                    return resp.content
+                if self.cache and params.get('alt') == 'media':
+                    self.cache.put(url, response_cache.Entry(
+                        resp.headers.get('ETag'),
+                        resp.headers.get('x-goog-generation'),
+                        resp.headers.get('x-goog-metageneration'),
+                        immutable, resp.content))
+                return self._decode(resp.content, as_json)
             except requests.exceptions.RequestException:
                 logging.exception('request failed %s', url)
-            time.sleep(random.random() * min(60, 2 ** retry))
+                time.sleep(self.limiter.throttle(retry))
+
+    @staticmethod
+    def _decode(content, as_json):
+        if as_json:
+            return json.loads(content)
+        return content
 
     def parse_uri(self, path):
         if not path.startswith('gs://'):
@@ -75,11 +190,26 @@ class GCSClient(object):
         bucket, prefix = path[5:].split('/', 1)
         return bucket, prefix
 
-    def get(self, path, as_json=False):
-        """Get an object from GCS."""
+    def get(self, path, as_json=False, immutable=False):
+        """Get an object from GCS.
+
+        Objects that won't change, like a finished build's artifacts, should
+        be marked immutable, so a cached copy is used without asking GCS.
+        """
         bucket, path = self.parse_uri(path)
         return self.request('%s/o/%s' % (bucket, urllib2.quote(path, '')),
-                           {'alt': 'media'}, as_json=as_json)
+                           {'alt': 'media'}, as_json=as_json,
+                           immutable=immutable)
+
+    def _list(self, bucket, params):
+        """Generates the pages of an object listing."""
+        params = dict(params)
+        while True:
+            resp = self.request('%s/o' % bucket, params)
+            yield resp
+            if 'nextPageToken' not in resp:
+                break
+            params['pageToken'] = resp['nextPageToken']
 
     def ls(self, path, dirs=True, files=True):
         """Lists objects under a path on gcs."""
@@ -89,33 +219,47 @@ class GCSClient(object):
             params['fields'] += ',prefixes'
         if files:
             params['fields'] += ',items(name)'
-        while True:
-            resp = self.request('%s/o' % bucket, params)
+        for resp in self._list(bucket, params):
             for prefix in resp.get('prefixes', []):
                 yield 'gs://%s/%s' % (bucket, prefix)
             for item in resp.get('items', []):
                 yield 'gs://%s/%s' % (bucket, item['name'])
-            if 'nextPageToken' not in resp:
-                break
-            params['pageToken'] = resp['nextPageToken']
+
+    def ls_metadata(self, path, glob, fields):
+        """Generates metadata for objects under a path matching a glob.
+
+        Args:
+            path: the GCS path to list recursively.
+            glob: a pattern for object names, relative to path.
+            fields: the metadata to get, like 'name,updated'.
+        Yields:
+            dicts of each object's metadata, as returned by GCS.
+        """
+        bucket, path = self.parse_uri(path)
+        params = {'prefix': path, 'matchGlob': path + glob,
+                  'fields': 'nextPageToken,items(%s)' % fields}
+        for resp in self._list(bucket, params):
+            for item in resp.get('items', []):
+                yield item
 
     def ls_dirs(self, path):
         return self.ls(path, dirs=True, files=False)
 
-    def _ls_junit_paths(self, job, build):
+    def ls_junit_paths(self, job, build):
         """Lists the paths of JUnit XML files for a build."""
         url = '%s%s/%s/artifacts/' % (self.jobs_dir, job, build)
         for path in self.ls(url):
             if re.match(r'.*/junit.*\.xml$', path):
                 yield path
 
-    def _get_tests_from_junit(self, path):
+    def get_tests_from_junit(self, path):
         """Generates test data out of the provided JUnit path.
 
         Returns None if there's an issue parsing the XML.
         Yields name, time, failed, skipped for each test.
         """
-        data = self.get(path)
+        # Only finished builds are read, so their results won't change.
+        data = self.get(path, immutable=True)
 
         try:
             root = ElementTree.fromstring(data)
@@ -140,50 +284,159 @@ class GCSClient(object):
         for job_path in self.ls_dirs(self.jobs_dir):
             yield os.path.basename(os.path.dirname(job_path))
 
-    def _get_builds(self, job):
-        if self.metadata.get('sequential', True):
-            try:
-                latest_build = int(self.get('%s%s/latest-build.txt'
-                                            % (self.jobs_dir, job)))
-            except (ValueError, TypeError):
-                pass
-            else:
-                return (str(n) for n in xrange(latest_build, 0, -1))
-        # Invalid latest-build or bucket is using timestamps
+    def _get_latest_build(self, job):
+        """Returns the build number in a sequential job's latest-build.txt."""
+        if not self.metadata.get('sequential', True):
+            return None
+        try:
+            return int(self.get('%s%s/latest-build.txt' % (self.jobs_dir, job)))
+        except (ValueError, TypeError):
+            return None
+
+    def _list_builds(self, job):
         build_paths = self.ls_dirs('%s%s/' % (self.jobs_dir, job))
         return sorted((os.path.basename(os.path.dirname(b))
                        for b in build_paths), key=int, reverse=True)
 
+    def _get_builds(self, job):
+        latest_build = self._get_latest_build(job)
+        if latest_build is not None:
+            return (str(n) for n in xrange(latest_build, 0, -1))
+        # Invalid latest-build or bucket is using timestamps
+        return self._list_builds(job)
+
     def _get_build_finish_time(self, job, build):
         data = self.get('%s%s/%s/finished.json' % (self.jobs_dir, job, build),
-                        as_json=True)
+                        as_json=True, immutable=True)
         if data is None:
             return None
         return int(data['timestamp'])
 
-    def get_daily_builds(self, matcher, builds_have):
-        """Generates all (job, build) pairs for the last day."""
-        now = time.time()
-        for job in self._get_jobs():
-            if not matcher(job):
+    def _walk_daily_builds(self, job, builds, builds_have, min_timestamp):
+        """Generates (build, timestamp) pairs, newest first, until one is old."""
+        for build in builds:
+            if (job, build) in builds_have:
+                # assumption: we're only getting builds NEWER than those
+                # in builds_have.
+                break
+            timestamp = self._get_build_finish_time(job, build)
+            if timestamp is None:
                 continue
-            for build in self._get_builds(job):
-                if (job, build) in builds_have:
-                    # assumption: we're only getting builds NEWER than those
-                    # in builds_have.
-                    break
-                timestamp = self._get_build_finish_time(job, build)
-                if timestamp is None:
+            # Quit once we've walked back over a day.
+            if timestamp < min_timestamp:
+                break
+            yield build, timestamp
+
+    def _search_daily_builds(self, job, latest, oldest_have, min_timestamp,
+                             pool):
+        """Generates (build, timestamp) pairs for a sequential job, newest first.
+
+        Rather than walking back one build at a time, this gallops back from
+        the latest build to bracket the oldest build finished after
+        min_timestamp, binary searches for it, and then fetches the finish
+        times of the builds after it concurrently.
+
+        Builds without a finish time are treated as recent while searching,
+        since they may still be running.
+        """
+        timestamps = {}
+
+        def is_recent(build):
+            if build not in timestamps:
+                timestamps[build] = self._get_build_finish_time(job, str(build))
+            return timestamps[build] is None or timestamps[build] >= min_timestamp
+
+        # Builds <= old are too old (or already collected), builds >= recent
+        # are recent.
+        old, recent = oldest_have, latest + 1
+        build, step = latest, 1
+        while build > old:
+            if not is_recent(build):
+                old = build
+                break
+            recent = build
+            build -= step
+            step *= 2
+        while recent - old > 1:
+            build = (old + recent) // 2
+            if is_recent(build):
+                recent = build
+            else:
+                old = build
+
+        builds = xrange(latest, recent - 1, -1)
+        missing = [build for build in builds if build not in timestamps]
+        for build, timestamp in zip(missing, pool.map(
+                lambda build: self._get_build_finish_time(job, str(build)),
+                missing)):
+            timestamps[build] = timestamp
+        for build in builds:
+            timestamp = timestamps[build]
+            if timestamp is not None and timestamp >= min_timestamp:
+                yield str(build), timestamp
+
+    def _find_daily_builds(self, job, builds_have, newest_have, min_timestamp,
+                           pool):
+        """Generates (build, timestamp) pairs by fetching finished.json files."""
+        latest_build = self._get_latest_build(job)
+        if latest_build is None:
+            return self._walk_daily_builds(
+                job, self._list_builds(job), builds_have, min_timestamp)
+        return self._search_daily_builds(
+            job, latest_build, newest_have, min_timestamp, pool)
+
+    def _list_daily_builds(self, job, newest_have, min_timestamp, pool):
+        """Generates (build, timestamp) pairs from one listing, newest first.
+
+        Rather than fetching each build's finished.json, this lists them all
+        and uses their upload times as the builds' timestamps. Only the
+        builds uploaded near min_timestamp have their finished.json read.
+        """
+        uploads = {}
+        for item in self.ls_metadata('%s%s/' % (self.jobs_dir, job),
+                                     '*/finished.json', 'name,timeCreated'):
+            build = item['name'].split('/')[-2]
+            if int(build) > newest_have:
+                uploads[build] = calendar.timegm(time.strptime(
+                    item['timeCreated'][:19], '%Y-%m-%dT%H:%M:%S'))
+        builds = sorted(uploads, key=int, reverse=True)
+        boundary = [build for build in builds
+                    if abs(uploads[build] - min_timestamp) < self.LISTING_SLACK]
+        timestamps = dict(uploads)
+        timestamps.update(zip(boundary, pool.map(
+            lambda build: self._get_build_finish_time(job, build), boundary)))
+        for build in builds:
+            timestamp = timestamps[build]
+            if timestamp is not None and timestamp >= min_timestamp:
+                yield build, timestamp
+
+    def get_daily_builds(self, matcher, builds_have):
+        """Generates all (job, build, timestamp) tuples for the last day."""
+        min_timestamp = time.time() - MAX_AGE
+        newest_have = {}
+        for job, build in builds_have:
+            newest_have[job] = max(newest_have.get(job, 0), int(build))
+        pool = ThreadPool(self.FETCH_THREADS)
+        try:
+            for job in self._get_jobs():
+                if not matcher(job):
                     continue
-                # Quit once we've walked back over a day.
-                if now - timestamp > MAX_AGE:
-                    break
-                yield job, build, timestamp
+                if self.metadata.get('list_finished'):
+                    builds = self._list_daily_builds(
+                        job, newest_have.get(job, 0), min_timestamp, pool)
+                else:
+                    builds = self._find_daily_builds(
+                        job, builds_have, newest_have.get(job, 0),
+                        min_timestamp, pool)
+                for build, timestamp in builds:
+                    yield job, build, timestamp
+        finally:
+            pool.close()
 
     def get_tests_from_build(self, job, build):
         """Generates all tests for a build."""
-        for junit_path in self._ls_junit_paths(job, build):
-            for test in self._get_tests_from_junit(junit_path):
+        for junit_path in self.ls_junit_paths(job, build):
+            for test in self.get_tests_from_junit(junit_path):
                 yield test
 
 
@@ -210,76 +463,155 @@ class IndexedList(list):
         return self._index[value]
 
 
-def mp_init_worker(jobs_dir, metadata, client_class):
+class FetchEngine(object):
     """
-    Initialize the environment for multiprocessing-based multithreading.
+    Runs I/O-bound calls on a pool of threads.
+
+    Calls are submitted from a single thread, which then iterates over
+    results() to collect them as they finish, and may submit follow-up
+    calls while doing so. With fewer than two threads, calls run inline
+    when submitted, which is easier to debug.
     """
-    # Multiprocessing doesn't allow local variables for each worker, so we need
-    # to make a GCSClient global variable.
-    global WORKER_CLIENT
-    WORKER_CLIENT = client_class(jobs_dir, metadata)
-    signal.signal(signal.SIGINT, signal.SIG_IGN)  # make Ctrl-C kill the worker
 
+    # Marks the end of a stream() in the results queue.
+    STREAM_END = object()
+
+    def __init__(self, threads):
+        self.pending = 0
+        self.tasks = Queue.Queue()
+        self.done = Queue.Queue()
+        self.workers = []
+        if threads > 1:
+            for _ in xrange(threads):
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True  # make Ctrl-C kill the workers
+                worker.start()
+                self.workers.append(worker)
+
+    def _run(self, func, args):
+        try:
+            self.done.put((func, args, func(*args), None, True))
+        except Exception as e:  # pylint: disable=broad-except
+            logging.exception('%s%r failed', func.__name__, args)
+            self.done.put((func, args, None, e, True))
 
-def mp_get_tests((job, build, timestamp)):
-    """
-    Inside a multiprocessing worker, get the tests for a given job and build.
-    """
-    try:
-        return job, build, timestamp, list(
-            WORKER_CLIENT.get_tests_from_build(job, build))
-    except:
-        logging.exception('failed to get tests for %s/%s', job, build)
-        raise
+    def _run_stream(self, func, args):
+        try:
+            for item in func(*args):
+                self.done.put((func, args, item, None, False))
+            self.done.put((func, args, self.STREAM_END, None, True))
+        except Exception as e:  # pylint: disable=broad-except
+            logging.exception('%s%r failed', func.__name__, args)
+            self.done.put((func, args, None, e, True))
+
+    def _work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            self._run(*task)
+
+    def submit(self, func, *args):
+        """Schedules func(*args). Its result is returned by results()."""
+        self.pending += 1
+        if self.workers:
+            self.tasks.put((func, args))
+        else:
+            self._run(func, args)
 
+    def stream(self, func, *args):
+        """
+        Iterates over func(*args) on a thread of its own.
+
+        Each item is returned by results() as soon as it's generated, so
+        long-running generators, like build discovery, don't hold up the
+        pool.
+        """
+        self.pending += 1
+        if self.workers:
+            thread = threading.Thread(target=self._run_stream,
+                                      args=(func, args))
+            thread.daemon = True
+            thread.start()
+        else:
+            self._run_stream(func, args)
+
+    def results(self, wait=True):
+        """
+        Generates (func, args, result) for submitted calls as they finish,
+        and for the items of streams as they're generated.
+
+        Stops once no calls are pending, or, if wait is False, once none of
+        them have finished. Errors are reraised here.
+        """
+        while self.pending:
+            # A timeout keeps the wait interruptible by Ctrl-C.
+            try:
+                func, args, result, error, finished = self.done.get(
+                    wait, timeout=1)
+            except Queue.Empty:
+                if not wait:
+                    return
+                continue
+            if finished:
+                self.pending -= 1
+            if error is not None:
+                raise error
+            if result is not self.STREAM_END:
+                yield func, args, result
 
-def get_existing_builds(jobs):
-    out = set()
-    for job_name, job in jobs.iteritems():
-        for build_num in job.iterkeys():
-            out.add((job_name, build_num))
-    return out
+    def close(self):
+        """Stops the worker threads once they finish their current calls."""
+        for _ in self.workers:
+            self.tasks.put(None)
 
 
-def get_tests(names, jobs_dir, metadata, matcher, threads, client_class, jobs):
+def get_tests(names, buckets, matcher, threads, client_class, builds_have,
+              store=None, cache=None, bucket_done=None, rollups=None):
     """
-    Adds information about tests to a dictionary.
+    Collects the tests of recent builds from every bucket at once.
+
+    Each bucket's jobs and builds are discovered on a thread of its own, and
+    their results are all fetched from one shared pool, so slow buckets
+    don't hold up the others.
 
     Args:
         names: an IndexedList of test names.
-        jobs_dir: the GCS path containing jobs.
-        metadata: a dict of metadata about the jobs_dir.
+        buckets: a dict of {jobs_dir: metadata}, for each GCS path
+            containing jobs.
         matcher: a function str->bool that determines whether to include a job.
-        threads: how many threads to use to download build information.
+        threads: how many requests to have in flight at once.
         client_class: a constructor for a GCSClient (or a subclass).
-        jobs: a dictionary to place new test information into. Builds already
-            present in this dictionary will be skipped.
+        builds_have: a dict of {jobs_dir: set of (job, build)} to skip.
+        store: if set, a BuildStore to save each build into as it's fetched.
+            Builds that aren't newer than the store's cursors will be skipped
+            instead of those in builds_have.
+        cache: if set, a ResponseCache to keep downloaded objects in.
+        bucket_done: if set, called with (jobs_dir, jobs) as soon as every
+            build of a bucket has been collected.
+        rollups: if set, a RollupStore to count each build into.
     Returns:
-        jobs is modified to contain the new test information.
+        {jobs_dir: {job: {build: {'timestamp': int, 'tests': [...]}}}} for
+        the new builds.
     """
-    gcs = client_class(jobs_dir, metadata)
-
-    print('Loading builds from %s' % jobs_dir)
-
-    builds_have = get_existing_builds(jobs)
-    if builds_have:
-        print('already have %d builds' % len(builds_have))
-
-    jobs_and_builds = gcs.get_daily_builds(matcher, builds_have)
-    if threads > 1:
-        pool = multiprocessing.Pool(threads, mp_init_worker,
-                                    (jobs_dir, metadata, client_class))
-        builds_tests_iterator = pool.imap_unordered(
-            mp_get_tests, jobs_and_builds)
-    else:
-        # for debugging, have a single-threaded mode without multiprocessing
-        builds_tests_iterator = (
-            (job, build, timestamp, gcs.get_tests_from_build(job, build))
-            for job, build, timestamp in jobs_and_builds)
-
-    for job, build, timestamp, build_tests in builds_tests_iterator:
-        print('%s/%s' % (job, build))
-        build_info = jobs.setdefault(job, {}).setdefault(build, {})
+    clients = {}
+    new_builds = {}
+    limiter = ConcurrencyLimiter(max(threads, 1))
+    for jobs_dir, metadata in buckets.iteritems():
+        clients[jobs_dir] = client_class(
+            jobs_dir, metadata, connections=max(threads, 1), cache=cache,
+            limiter=limiter)
+        new_builds[jobs_dir] = {}
+
+    def add_build(jobs_dir, job, build, timestamp, build_tests):
+        print('%s%s/%s' % (jobs_dir, job, build))
+        if store:
+            store.add_build(jobs_dir, job, build, timestamp, build_tests)
+            store.commit()
+        if rollups:
+            rollups.add_build(jobs_dir, job, build, timestamp, build_tests)
+            rollups.commit()
+        build_info = new_builds[jobs_dir].setdefault(job, {}).setdefault(build, {})
         build_info['timestamp'] = timestamp
         build_info['tests'] = []
         for name, duration, failed, skipped in build_tests:
@@ -293,46 +625,198 @@ def get_tests(names, jobs_dir, metadata, matcher, threads, client_class, jobs):
                 result['skipped'] = True
             build_info['tests'].append(result)
 
-
-def remove_old_builds(buckets, now):
+    if store:
+        # The store can only be used from this thread.
+        builds_have = {jobs_dir: store.get_cursors(jobs_dir)
+                       for jobs_dir in buckets}
+
+    def find_builds(jobs_dir):
+        have = builds_have.get(jobs_dir, set())
+        if have:
+            print('already have %d builds in %s' % (len(have), jobs_dir))
+        for found in clients[jobs_dir].get_daily_builds(matcher, have):
+            yield found
+        yield None  # marks the end of the bucket's builds
+
+    def list_junit(jobs_dir, job, build):
+        return list(clients[jobs_dir].ls_junit_paths(job, build))
+
+    def get_junit(jobs_dir, path):
+        return list(clients[jobs_dir].get_tests_from_junit(path))
+
+    # Every build's artifacts are listed, then all of its junit files are
+    # fetched at once. A build is complete once each file has returned.
+    # {(jobs_dir, job, build): [timestamp, junit paths, {path: tests}]}
+    fetching = {}
+    # {path: (jobs_dir, job, build)}
+    junit_builds = {}
+    # A bucket is done once its builds are found and none are left fetching.
+    finding = set(buckets)
+    unfinished = collections.Counter()
+
+    def check_done(jobs_dir):
+        if jobs_dir not in finding and not unfinished[jobs_dir]:
+            if bucket_done:
+                bucket_done(jobs_dir, new_builds[jobs_dir])
+
+    def handle(func, args, result):
+        if func is find_builds:
+            jobs_dir, = args
+            if result is None:
+                finding.remove(jobs_dir)
+                check_done(jobs_dir)
+                return
+            job, build, timestamp = result
+            fetching[jobs_dir, job, build] = [timestamp, None, {}]
+            unfinished[jobs_dir] += 1
+            engine.submit(list_junit, jobs_dir, job, build)
+            return
+        if func is list_junit:
+            key = args
+            fetching[key][1] = result
+            for path in result:
+                junit_builds[path] = key
+                engine.submit(get_junit, key[0], path)
+        else:
+            _, path = args
+            key = junit_builds.pop(path)
+            fetching[key][2][path] = result
+        timestamp, paths, results = fetching[key]
+        if paths is not None and len(results) == len(paths):
+            del fetching[key]
+            add_build(key[0], key[1], key[2], timestamp,
+                      [test for path in paths for test in results[path]])
+            unfinished[key[0]] -= 1
+            check_done(key[0])
+
+    engine = FetchEngine(threads)
+    try:
+        for jobs_dir in sorted(buckets):
+            engine.stream(find_builds, jobs_dir)
+        for finished in engine.results():
+            handle(*finished)
+    finally:
+        engine.close()
+    print('%d requests retried, %.1fs spent backing off' % (
+        limiter.retries, limiter.throttled))
+    return new_builds
+
+
+def remove_old_builds(job, now):
+    """Deletes a job's builds older than MAX_AGE, returning how many there were."""
     pruned = 0
-    for jobs in buckets.itervalues():
-        for job_name, job in jobs.iteritems():
-            for build_num, build in job.items():  # intentional copy
-                if build['timestamp'] < now - MAX_AGE:
-                    pruned += 1
-                    job.pop(build_num)
-    print('pruned %d old builds' % pruned)
+    for build_num, build in job.items():  # intentional copy
+        if build['timestamp'] < now - MAX_AGE:
+            pruned += 1
+            job.pop(build_num)
+    return pruned
 
 
-def main(jobs_dirs, match, outfile, threads, client_class=GCSClient):
+def main(jobs_dirs, match, outfile, threads, client_class=GCSClient,
+         store_path=None, fmt='json', cache_path=None, cache_size=512,
+         rollups_path=None):
     """Collect test info in matching jobs."""
     print('Finding tests in jobs matching %s' % match)
     matcher = re.compile(match).match
-    tests = None
-    if os.path.exists(outfile):
+    cache = None
+    if cache_path:
+        cache = response_cache.ResponseCache(cache_path, cache_size << 20)
+    rollups = None
+    if rollups_path:
+        rollups = rollup.RollupStore(rollups_path)
+        rollups.remove_old_days(time.time())
+    names = IndexedList()
+    reader = None
+    store = None
+    if store_path:
+        # The store replaces resuming from outfile: it's regenerated in full.
+        store = build_store.BuildStore(store_path)
+        pruned = store.remove_old_builds(time.time() - MAX_AGE)
+        print('pruned %d old builds from %s' % (pruned, store_path))
+    elif os.path.exists(outfile):
         try:
-            tests = json.load(open(outfile))
-            if 'test_names' not in tests:
-                raise ValueError
+            reader = columnar.open_reader(outfile)
         except ValueError:
-            tests = None
+            pass
         else:
             print('Resuming from previous run...')
-            names = IndexedList(tests['test_names'])
-            tests['test_names'] = names
-            remove_old_builds(tests['buckets'], time.time())
-    if tests is None:
-        names = IndexedList()
-        tests = {'test_names': names, 'buckets': {}}
+            names = IndexedList(reader.test_names)
+
+    bucket_metadata = {}
     for bucket, metadata in jobs_dirs.iteritems():
         if not bucket.endswith('/'):
             bucket += '/'
-        bucket_jobs = tests['buckets'].setdefault(bucket, {})
-        get_tests(names, bucket, metadata, matcher, threads, client_class,
-                  bucket_jobs)
-    with open(outfile, 'w') as buf:
-        json.dump(tests, buf, sort_keys=True)
+        bucket_metadata[bucket] = metadata
+
+    # The previous output is streamed rather than loaded in full: once to
+    # find which builds it has, and again to write them out.
+    builds_have = {}
+    if reader:
+        now = time.time()
+        for bucket, job, builds in reader.list_jobs():
+            remove_old_builds(builds, now)
+            builds_have.setdefault(bucket, set()).update(
+                (job, build) for build in builds)
+
+    # Both the previous run's jobs and the buckets are in sorted order, so
+    # each bucket can be merged and written out once it and the ones before
+    # it are collected.
+    old_buckets = itertools.groupby(reader.list_jobs() if reader else [],
+                                    key=lambda job: job[0])
+    old_bucket = [next(old_buckets, None)]
+    pruned = [0]
+
+    def read_old_bucket(before=None):
+        """Returns the jobs of the next old bucket, if it's before a bucket."""
+        if not old_bucket[0] or (before and old_bucket[0][0] > before):
+            return None, {}
+        bucket, group = old_bucket[0]
+        jobs = {}
+        for _, job, builds in group:
+            pruned[0] += remove_old_builds(builds, time.time())
+            jobs[job] = builds
+        old_bucket[0] = next(old_buckets, None)
+        return bucket, jobs
+
+    tmpfile = outfile + '.tmp'
+    if fmt == 'columnar':
+        writer = columnar.Writer(tmpfile)
+    else:
+        writer = stream_json.Writer(tmpfile)
+    unwritten = sorted(bucket_metadata)
+    collected = {}
+
+    def bucket_done(bucket, new_jobs):
+        collected[bucket] = new_jobs
+        while unwritten and unwritten[0] in collected:
+            bucket = unwritten.pop(0)
+            new_jobs = collected.pop(bucket)
+            while True:
+                old_name, jobs = read_old_bucket(before=bucket)
+                if old_name is None or old_name == bucket:
+                    break
+                writer.write_bucket(old_name, jobs)
+            if store:
+                jobs = store.get_jobs(bucket, names)
+            for job, builds in new_jobs.iteritems():
+                jobs.setdefault(job, {}).update(builds)
+            writer.write_bucket(bucket, jobs)
+
+    get_tests(names, bucket_metadata, matcher, threads, client_class,
+              builds_have, store, cache, bucket_done, rollups)
+    while old_bucket[0]:
+        writer.write_bucket(*read_old_bucket())
+    writer.close(names)
+    if pruned[0]:
+        print('pruned %d old builds' % pruned[0])
+    if store:
+        store.close()
+    if rollups:
+        rollups.close()
+    if cache:
+        print('response cache: %d hits, %d misses' % (cache.hits, cache.misses))
+        cache.close()
+    os.rename(tmpfile, outfile)
 
 
 def get_options(argv):
@@ -353,9 +837,37 @@ def get_options(argv):
         help='file to write output JSON to',
         default='tests.json',
     )
+    parser.add_argument(
+        '--format',
+        help='format to write outfile in: json, or columnar for a compact '
+             'file that gen_html can read without parsing all of it',
+        choices=['json', 'columnar'],
+        default='json',
+    )
+    parser.add_argument(
+        '--store',
+        help='SQLite file to keep collected builds in between runs. If set, '
+             'only builds newer than those stored are fetched, and outfile '
+             'is regenerated from the store instead of being resumed',
+    )
+    parser.add_argument(
+        '--rollups',
+        help='SQLite file to count results into by day, for flake rates '
+             'over longer windows than outfile keeps',
+    )
+    parser.add_argument(
+        '--cache',
+        help='SQLite file to cache downloaded GCS objects in between runs',
+    )
+    parser.add_argument(
+        '--cache-size',
+        help='how many MB of objects to keep in the cache',
+        default=512,
+        type=int,
+    )
     parser.add_argument(
         '--threads',
-        help='number of concurrent threads to download results with',
+        help='number of concurrent requests to download results with',
         default=32,
         type=int,
     )
@@ -369,4 +881,7 @@ if __name__ == '__main__':
         requests_cache.install_cache(os.getenv('REQ_CACHE'))
     OPTIONS = get_options(sys.argv[1:])
     jobs_dirs = yaml.load(open(OPTIONS.buckets))
-    main(jobs_dirs, OPTIONS.match, OPTIONS.outfile, OPTIONS.threads)
+    main(jobs_dirs, OPTIONS.match, OPTIONS.outfile, OPTIONS.threads,
+         store_path=OPTIONS.store, fmt=OPTIONS.format,
+         cache_path=OPTIONS.cache, cache_size=OPTIONS.cache_size,
+         rollups_path=OPTIONS.rollups)
@@ -20,9 +20,13 @@ import json
 import os
 import shutil
 import tempfile
+import threading
 import unittest
 
+import columnar
 import gen_json
+import response_cache
+import rollup
 
 import time
 
@@ -113,6 +117,141 @@ class IndexedListTest(unittest.TestCase):
         self.assertEqual(l, ['foo', 'bar', 'baz'])
 
 
+class FetchEngineTest(unittest.TestCase):
+    def test_follow_up(self):
+        for threads in [1, 8]:
+            engine = gen_json.FetchEngine(threads)
+            def double(x):
+                return x * 2
+            for x in range(10):
+                engine.submit(double, x)
+            results = []
+            for _, (x,), result in engine.results():
+                results.append(result)
+                if x < 10:
+                    engine.submit(double, x + 10)
+            engine.close()
+            self.assertEqual(sorted(results), range(0, 40, 2))
+
+    def test_stream(self):
+        for threads in [1, 8]:
+            engine = gen_json.FetchEngine(threads)
+            engine.stream(iter, 'abc')
+            engine.submit(len, 'abcd')
+            results = sorted(result for _, _, result in engine.results())
+            engine.close()
+            self.assertEqual(results, [4, 'a', 'b', 'c'])
+
+    def test_error(self):
+        engine = gen_json.FetchEngine(4)
+        engine.submit(int, 'asdf')
+        with self.assertRaises(ValueError):
+            list(engine.results())
+        engine.close()
+
+
+class ConcurrencyLimiterTest(unittest.TestCase):
+    def test_aimd(self):
+        limiter = gen_json.ConcurrencyLimiter(8)
+        delay = limiter.throttle(0)
+        self.assertLessEqual(delay, 1)
+        self.assertEqual(limiter.limit, 4)
+        # a burst of throttling only halves the limit once
+        delay += limiter.throttle(1)
+        self.assertEqual(limiter.limit, 4)
+        for _ in range(4):
+            limiter.succeed()
+        self.assertEqual(int(limiter.limit), 4)
+        for _ in range(5):
+            limiter.succeed()
+        self.assertEqual(int(limiter.limit), 5)
+        for _ in range(100):
+            limiter.succeed()
+        self.assertEqual(limiter.limit, 8)
+        self.assertEqual(limiter.retries, 2)
+        self.assertAlmostEqual(limiter.throttled, delay)
+
+    def test_limit(self):
+        limiter = gen_json.ConcurrencyLimiter(2)
+        limiter.limit = 1
+        order = []
+        def request(n):
+            with limiter:
+                order.append(('start', n))
+                time.sleep(0.01)
+                order.append(('end', n))
+        threads = [threading.Thread(target=request, args=(n,))
+                   for n in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # requests never overlap
+        for n in range(0, 6, 2):
+            self.assertEqual(order[n][0], 'start')
+            self.assertEqual(order[n + 1], ('end', order[n][1]))
+        self.assertEqual(limiter.in_flight, 0)
+        # waiting for a slot isn't throttling
+        self.assertEqual(limiter.throttled, 0)
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, content='', headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeSession(object):
+    """Serves one object, honoring ETags. Records requests made."""
+    def __init__(self, content, etag):
+        self.content = content
+        self.etag = etag
+        self.requests = []
+
+    def get(self, url, params, headers, **_):
+        self.requests.append((url, params, headers))
+        if headers.get('If-None-Match') == self.etag:
+            return FakeResponse(304)
+        return FakeResponse(200, self.content, {
+            'ETag': self.etag, 'x-goog-generation': '5'})
+
+
+class GCSClientCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='test-history-')
+        self.cache = response_cache.ResponseCache(
+            os.path.join(self.tmpdir, 'responses.db'), 1000)
+        self.client = gen_json.GCSClient('gs://bucket/', cache=self.cache)
+        self.session = self.client.session = FakeSession('{"a": 1}', '"e1"')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_conditional(self):
+        self.assertEqual(self.client.get('gs://bucket/x', as_json=True),
+                         {'a': 1})
+        self.assertEqual(self.client.get('gs://bucket/x', as_json=True),
+                         {'a': 1})
+        (_, params, headers), = self.session.requests[1:]
+        self.assertEqual(headers, {'If-None-Match': '"e1"'})
+        self.assertEqual(params['ifGenerationNotMatch'], '5')
+        # a changed object is downloaded again
+        self.session.content, self.session.etag = '{"a": 2}', '"e2"'
+        self.assertEqual(self.client.get('gs://bucket/x', as_json=True),
+                         {'a': 2})
+
+    def test_immutable(self):
+        self.assertEqual(self.client.get('gs://bucket/x', immutable=True),
+                         '{"a": 1}')
+        self.assertEqual(self.client.get('gs://bucket/x', immutable=True),
+                         '{"a": 1}')
+        self.assertEqual(len(self.session.requests), 1)
+
+
 class GCSClientTest(unittest.TestCase):
     """Unit tests for GCSClient"""
 
@@ -172,6 +311,62 @@ class GCSClientTest(unittest.TestCase):
         builds = list(self.client.get_daily_builds(lambda x: True, set()))
         self.assertEqual(builds, [('fake', '123', self.client.NOW)])
 
+    def test_get_daily_builds_sequential(self):
+        # builds 12-20 are recent, and 18 is still running.
+        gets = {self.client.LOG_DIR + 'seq/latest-build.txt': '20'}
+        for build in range(1, 21):
+            if build != 18:
+                gets[self.client.LOG_DIR + 'seq/%d/finished.json' % build] = {
+                    'timestamp': self.client.NOW - 60 * (20 - build)
+                                 if build >= 12 else 123}
+        lists = dict(self.client.lists)
+        lists[self.client.LOG_DIR] = [self.client.LOG_DIR + 'seq/']
+        self.client.gets = gets
+        self.client.lists = lists
+
+        builds = list(self.client.get_daily_builds(lambda x: True, set()))
+        self.assertEqual([build for _, build, _ in builds],
+                         ['20', '19', '17', '16', '15', '14', '13', '12'])
+        self.assertEqual(builds[0], ('seq', '20', self.client.NOW))
+
+        builds = list(self.client.get_daily_builds(lambda x: True,
+                                                   {('seq', '15')}))
+        self.assertEqual([build for _, build, _ in builds],
+                         ['20', '19', '17', '16'])
+
+    def test_get_daily_builds_listed(self):
+        cutoff = self.client.NOW - gen_json.MAX_AGE
+        uploads = {
+            '11': self.client.NOW - 60,  # recent
+            '10': cutoff + 60,  # near the cutoff: finished before it
+            '9': cutoff + 90,  # near the cutoff: finished.json is missing
+            '8': cutoff - 2 * 60 * 60,  # old
+            '7': self.client.NOW - 30,  # already collected
+        }
+        def ls_metadata(path, glob, fields):
+            self.assertEqual((path, glob), (self.client.LOG_DIR + 'list/',
+                                            '*/finished.json'))
+            for build, upload in uploads.iteritems():
+                yield {'name': 'logs/list/%s/finished.json' % build,
+                       'timeCreated': time.strftime(
+                           '%Y-%m-%dT%H:%M:%S.123Z', time.gmtime(upload))}
+        fetched = []
+        def get(path, **_):
+            fetched.append(path)
+            if path.endswith('/10/finished.json'):
+                return {'timestamp': cutoff - 10}
+        self.client.ls_metadata = ls_metadata
+        self.client.get = get
+        self.client.lists = {self.client.LOG_DIR: [self.client.LOG_DIR + 'list/']}
+        self.client.metadata = {'list_finished': True}
+
+        builds = list(self.client.get_daily_builds(lambda x: True,
+                                                   {('list', '7')}))
+        self.assertEqual(builds, [('list', '11', self.client.NOW - 60)])
+        self.assertEqual(sorted(fetched), [
+            self.client.LOG_DIR + 'list/10/finished.json',
+            self.client.LOG_DIR + 'list/9/finished.json'])
+
     def test_get_daily_builds_skip(self):
         # builds that we already have are filtered out.
         have = {('fake', '123')}
@@ -196,11 +391,13 @@ class MainTest(unittest.TestCase):
         ]}}}}}
 
     def assert_main_output(self, outfile, threads, expected=None,
-                           client=MockedClient):
+                           client=MockedClient, store_path=None):
         if expected is None:
             expected = self.get_expected_json()
-        gen_json.main({self.JOBS_DIR: {}}, 'fa', outfile.name, 32, client)
-        output = json.load(outfile)
+        gen_json.main({self.JOBS_DIR: {}}, 'fa', outfile.name, threads, client,
+                      store_path)
+        # outfile is replaced, rather than written through the open handle.
+        output = json.load(open(outfile.name))
         self.assertEqual(output, expected)
 
     def test_clean(self):
@@ -248,6 +445,86 @@ class MainTest(unittest.TestCase):
         }
         self.assert_main_output(outfile, 1, expected, MockedClientNewer)
 
+    def test_store(self):
+        temp_dir = tempfile.mkdtemp(prefix='test-history-')
+        try:
+            store_path = os.path.join(temp_dir, 'builds.db')
+            outfile = tempfile.NamedTemporaryFile(prefix='test-history-')
+            self.assert_main_output(outfile, 1, store_path=store_path)
+
+            fetched = []
+
+            class MockedClientRecorded(MockedClient):
+                def get(self, path, **kwargs):
+                    fetched.append(path)
+                    return super(MockedClientRecorded, self).get(path, **kwargs)
+
+            # outfile is regenerated from the store, not resumed.
+            outfile = tempfile.NamedTemporaryFile(prefix='test-history-')
+            self.assert_main_output(outfile, 1, client=MockedClientRecorded,
+                                    store_path=store_path)
+            self.assertFalse([path for path in fetched if '/123/' in path])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_buckets(self):
+        class MockedClientBuckets(MockedClient):
+            lists = dict(MockedClient.lists)
+            gets = dict(MockedClient.gets)
+            lists['gs://bucket1/'] = ['gs://bucket1/fast/']
+            gets['gs://bucket1/fast/latest-build.txt'] = '1'
+            gets['gs://bucket1/fast/1/finished.json'] = {
+                'timestamp': MockedClient.NOW}
+            lists['gs://bucket1/fast/1/artifacts/'] = []
+
+        outfile = tempfile.NamedTemporaryFile(prefix='test-history-')
+        for threads in [1, 32]:
+            gen_json.main({self.JOBS_DIR: {}, 'gs://bucket1': {}}, 'fa',
+                          outfile.name, threads, MockedClientBuckets)
+            expected = self.get_expected_json()
+            expected['buckets']['gs://bucket1/'] = {'fast': {'1': {
+                'timestamp': MockedClient.NOW, 'tests': []}}}
+            self.assertEqual(json.load(open(outfile.name)), expected)
+
+    def test_incremental_prune(self):
+        outfile = tempfile.NamedTemporaryFile(prefix='test-history-')
+        self.assert_main_output(outfile, 1)
+        old = json.load(open(outfile.name))
+        old['buckets'][self.JOBS_DIR]['fake']['100'] = {
+            'timestamp': 123, 'tests': []}
+        old['buckets']['gs://other/'] = {'job': {
+            '1': {'timestamp': 123, 'tests': []},
+            '2': {'timestamp': MockedClient.NOW, 'tests': []}}}
+        with open(outfile.name, 'w') as buf:
+            json.dump(old, buf)
+        expected = self.get_expected_json()
+        expected['buckets']['gs://other/'] = {'job': {
+            '2': {'timestamp': MockedClient.NOW, 'tests': []}}}
+        self.assert_main_output(outfile, 1, expected)
+
+    def test_rollups(self):
+        temp_dir = tempfile.mkdtemp(prefix='test-history-')
+        try:
+            rollups_path = os.path.join(temp_dir, 'rollups.db')
+            outfile = tempfile.NamedTemporaryFile(prefix='test-history-')
+            gen_json.main({self.JOBS_DIR: {}}, 'fa', outfile.name, 1,
+                          MockedClient, rollups_path=rollups_path)
+            rollups = rollup.RollupStore(rollups_path)
+            self.assertEqual(
+                rollups.get_rates(self.JOBS_DIR, 'fake', MockedClient.NOW),
+                {'Foo': [(1, 0)] * 3, 'Bad': [(1, 1)] * 3})
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_columnar(self):
+        outfile = tempfile.NamedTemporaryFile(prefix='test-history-')
+        for _ in range(2):  # the second run resumes from the first
+            gen_json.main({self.JOBS_DIR: {}}, 'fa', outfile.name, 1,
+                          MockedClient, fmt='columnar')
+            reader = columnar.Reader(outfile.name)
+            self.assertEqual(reader.load(), self.get_expected_json())
+            reader.close()
+
 
 if __name__ == '__main__':
     unittest.main()
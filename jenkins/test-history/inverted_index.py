@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+# Copyright 2016 The Kubernetes Authors All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""An inverted index from tests to the runs of them in every job."""
+
+import collections
+
+import numpy
+
+import columnar
+
+Postings = collections.namedtuple('Postings', [
+    'jobs',      # for each run: the index of its job, in the order added
+    'builds',    # ... the index of its build in that job
+    'statuses',  # ... columnar.FAILED and columnar.SKIPPED bits
+])
+
+
+class TestIndex(object):
+    """
+    Maps each test name index to its runs across all jobs.
+
+    Jobs are added one at a time, and the index is built once when they've
+    all been added. Looking up a test is then a slice of sorted arrays,
+    rather than a scan over every job.
+    """
+
+    def __init__(self):
+        self.jobs = []
+        self.parts = []
+        self.postings = None
+        self.offsets = None
+        self.failing = None
+
+    def add_job(self, job, ids, builds, failed, ran):
+        """
+        Adds a job's runs.
+
+        Args:
+            job: anything identifying the job, returned by lookups.
+            ids, builds, failed, ran: arrays with an entry for each run: its
+                test name index, the index of its build, whether it failed,
+                and whether it wasn't skipped.
+        """
+        statuses = (numpy.where(failed, columnar.FAILED, 0) |
+                    numpy.where(ran, 0, columnar.SKIPPED)).astype(numpy.uint8)
+        self.parts.append((
+            numpy.asarray(ids, int),
+            numpy.full(len(ids), len(self.jobs), int),
+            numpy.asarray(builds, int),
+            statuses))
+        self.jobs.append(job)
+
+    def build(self):
+        """Sorts the runs added so far by test."""
+        if self.parts:
+            ids, jobs, builds, statuses = (
+                numpy.concatenate(column) for column in zip(*self.parts))
+        else:
+            ids, jobs, builds, statuses = (
+                numpy.zeros(0, dtype) for dtype in (int, int, int, numpy.uint8))
+        # A stable sort keeps each test's runs ordered by job, then build.
+        order = numpy.argsort(ids, kind='mergesort')
+        self.postings = Postings(jobs[order], builds[order], statuses[order])
+        self.offsets = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(ids))))
+        self.failing = numpy.unique(ids[statuses & columnar.FAILED != 0])
+        self.parts = []
+
+    def lookup(self, test_id):
+        """Returns Postings for every run of a test."""
+        if test_id + 1 >= len(self.offsets):
+            return Postings(*(column[:0] for column in self.postings))
+        start, end = self.offsets[test_id], self.offsets[test_id + 1]
+        return Postings(*(column[start:end] for column in self.postings))
+
+    def failing_tests(self):
+        """Returns the indexes of tests that failed in any job, in order."""
+        return [int(test_id) for test_id in self.failing]
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+# Copyright 2016 The Kubernetes Authors All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for inverted_index."""
+
+import unittest
+
+import columnar
+import inverted_index
+
+
+class TestIndexTest(unittest.TestCase):
+    def test_lookup(self):
+        index = inverted_index.TestIndex()
+        index.add_job('a', [0, 2, 0, 2], [0, 0, 1, 1],
+                      [False, True, False, False], [True, True, True, False])
+        index.add_job('b', [2, 1], [0, 0], [True, False], [True, True])
+        index.build()
+        self.assertEqual(index.jobs, ['a', 'b'])
+        self.assertEqual(index.failing_tests(), [2])
+
+        postings = index.lookup(2)
+        self.assertEqual(list(postings.jobs), [0, 0, 1])
+        self.assertEqual(list(postings.builds), [0, 1, 0])
+        self.assertEqual(list(postings.statuses), [
+            columnar.FAILED, columnar.SKIPPED, columnar.FAILED])
+        self.assertEqual(list(index.lookup(0).builds), [0, 1])
+        self.assertEqual(list(index.lookup(1).jobs), [1])
+        self.assertEqual(len(index.lookup(3).jobs), 0)
+
+    def test_empty(self):
+        index = inverted_index.TestIndex()
+        index.build()
+        self.assertEqual(index.failing_tests(), [])
+        self.assertEqual(len(index.lookup(0).jobs), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+# Copyright 2016 The Kubernetes Authors All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""An on-disk cache of GCS object downloads, bounded in size."""
+
+import collections
+import sqlite3
+import threading
+import time
+
+Entry = collections.namedtuple('Entry', [
+    'etag',
+    'generation',
+    'metageneration',
+    'immutable',
+    'body',
+])
+
+
+class ResponseCache(object):
+    """
+    A SQLite database of object contents, keyed by URL.
+
+    Each entry records the object's ETag, generation and metageneration, so
+    that it can be revalidated with a conditional request. Immutable entries,
+    like the artifacts of finished builds, are used without revalidating.
+    The least recently used entries are evicted once the bodies exceed
+    max_size bytes.
+
+    Access times are buffered in memory and written in batches, and puts are
+    committed in batches, so requests don't wait on the database syncing to
+    disk while holding the lock every other thread needs. Batches are also
+    committed on eviction and close().
+
+    Safe to share between threads.
+    """
+
+    # How many access times to buffer before writing them.
+    ACCESS_BATCH = 1000
+    # How many puts to write before committing them.
+    PUT_BATCH = 100
+
+    def __init__(self, path, max_size):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                generation TEXT,
+                metageneration TEXT,
+                immutable INTEGER,
+                body BLOB,
+                size INTEGER,
+                accessed REAL
+            );
+            CREATE INDEX IF NOT EXISTS responses_by_access
+                ON responses (accessed);
+        ''')
+        self.size = self.db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        self.accessed = {}  # {url: access time not yet written}
+        self.uncommitted = 0  # puts written since the last commit
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, url):
+        """Returns the Entry for url, or None if it's not cached."""
+        with self.lock:
+            row = self.db.execute(
+                'SELECT etag, generation, metageneration, immutable, body '
+                'FROM responses WHERE url = ?', (url,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.accessed[url] = time.time()
+            if len(self.accessed) >= self.ACCESS_BATCH:
+                self._write_accessed()
+                self._commit()
+        etag, generation, metageneration, immutable, body = row
+        return Entry(etag, generation, metageneration, bool(immutable),
+                     str(body))
+
+    def put(self, url, entry):
+        """Caches entry for url, evicting old entries if it's too large."""
+        size = len(entry.body)
+        if size > self.max_size:
+            return
+        with self.lock:
+            old = self.db.execute(
+                'SELECT size FROM responses WHERE url = ?', (url,)).fetchone()
+            if old:
+                self.size -= old[0]
+            self.accessed.pop(url, None)  # superseded by the new entry
+            self.db.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (url, entry.etag, entry.generation, entry.metageneration,
+                 int(entry.immutable), sqlite3.Binary(entry.body), size,
+                 time.time()))
+            self.size += size
+            self.uncommitted += 1
+            if self.size > self.max_size:
+                self._write_accessed()
+                self._evict()
+                self._commit()
+            elif self.uncommitted >= self.PUT_BATCH:
+                self._commit()
+
+    def _commit(self):
+        self.db.commit()
+        self.uncommitted = 0
+
+    def _write_accessed(self):
+        self.db.executemany(
+            'UPDATE responses SET accessed = ? WHERE url = ?',
+            [(accessed, url) for url, accessed in self.accessed.iteritems()])
+        self.accessed = {}
+
+    def _evict(self):
+        rows = self.db.execute(
+            'SELECT url, size FROM responses ORDER BY accessed').fetchall()
+        evicted = []
+        for url, size in rows:
+            if self.size <= self.max_size:
+                break
+            evicted.append((url,))
+            self.size -= size
+        self.db.executemany('DELETE FROM responses WHERE url = ?', evicted)
+
+    def close(self):
+        with self.lock:
+            self._write_accessed()
+            self._commit()
+            self.db.close()
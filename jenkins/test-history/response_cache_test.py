@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+# Copyright 2016 The Kubernetes Authors All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for response_cache."""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import response_cache
+
+
+def entry(body, immutable=False):
+    return response_cache.Entry('"etag"', '1', '1', immutable, body)
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='test-history-')
+        self.path = os.path.join(self.tmpdir, 'responses.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_put(self):
+        cache = response_cache.ResponseCache(self.path, 100)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', entry('\x00abc', True))
+        self.assertEqual(cache.get('a'), entry('\x00abc', True))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        cache.close()
+        # entries persist between runs
+        cache = response_cache.ResponseCache(self.path, 100)
+        self.assertEqual(cache.get('a'), entry('\x00abc', True))
+        self.assertEqual(cache.size, 4)
+
+    def test_evict(self):
+        cache = response_cache.ResponseCache(self.path, 10)
+        cache.put('a', entry('aaaa'))
+        cache.put('b', entry('bbbb'))
+        cache.get('a')  # b is now the least recently used
+        cache.put('c', entry('cccc'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a').body, 'aaaa')
+        self.assertEqual(cache.get('c').body, 'cccc')
+        self.assertEqual(cache.size, 8)
+        # replacing an entry doesn't count it twice
+        cache.put('c', entry('cc'))
+        self.assertEqual(cache.size, 6)
+        # entries too large to ever fit aren't cached
+        cache.put('d', entry('d' * 11))
+        self.assertIsNone(cache.get('d'))
+        self.assertEqual(cache.size, 6)
+
+    def test_access_batched(self):
+        now = [1000.0]
+        real_time = response_cache.time.time
+        response_cache.time.time = lambda: now[0]
+        self.addCleanup(setattr, response_cache.time, 'time', real_time)
+        cache = response_cache.ResponseCache(self.path, 100)
+        cache.put('a', entry('aaaa'))
+        cache.put('b', entry('bbbb'))
+        stored = dict(cache.db.execute('SELECT url, accessed FROM responses'))
+        now[0] += 1
+        cache.get('a')
+        # hits are only written in batches, or on eviction or close
+        self.assertEqual(
+            dict(cache.db.execute('SELECT url, accessed FROM responses')),
+            stored)
+        cache.close()
+        cache = response_cache.ResponseCache(self.path, 100)
+        accessed = dict(cache.db.execute('SELECT url, accessed FROM responses'))
+        self.assertGreater(accessed['a'], stored['a'])
+        self.assertEqual(accessed['b'], stored['b'])
+
+    def committed(self):
+        db = sqlite3.connect(self.path)
+        try:
+            return sorted(url for url, in db.execute('SELECT url FROM responses'))
+        finally:
+            db.close()
+
+    def test_put_batched(self):
+        cache = response_cache.ResponseCache(self.path, 10)
+        cache.PUT_BATCH = 3
+        cache.put('a', entry('a'))
+        cache.put('b', entry('b'))
+        # puts are only committed in batches, or on eviction or close
+        self.assertEqual(self.committed(), [])
+        cache.put('c', entry('c'))
+        self.assertEqual(self.committed(), ['a', 'b', 'c'])
+        cache.put('d', entry('dddd'))
+        self.assertEqual(self.committed(), ['a', 'b', 'c'])
+        cache.put('e', entry('eeee'))  # evicts a
+        self.assertEqual(self.committed(), ['b', 'c', 'd', 'e'])
+        cache.put('f', entry('f'))
+        cache.close()
+        self.assertEqual(self.committed(), ['c', 'd', 'e', 'f'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+# Copyright 2016 The Kubernetes Authors All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Daily aggregates of test results, for flake rates over longer windows."""
+
+import collections
+import sqlite3
+
+DAY = 60 * 60 * 24
+# The windows, in days, that flake rates are reported over.
+WINDOWS = (1, 7, 30)
+
+
+class RollupStore(object):
+    """
+    A SQLite database of per-test, per-job run and failure counts by day.
+
+    Raw results aren't kept: each build is counted into the day (UTC) it
+    finished on, and days older than the longest window are pruned.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS daily (
+                bucket TEXT,
+                job TEXT,
+                test TEXT,
+                day INTEGER,  -- days since the epoch
+                runs INTEGER,
+                failed INTEGER,
+                PRIMARY KEY (bucket, job, test, day)
+            );
+            CREATE TABLE IF NOT EXISTS counted (
+                bucket TEXT,
+                job TEXT,
+                build TEXT,
+                day INTEGER,
+                PRIMARY KEY (bucket, job, build)
+            );
+        ''')
+
+    def add_build(self, bucket, job, build, timestamp, tests):
+        """
+        Counts a build's results into its day, unless it's been counted.
+
+        Args:
+            tests: a list of (name, time, failed, skipped) tuples.
+        """
+        day = int(timestamp // DAY)
+        cursor = self.db.execute(
+            'INSERT OR IGNORE INTO counted VALUES (?, ?, ?, ?)',
+            (bucket, job, build, day))
+        if not cursor.rowcount:
+            return
+        counts = collections.defaultdict(lambda: [0, 0])
+        for name, _, failed, skipped in tests:
+            if not skipped:
+                counts[name][0] += 1
+                counts[name][1] += bool(failed)
+        self.db.executemany(
+            'INSERT OR IGNORE INTO daily VALUES (?, ?, ?, ?, 0, 0)',
+            [(bucket, job, name, day) for name in counts])
+        self.db.executemany(
+            'UPDATE daily SET runs = runs + ?, failed = failed + ? '
+            'WHERE bucket = ? AND job = ? AND test = ? AND day = ?',
+            [(runs, failed, bucket, job, name, day)
+             for name, (runs, failed) in counts.iteritems()])
+
+    def remove_old_days(self, now):
+        """Deletes the counts of days before the longest window."""
+        oldest = int(now // DAY) - max(WINDOWS) + 1
+        self.db.execute('DELETE FROM daily WHERE day < ?', (oldest,))
+        self.db.execute('DELETE FROM counted WHERE day < ?', (oldest,))
+
+    def get_rates(self, bucket, job, now):
+        """
+        Returns each test's counts over the last 1, 7 and 30 days.
+
+        Windows are whole calendar days (UTC), ending with the day of now, so
+        the 1-day window only covers today so far, as job pages say.
+
+        Returns:
+            {test: [(runs, failed) for each of WINDOWS]}
+        """
+        today = int(now // DAY)
+        columns = ', '.join(
+            'SUM(CASE WHEN day > %d THEN runs ELSE 0 END), '
+            'SUM(CASE WHEN day > %d THEN failed ELSE 0 END)'
+            % (today - days, today - days) for days in WINDOWS)
+        rows = self.db.execute(
+            'SELECT test, %s FROM daily WHERE bucket = ? AND job = ? '
+            'GROUP BY test' % columns, (bucket, job))
+        return {row[0]: zip(row[1::2], row[2::2]) for row in rows}
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
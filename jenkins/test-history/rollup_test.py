@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+# Copyright 2016 The Kubernetes Authors All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for rollup."""
+
+import unittest
+
+import rollup
+
+
+BUCKET = 'gs://kubernetes-jenkins/logs/'
+NOW = 1000 * rollup.DAY + 100
+
+
+class RollupStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.rollups = rollup.RollupStore(':memory:')
+
+    def test_get_rates(self):
+        def add(build, days_ago, tests):
+            self.rollups.add_build(BUCKET, 'job', build,
+                                   NOW - days_ago * rollup.DAY, tests)
+        add('1', 0, [('Foo', 1.0, False, False), ('Bar', 1.0, True, False)])
+        add('2', 3, [('Foo', 1.0, True, False), ('Bar', 1.0, False, True)])
+        add('3', 20, [('Foo', 1.0, True, False)])
+        add('4', 40, [('Foo', 1.0, True, False)])
+        # builds are only counted once
+        add('1', 0, [('Foo', 1.0, False, False), ('Bar', 1.0, True, False)])
+        self.rollups.add_build(BUCKET, 'other', '1', NOW,
+                               [('Foo', 1.0, True, False)])
+        self.assertEqual(self.rollups.get_rates(BUCKET, 'job', NOW), {
+            'Foo': [(1, 0), (2, 1), (3, 2)],
+            'Bar': [(1, 1), (1, 1), (1, 1)],
+        })
+
+    def test_remove_old_days(self):
+        self.rollups.add_build(BUCKET, 'job', '1', NOW - 40 * rollup.DAY,
+                               [('Foo', 1.0, True, False)])
+        self.rollups.add_build(BUCKET, 'job', '2', NOW,
+                               [('Foo', 1.0, False, False)])
+        self.rollups.remove_old_days(NOW)
+        self.assertEqual(
+            self.rollups.db.execute('SELECT COUNT(*) FROM daily').fetchone(),
+            (1,))
+        self.assertEqual(
+            self.rollups.db.execute('SELECT build FROM counted').fetchall(),
+            [('2',)])
+
+
+if __name__ == '__main__':
+    unittest.main()
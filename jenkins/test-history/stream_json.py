@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+# Copyright 2016 The Kubernetes Authors All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Reads and writes tests.json a job at a time.
+
+The output is ordinary JSON, laid out with one job per line so that it can be
+read back without parsing the whole file:
+
+    {"buckets": {
+    "gs://bucket/": {
+    "job": {"build": {"timestamp": ..., "tests": [...]}, ...}
+    ,"job2": {...}
+    }
+    ,"gs://bucket2/": {
+    }
+    }, "test_names": [...]}
+
+Test names come last, since they aren't known until every job is written.
+"""
+
+import json
+import os
+
+HEADER = '{"buckets": {\n'
+FOOTER = '}, "test_names": '
+
+
+class Writer(object):
+    """Writes buckets one at a time, followed by the test names."""
+
+    def __init__(self, path):
+        self.out = open(path, 'w')
+        self.out.write(HEADER)
+        self.buckets = 0
+
+    def write_bucket(self, bucket, jobs):
+        """Appends a bucket's jobs: {job: {build: {...}}}, as in tests.json."""
+        self.out.write('%s%s: {\n' % (',' if self.buckets else '',
+                                      json.dumps(bucket)))
+        for n, (job, builds) in enumerate(sorted(jobs.iteritems())):
+            self.out.write('%s%s: %s\n' % (',' if n else '', json.dumps(job),
+                                           json.dumps(builds, sort_keys=True)))
+        self.out.write('}\n')
+        self.buckets += 1
+
+    def close(self, test_names):
+        """Writes the test names and closes the file."""
+        self.out.write('%s%s}\n' % (FOOTER, json.dumps(test_names)))
+        self.out.close()
+
+
+def _read_last_line(buf):
+    buf.seek(0, os.SEEK_END)
+    end = buf.tell()
+    size = 4096
+    while True:
+        start = max(0, end - size)
+        buf.seek(start)
+        data = buf.read(end - start).rstrip('\n')
+        newline = data.rfind('\n')
+        if newline >= 0 or start == 0:
+            return data[newline + 1:]
+        size *= 2
+
+
+class Reader(object):
+    """
+    Reads jobs from a tests.json file.
+
+    Files not written by Writer are loaded in full instead.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data = None
+        with open(path) as buf:
+            if buf.readline() == HEADER:
+                line = _read_last_line(buf)
+                if not line.startswith(FOOTER):
+                    raise ValueError('%s is truncated' % path)
+                self.test_names = json.loads(line[len(FOOTER):-1])
+                return
+            buf.seek(0)
+            self.data = json.load(buf)
+        if 'test_names' not in self.data:
+            raise ValueError('%s has no test_names' % path)
+        self.test_names = self.data['test_names']
+
+    def list_jobs(self):
+        """Generates (bucket, job, builds) for each job, ordered by bucket."""
+        if self.data is not None:
+            for bucket, jobs in sorted(self.data['buckets'].iteritems()):
+                for job, builds in sorted(jobs.iteritems()):
+                    yield bucket, job, builds
+            return
+        with open(self.path) as buf:
+            buf.readline()
+            bucket = None
+            for line in buf:
+                line = line.rstrip('\n').lstrip(',')
+                if line.startswith(FOOTER):
+                    return
+                elif line == '}':
+                    bucket = None
+                elif line.endswith('{'):
+                    bucket = json.loads(line[:-len(': {')])
+                else:
+                    (job, builds), = json.loads('{%s}' % line).items()
+                    yield bucket, job, builds
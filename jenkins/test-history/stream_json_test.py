@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+# Copyright 2016 The Kubernetes Authors All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for stream_json."""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import stream_json
+
+
+BUCKETS = {
+    'gs://kubernetes-jenkins/logs/': {
+        'kubernetes-release': {
+            '3': {'timestamp': 30, 'tests': [{'name': 0, 'time': 3.52}]},
+        },
+        'kubernetes-debug': {
+            '5': {'timestamp': 50, 'tests': [
+                {'name': 1, 'time': 7.56, 'failed': True}]},
+        },
+    },
+    'gs://kube_azure_log/': {},
+    'gs://rktnetes-jenkins/logs/': {
+        'kubernetes-release': {},
+    },
+}
+
+
+class StreamJsonTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='test-history-')
+        self.path = os.path.join(self.tmpdir, 'tests.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, test_names):
+        writer = stream_json.Writer(self.path)
+        for bucket, jobs in sorted(BUCKETS.iteritems()):
+            writer.write_bucket(bucket, jobs)
+        writer.close(test_names)
+
+    def test_valid_json(self):
+        self.write(['test1', 'test2'])
+        self.assertEqual(json.load(open(self.path)),
+                         {'test_names': ['test1', 'test2'], 'buckets': BUCKETS})
+
+    def test_read(self):
+        # enough names that the last line is read in several pieces
+        test_names = ['test%d' % n for n in range(2000)]
+        self.write(test_names)
+        reader = stream_json.Reader(self.path)
+        self.assertEqual(reader.test_names, test_names)
+        self.assertEqual(list(reader.list_jobs()), [
+            ('gs://kubernetes-jenkins/logs/', 'kubernetes-debug',
+             BUCKETS['gs://kubernetes-jenkins/logs/']['kubernetes-debug']),
+            ('gs://kubernetes-jenkins/logs/', 'kubernetes-release',
+             BUCKETS['gs://kubernetes-jenkins/logs/']['kubernetes-release']),
+            ('gs://rktnetes-jenkins/logs/', 'kubernetes-release', {}),
+        ])
+
+    def test_read_whole(self):
+        # files written with json.dump are loaded in full
+        with open(self.path, 'w') as buf:
+            json.dump({'test_names': ['test1'], 'buckets': BUCKETS}, buf)
+        reader = stream_json.Reader(self.path)
+        self.assertEqual(reader.test_names, ['test1'])
+        self.assertEqual(len(list(reader.list_jobs())), 3)
+
+    def test_truncated(self):
+        self.write(['test1'])
+        with open(self.path, 'r+') as buf:
+            buf.truncate(os.path.getsize(self.path) - 10)
+        self.assertRaises(ValueError, stream_json.Reader, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -16,7 +16,7 @@
 
 from __future__ import division
 
-import collections
+import cPickle
 import cStringIO
 import datetime
 import gzip
@@ -33,18 +33,128 @@ import matplotlib.patches as mpatches
 import matplotlib.pyplot as plt
 import numpy
 
-def parse_line(
-        date, time, online, pr, queue,
-        run, blocked, merge_count=0):  # merge_count may be missing
-    return (
-        datetime.datetime.strptime('{} {}'.format(date, time), '%Y-%m-%d %H:%M:%S.%f'),
-        online == 'True',  # Merge queue is down/initializing
-        int(pr),  # Number of open PRs
-        int(queue),  # PRs in the queue
-        int(run),  # Totally worthless
-        blocked == 'True',  # Cannot merge
-        int(merge_count),  # Number of merges
-    )
+
+# Samples are kept this long, so the rolling windows are full at the start of
+# the plot, which shows PLOT_DAYS.
+KEEP_DAYS = 30
+PLOT_DAYS = 21
+WINDOW = 60*24  # Samples in each rolling window: a day of them
+
+SAMPLE = numpy.dtype([
+    ('dt', float),  # matplotlib date number
+    ('online', bool),  # Merge queue is up (not down/initializing)
+    ('pr', int),  # Number of open PRs
+    ('queue', int),  # PRs in the queue
+    ('blocked', bool),  # Cannot merge
+    ('merged', int),  # Number of merges since the queue restarted
+    ('did_merge', int),  # Number of merges since the last sample
+])
+
+
+def days_ago(days):
+    """Return the date number of days before now."""
+    return mdates.date2num(
+        datetime.datetime.now() - datetime.timedelta(days=days))
+
+
+def load_samples(history_lines):
+    """Parse history lines into an array of SAMPLE in one pass.
+
+    Lines are 'DATE TIME ONLINE PRS QUEUE RUNNING BLOCKED [MERGE_COUNT]', and
+    other lines are skipped. Times are decoded from their digits with numpy
+    and dates are converted once per day, rather than with strptime per
+    line. did_merge is left at 0; see count_merges.
+    """
+    fields = []
+    for line in history_lines:
+        parts = line.strip().split(' ')
+        if len(parts) == 7:
+            parts.append('0')  # merge_count may be missing
+        elif len(parts) != 8:
+            continue  # line does not fit expected criteria
+        fields.append(parts)
+    samples = numpy.zeros(len(fields), SAMPLE)
+    if not fields:
+        return samples
+    dates, times, online, pr, queue, _, blocked, merged = zip(*fields)
+
+    days, day_index = numpy.unique(dates, return_inverse=True)
+    day_nums = numpy.array([
+        mdates.date2num(datetime.datetime.strptime(day, '%Y-%m-%d'))
+        for day in days])
+    # HH:MM:SS.ffffff, where the microseconds are missing when they're 0.
+    digits = numpy.array(times, 'S15').view(numpy.uint8).reshape(-1, 15)
+    digits = numpy.where(digits, digits.astype(int) - ord('0'), 0)
+    seconds = (
+        (digits[:, 0] * 10 + digits[:, 1]) * 3600 +
+        (digits[:, 3] * 10 + digits[:, 4]) * 60 +
+        digits[:, 6] * 10 + digits[:, 7] +
+        digits[:, 9:].dot(10.0 ** -numpy.arange(1, 7)))
+    samples['dt'] = day_nums[day_index] + seconds / (24 * 3600)
+
+    samples['online'] = numpy.array(online) == 'True'
+    samples['pr'] = numpy.array(pr).astype(int)
+    samples['queue'] = numpy.array(queue).astype(int)
+    samples['blocked'] = numpy.array(blocked) == 'True'
+    samples['merged'] = numpy.array(merged).astype(int)
+    return samples
+
+
+def count_merges(samples, last_merge):
+    """Fill in samples' did_merge, returning the new last_merge.
+
+    last_merge is the merge count of the last online sample before these.
+    Offline samples don't count, and restarts reset the count to 0.
+    """
+    if not len(samples):
+        return last_merge
+    online = samples['online']
+    merged = samples['merged']
+    # The index of the last online sample up to each one, or -1.
+    last_online = numpy.maximum.accumulate(
+        numpy.where(online, numpy.arange(len(samples)), -1))
+    before = numpy.concatenate(([last_merge], numpy.where(
+        last_online >= 0, merged[last_online], last_merge)))
+    samples['did_merge'] = numpy.where(
+        merged >= before[:-1], merged - before[:-1],
+        numpy.where(online, merged, 0))
+    return before[-1]
+
+
+def rolling_sum(values, window):
+    """Sum each of values with the (up to) window-1 values before it."""
+    sums = numpy.concatenate(([0], numpy.cumsum(values)))
+    ends = numpy.arange(1, len(values) + 1)
+    return sums[ends] - sums[numpy.maximum(ends - window, 0)]
+
+
+def rolling_stats(samples):
+    """Compute the rolling daily statistics at each sample, with cumsums.
+
+    Returns:
+        (happiness, merge_rate, real_merge_rate) arrays: the fraction of the
+        last WINDOW samples where the queue was online and unblocked, the
+        merges in the last WINDOW samples where the queue was busy, and the
+        merges in the last WINDOW samples.
+    """
+    did_merge = samples['did_merge']
+    happy = samples['online'] & ~samples['blocked']
+    happiness = rolling_sum(happy, WINDOW) / numpy.minimum(
+        numpy.arange(1, len(samples) + 1), WINDOW)
+    real_merge_rate = rolling_sum(did_merge, WINDOW)
+    # Only count samples when the queue is busy.
+    busy = (samples['queue'] > 0) | (did_merge > 0)
+    busy_rate = numpy.concatenate(([0], rolling_sum(did_merge[busy], WINDOW)))
+    merge_rate = busy_rate[numpy.cumsum(busy)]
+    return happiness, merge_rate, real_merge_rate
+
+
+def intervals(dts, flags, last_dt):
+    """List (start, end) for each run of flags, ending at the next sample."""
+    edges = numpy.flatnonzero(numpy.diff(numpy.concatenate(
+        ([False], flags, [False])).astype(int)))
+    starts, ends = edges[::2], edges[1::2]
+    return zip(dts[starts], numpy.append(dts, last_dt)[ends])
 
 
 def merges_color(merges):
@@ -84,109 +194,64 @@ def format_timedelta(delta):
         delta.days, delta.seconds / 3600, (delta.seconds % 3600) / 60)
 
 
-class Sampler(object):
-    total = 0
-
-    def __init__(self, maxlen=60*24):
-        self.maxlen = maxlen
-        self.samples = collections.deque()
-
-    def __iadd__(self, sample):
-        self.samples.append(sample)
-        self.total += sample
-        while len(self.samples) > self.maxlen:
-            self.total -= self.samples.popleft()
-        return self
-
-    @property
-    def mean(self):
-        return float(self.total) / len(self.samples)
-
-
-def render(history_lines, out_file):
-    """Read historical data and save to out_file as img."""
-    dts = []
-    prs = []
-    queued = []
-    daily_happiness = []  # Percentage of last day queue was not blocked
-    merge_rate = []  # Merge rate for the past 24 active hours
-    real_merge_rate = []  # Merge rate including when queue is empty
-    merges = []
-
-    blocked_intervals = []
-    offline_intervals = []
-
-    active_merges = Sampler()
-    real_merges = Sampler()
-    happy_moments = Sampler()
-
-    daily_merged = collections.deque()
-    actually_merged = collections.deque()
-
-    start_blocked = None
-    start_offline = None
-    last_merge = 0  # Number of merges last sample, resets on queue restart
-
-    for line in history_lines:
-        try:
-            dt, online, pr, queue, _, blocked, merged = parse_line(
-                *line.strip().split(' '))
-        except TypeError:  # line does not fit expected criteria
-            continue
-        if dt < datetime.datetime.now() - datetime.timedelta(days=30):
-            continue
-
-        if merged >= last_merge:
-            did_merge = merged - last_merge
-        elif online:  # Restarts reset the number to 0
-            did_merge = merged
-        else:
-            did_merge = 0
-
-        if online:  # Ignore offline status
-            last_merge = merged
-
-        happy_moments += int(bool(online and not blocked))
-
-        real_merges += did_merge
-        if queue or did_merge:  # Only add samples when queue is busy.
-            active_merges += did_merge
-
-        if not start_offline and not online:
-            start_offline = dt
-        if start_offline and online:
-            offline_intervals.append((start_offline, dt))
-            start_offline = None
-
-        if not online:  # Skip offline entries
-            continue
-
-        # Make them steps instead of slopes.
-        if dts:
-            dts.append(dt)
-            prs.append(prs[-1])
-            queued.append(queued[-1])
-            daily_happiness.append(happy_moments.mean)
-            merge_rate.append(active_merges.total)
-            real_merge_rate.append(real_merges.total)
-            merges.append(did_merge)
-        dts.append(dt)
-        prs.append(pr)
-        queued.append(queue)
-        daily_happiness.append(happy_moments.mean)
-        merge_rate.append(active_merges.total)
-        real_merge_rate.append(real_merges.total)
-        merges.append(did_merge)
-
-        if not start_blocked and blocked:
-            start_blocked = dt
-        if start_blocked and not blocked:
-            blocked_intervals.append((start_blocked, dt))
-            start_blocked = None
-    if start_blocked:
-        blocked_intervals.append((start_blocked, dt))
-    if start_offline:
-        offline_intervals.append((start_offline, dt))
+class RenderState(object):
+    """The samples render plots, kept between renders.
+
+    The state can be checkpointed to disk, so each render only parses the
+    lines added since the last one. offsets records how many bytes of each
+    history segment have been processed, or None once a segment is finished.
+    """
+    VERSION = 2  # Checkpoints from other versions are discarded
+
+    def __init__(self):
+        self.version = self.VERSION
+        self.offsets = {}
+        self.samples = numpy.zeros(0, SAMPLE)
+        self.last_merge = 0  # Number of merges at the last online sample
+
+    def add_lines(self, history_lines):
+        """Process new lines of history, oldest first."""
+        samples = load_samples(history_lines)
+        samples = samples[samples['dt'] >= days_ago(KEEP_DAYS)]
+        if len(self.samples):
+            # Lines seen again (say, after a segment was rewritten) are
+            # skipped, so they aren't plotted or counted as merges twice.
+            samples = samples[samples['dt'] > self.samples['dt'][-1]]
+        self.last_merge = count_merges(samples, self.last_merge)
+        self.samples = numpy.concatenate((self.samples, samples))
+
+    def trim(self, oldest):
+        """Forget samples from before oldest, a date number."""
+        self.samples = self.samples[self.samples['dt'] >= oldest]
+
+
+def render(state, out_file):
+    """Save the samples in state to out_file as img."""
+    samples = state.samples
+    plot_start = days_ago(PLOT_DAYS)
+    happiness, rate, real_rate = rolling_stats(samples)
+
+    last_dt = samples['dt'][-1]
+    online = numpy.flatnonzero(samples['online'])
+    offline_intervals = intervals(samples['dt'], ~samples['online'], last_dt)
+    blocked_intervals = intervals(
+        samples['dt'][online], samples['blocked'][online], last_dt)
+    offline_intervals = [i for i in offline_intervals if i[1] >= plot_start]
+    blocked_intervals = [i for i in blocked_intervals if i[1] >= plot_start]
+
+    # Plot online samples, as steps instead of slopes.
+    shown = online[samples['dt'][online] >= plot_start]
+    def steps(values):
+        return numpy.repeat(values[shown], 2)[1:]
+    def steps_after(values):
+        return numpy.repeat(values[shown], 2)[:-1]
+    dts = steps(samples['dt'])
+    prs = steps_after(samples['pr'])
+    queued = steps_after(samples['queue'])
+    daily_happiness = steps(happiness)  # Percentage of last day queue was not blocked
+    merge_rate = steps(rate)  # Merge rate for the past 24 active hours
+    real_merge_rate = steps(real_rate)  # Merge rate including when queue is empty
+    merges = steps(samples['did_merge'])
 
     fig, (ax_open, ax_merged, ax_health) = plt.subplots(
         3, sharex=True, figsize=(16, 8), dpi=100)
@@ -222,7 +287,7 @@ def render(history_lines, out_file):
     ax_merged.set_ylabel('Merge capacity: %d/d' % merge_rate[-1], color=merge_color)
 
     ax_health.set_ylim([0.0, 1.0])
-    ax_health.set_xlim(left=datetime.datetime.now() - datetime.timedelta(days=21))
+    ax_health.set_xlim(left=plot_start)
 
     fig.autofmt_xdate()
 
@@ -238,17 +303,15 @@ def render(history_lines, out_file):
     ax_health.legend([p_offline, p_blocked], ['offline', 'blocked'], 'lower left', fontsize='x-small')
     ax_merged.legend([p_merge, p_real_merge, p_offline], ['capacity', 'actual', 'offline'], 'lower left', fontsize='x-small')
 
-    last_week = datetime.datetime.now() - datetime.timedelta(days=6)
+    this_week = dts >= days_ago(6)
 
     halign = 'center'
     xpos = 0.5
     fig.text(
         xpos, 0.08, 'Weekly statistics', horizontalalignment=halign)
 
-    weekly_merge_rate = numpy.mean([
-        m for (d, m) in zip(dts, merge_rate) if d >= last_week])
-    weekly_merges = sum(
-        m for (d, m) in zip(dts, merges) if d >= last_week)
+    weekly_merge_rate = numpy.mean(merge_rate[this_week])
+    weekly_merges = merges[this_week].sum()
 
     fig.text(
         xpos, .00,
@@ -258,8 +321,7 @@ def render(history_lines, out_file):
         horizontalalignment=halign,
     )
 
-    week_happiness = numpy.mean(
-        [h for (d, h) in zip(dts, daily_happiness) if d >= last_week])
+    week_happiness = numpy.mean(daily_happiness[this_week])
     fig.text(
         xpos, .04,
         'Unblocked %.1f%% of this week' % (100 * week_happiness),
@@ -288,30 +350,119 @@ def render(history_lines, out_file):
     plt.close()
 
 
-def render_forever(history_uri, img_uri, service_account=None):
-    """Download results from history_uri, render to svg and save to img_uri."""
+def stat_exists(uri):
+    """Returns whether uri exists, retrying until gsutil can tell."""
+    while True:
+        # Not -q: it would hide the message that tells missing from failing.
+        proc = subprocess.Popen(
+            ['gsutil', 'stat', uri],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, err = proc.communicate()
+        if not proc.returncode:
+            return True
+        if 'No URLs matched' in err:
+            return False
+        print >>sys.stderr, 'Failed to stat %s: %s' % (uri, err.strip())
+        time.sleep(5)
+
+
+def list_segments(history_uri, days=21):
+    """List the history segments which may have samples from the last days.
+
+    The poller lists segments in history_uri.manifest, one 'START_DAY URI'
+    line each, oldest first. Histories without a manifest are a single file.
+    """
+    manifest_uri = '%s.manifest' % history_uri
+    if not stat_exists(manifest_uri):
+        return [history_uri]
+    segments = [
+        line.split(' ', 1) for line in subprocess.check_output(
+            ['gsutil', '-q', 'cat', manifest_uri]).splitlines() if line]
+    cutoff = (datetime.datetime.now() - datetime.timedelta(days=days)).strftime(
+        '%Y-%m-%d')
+    # A segment ends when the next one starts, so only keep those whose
+    # successor started after the cutoff.
+    return [
+        uri for (_, uri), (end, _) in zip(segments, segments[1:] + [('~', None)])
+        if end > cutoff]
+
+
+def read_new_lines(history_uri, state):
+    """Cat the lines of history which state hasn't processed yet."""
+    uris = list_segments(history_uri)
+    offsets = {}
+    lines = []
+    for uri in uris:
+        offset = state.offsets.get(uri, 0)
+        if offset is not None:
+            size = int(subprocess.check_output(
+                ['gsutil', '-q', 'ls', '-l', uri]).split()[0])
+            if size > offset:
+                data = subprocess.check_output(
+                    ['gsutil', '-q', 'cat', '-r', '%d-' % offset, uri])
+                complete = data.rfind('\n') + 1  # The rest is still being written
+                lines.extend(data[:complete].splitlines())
+                offset += complete
+            if uri != uris[-1]:  # The poller moved on to a newer segment
+                offset = None
+        offsets[uri] = offset
+    state.offsets = offsets
+    return lines
+
+
+def load_state(path):
+    """Load a RenderState checkpointed to path, or start a new one."""
+    if path and os.path.exists(path):
+        try:
+            with open(path, 'rb') as fp:
+                state = cPickle.load(fp)
+            if getattr(state, 'version', None) == RenderState.VERSION:
+                return state
+        except Exception:  # pylint: disable=broad-except
+            traceback.print_exc()
+    return RenderState()
+
+
+def save_state(path, state):
+    """Checkpoint state to path, if set."""
+    if not path:
+        return
+    with open(path + '.tmp', 'wb') as fp:
+        cPickle.dump(state, fp, cPickle.HIGHEST_PROTOCOL)
+    os.rename(path + '.tmp', path)
+
+
+def render_forever(history_uri, img_uri, service_account=None, state_path=None):
+    """Download results from history_uri, render to svg and save to img_uri.
+
+    Only new results are downloaded each time, and the render state is
+    checkpointed to state_path if it is set.
+    """
     if service_account:
       print >>sys.stderr, 'Activating service account using: %s' % service_account
       subprocess.check_call(
           ['gcloud', 'auth', 'activate-service-account', '--key-file=%s' % service_account])
+    state = load_state(state_path)
     buf = cStringIO.StringIO()
     while True:
         print >>sys.stderr, 'Truncate render buffer'
         buf.seek(0)
         buf.truncate()
-        print >>sys.stderr, 'Cat latest results from %s...' % history_uri
+        print >>sys.stderr, 'Cat new results from %s...' % history_uri
         try:
-            history = subprocess.check_output(
-                ['gsutil', '-q', 'cat', history_uri])
+            lines = read_new_lines(history_uri, state)
         except subprocess.CalledProcessError:
             traceback.print_exc()
             time.sleep(10)
             continue
+        state.add_lines(lines)
+        state.trim(days_ago(KEEP_DAYS))
 
-        print >>sys.stderr, 'Render results to buffer...'
+        print >>sys.stderr, 'Render %d new results to buffer...' % len(lines)
         with gzip.GzipFile(
             os.path.basename(img_uri), mode='wb', fileobj=buf) as compressed:
-            render(history.split('\n')[-60*24*21:], compressed)  # Last 21 days
+            render(state, compressed)
+        save_state(state_path, state)
 
         print >>sys.stderr, 'Copy buffer to %s...' % img_uri
         proc = subprocess.Popen(
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+
+# Copyright 2016 The Kubernetes Authors All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for graph."""
+
+import collections
+import datetime
+import random
+import unittest
+
+import matplotlib.dates as mdates
+import numpy
+
+import graph
+
+
+def make_lines(count, start=datetime.datetime(2016, 7, 1), seed=0):
+    """Generate count history lines a minute apart, in the poller's format.
+
+    The queue goes offline and restarts now and then, and a few samples fall
+    on whole seconds, which str() writes without microseconds.
+    """
+    rand = random.Random(seed)
+    lines = []
+    merged = 0
+    for n in range(count):
+        now = start + datetime.timedelta(minutes=n)
+        if rand.random() < 0.2:
+            now = now.replace(microsecond=0)
+        else:
+            now = now.replace(microsecond=rand.randint(1, 999999))
+        online = rand.random() > 0.1
+        if rand.random() < 0.05:
+            merged = 0  # a restart
+        elif rand.random() < 0.3:
+            merged += rand.randint(1, 2)
+        queue = rand.choice([0, 0, 3])
+        lines.append('%s %s %d %d 0 %s %d' % (
+            now, online, rand.randint(50, 60), queue,
+            rand.random() < 0.2, merged if online else 0))
+    return lines
+
+
+def parse_line(line):
+    """Parse a line like render did before samples were arrays."""
+    date, time, online, pr, queue, _, blocked = line.split(' ')[:7]
+    fmt = '%Y-%m-%d %H:%M:%S.%f' if '.' in time else '%Y-%m-%d %H:%M:%S'
+    merged = line.split(' ')[7:] or ['0']
+    return (datetime.datetime.strptime('%s %s' % (date, time), fmt),
+            online == 'True', int(pr), int(queue), blocked == 'True',
+            int(merged[0]))
+
+
+def reference_stats(lines, window):
+    """Per-line (dt, did_merge, happiness, merge_rate, real_merge_rate)."""
+    happy = collections.deque(maxlen=window)
+    active = collections.deque(maxlen=window)
+    real = collections.deque(maxlen=window)
+    last_merge = 0
+    stats = []
+    for line in lines:
+        dt, online, _, queue, blocked, merged = parse_line(line)
+        if merged >= last_merge:
+            did_merge = merged - last_merge
+        elif online:  # Restarts reset the number to 0
+            did_merge = merged
+        else:
+            did_merge = 0
+        if online:
+            last_merge = merged
+        happy.append(online and not blocked)
+        real.append(did_merge)
+        if queue or did_merge:
+            active.append(did_merge)
+        stats.append((mdates.date2num(dt), did_merge,
+                      sum(happy) / float(len(happy)), sum(active), sum(real)))
+    return stats
+
+
+def reference_intervals(dts, flags):
+    """(start, end) of each run of flags, like render tracked them per line."""
+    found = []
+    start = None
+    for dt, flag in zip(dts, flags):
+        if start is None and flag:
+            start = dt
+        if start is not None and not flag:
+            found.append((start, dt))
+            start = None
+    if start is not None:
+        found.append((start, dts[-1]))
+    return found
+
+
+class GraphTest(unittest.TestCase):
+    def stub(self, obj, name, value):
+        self.addCleanup(setattr, obj, name, getattr(obj, name))
+        setattr(obj, name, value)
+
+    def samples(self, lines):
+        samples = graph.load_samples(lines)
+        graph.count_merges(samples, 0)
+        return samples
+
+    def test_load_samples(self):
+        samples = graph.load_samples([
+            '2016-07-01 12:34:56.500000 True 5 3 1 False 7',
+            'garbage',
+            '2016-07-01 23:59:59 False 6 0 0 True',  # no microseconds or count
+            '2016-07-02 00:00:00.000001 True 1 2 3 True 4 extra',
+        ])
+        self.assertEqual(len(samples), 2)
+        self.assertEqual(
+            [tuple(s)[1:6] for s in samples],
+            [(True, 5, 3, False, 7), (False, 6, 0, True, 0)])
+        for sample, when in zip(samples, [
+                datetime.datetime(2016, 7, 1, 12, 34, 56, 500000),
+                datetime.datetime(2016, 7, 1, 23, 59, 59)]):
+            self.assertAlmostEqual(sample['dt'], mdates.date2num(when), 9)
+
+    def test_empty(self):
+        samples = self.samples([])
+        self.assertEqual(len(samples), 0)
+        self.assertEqual(graph.count_merges(samples, 3), 3)
+
+    def test_count_merges(self):
+        lines = [
+            '2016-07-01 00:00:00 True 1 1 0 False 5',
+            '2016-07-01 00:01:00 True 1 1 0 False 7',  # +2
+            '2016-07-01 00:02:00 False 1 1 0 False 0',  # offline: ignored
+            '2016-07-01 00:03:00 True 1 1 0 False 8',  # +1 since last online
+            '2016-07-01 00:04:00 True 1 1 0 False 2',  # restarted: +2
+        ]
+        samples = graph.load_samples(lines)
+        self.assertEqual(graph.count_merges(samples, 4), 2)
+        self.assertEqual(list(samples['did_merge']), [1, 2, 0, 1, 2])
+        # counting continues from the last online sample of earlier lines
+        samples = graph.load_samples(lines[3:])
+        self.assertEqual(graph.count_merges(samples, 7), 2)
+        self.assertEqual(list(samples['did_merge']), [1, 2])
+
+    def test_rolling_stats(self):
+        # a small window, so the samples cross its edge many times
+        self.stub(graph, 'WINDOW', 7)
+        lines = make_lines(500)
+        samples = self.samples(lines)
+        happiness, merge_rate, real_merge_rate = graph.rolling_stats(samples)
+        expected = reference_stats(lines, 7)
+        self.assertEqual(len(samples), len(expected))
+        for n, (dt, did_merge, happy, rate, real_rate) in enumerate(expected):
+            self.assertAlmostEqual(samples['dt'][n], dt, 9)
+            self.assertEqual(
+                (samples['did_merge'][n], merge_rate[n], real_merge_rate[n]),
+                (did_merge, rate, real_rate), n)
+            self.assertAlmostEqual(happiness[n], happy, 9)
+
+    def test_rolling_sum_edges(self):
+        values = numpy.arange(1, 6)
+        self.assertEqual(list(graph.rolling_sum(values, 1)), [1, 2, 3, 4, 5])
+        self.assertEqual(list(graph.rolling_sum(values, 2)), [1, 3, 5, 7, 9])
+        self.assertEqual(list(graph.rolling_sum(values, 5)), [1, 3, 6, 10, 15])
+        self.assertEqual(list(graph.rolling_sum(values, 9)), [1, 3, 6, 10, 15])
+
+    def test_intervals(self):
+        dts = numpy.arange(1.0, 6.0)
+        self.assertEqual(
+            graph.intervals(dts, numpy.array([1, 1, 0, 1, 0], bool), 6.0),
+            [(1.0, 3.0), (4.0, 5.0)])
+        # a run still going at the end lasts until last_dt
+        self.assertEqual(
+            graph.intervals(dts, numpy.array([0, 0, 0, 1, 1], bool), 6.0),
+            [(4.0, 6.0)])
+        self.assertEqual(
+            graph.intervals(dts, numpy.zeros(5, bool), 6.0), [])
+
+    def test_intervals_per_line(self):
+        samples = self.samples(make_lines(500))
+        dts = samples['dt']
+        online = numpy.flatnonzero(samples['online'])
+        self.assertEqual(
+            graph.intervals(dts, ~samples['online'], dts[-1]),
+            reference_intervals(list(dts), list(~samples['online'])))
+        self.assertEqual(
+            graph.intervals(dts[online], samples['blocked'][online], dts[-1]),
+            reference_intervals(
+                list(dts[online]) + [dts[-1]],
+                list(samples['blocked'][online]) + [False]))
+
+
+class FakeProcess(object):
+    def __init__(self, returncode, err=''):
+        self.returncode = returncode
+        self.err = err
+
+    def communicate(self):
+        return '', self.err
+
+
+class FakeGsutil(object):
+    """Serves gsutil stat, ls -l and cat (with -r) from a dict of objects."""
+    def __init__(self):
+        self.objects = {}  # {uri: contents}
+        self.calls = []
+
+    def Popen(self, args, **_):  # pylint: disable=invalid-name
+        self.calls.append(args[1:])
+        assert args[:2] == ['gsutil', 'stat'], args
+        if args[2] in self.objects:
+            return FakeProcess(0)
+        return FakeProcess(1, 'No URLs matched: %s' % args[2])
+
+    def check_output(self, args):
+        self.calls.append(args[2:])
+        uri = args[-1]
+        if args[2:4] == ['ls', '-l']:
+            return '%d  2016-07-01T00:00:00Z  %s\n' % (
+                len(self.objects[uri]), uri)
+        assert args[2] == 'cat', args
+        if args[3] == '-r':
+            return self.objects[uri][int(args[4].rstrip('-')):]
+        return self.objects[uri]
+
+
+class RenderStateTest(unittest.TestCase):
+    URI = 'gs://bucket/history.txt'
+
+    def setUp(self):
+        self.gsutil = FakeGsutil()
+        for name in ['Popen', 'check_output']:
+            self.addCleanup(setattr, graph.subprocess, name,
+                            getattr(graph.subprocess, name))
+            setattr(graph.subprocess, name, getattr(self.gsutil, name))
+        start = datetime.datetime.now() - datetime.timedelta(days=2)
+        self.lines = make_lines(2 * 24 * 60, start)
+        self.day = start.strftime('%Y-%m-%d')
+
+    def segment(self, n):
+        return '%s.%s.%d' % (self.URI, self.day, n)
+
+    def write_manifest(self, count):
+        self.gsutil.objects['%s.manifest' % self.URI] = ''.join(
+            '%s %s\n' % (self.day, self.segment(n)) for n in range(count))
+
+    def assert_same(self, state, expected):
+        self.assertEqual(state.samples.tolist(), expected.samples.tolist())
+        self.assertEqual(state.last_merge, expected.last_merge)
+
+    def whole(self, lines):
+        state = graph.RenderState()
+        state.add_lines(lines)
+        return state
+
+    def test_incremental(self):
+        self.write_manifest(1)
+        state = graph.RenderState()
+        # Each read stops partway through a line, still being written.
+        for end in [0, 1000, 1000, 2500, len(self.lines)]:
+            data = ''.join(line + '\n' for line in self.lines[:end])
+            self.gsutil.objects[self.segment(0)] = data + self.lines[-1][:10]
+            state.add_lines(graph.read_new_lines(self.URI, state))
+            self.assertEqual(state.offsets, {self.segment(0): len(data)})
+            self.assert_same(state, self.whole(self.lines[:end]))
+
+    def test_rollover(self):
+        self.write_manifest(1)
+        state = graph.RenderState()
+        first = ''.join(line + '\n' for line in self.lines[:1000])
+        self.gsutil.objects[self.segment(0)] = first[:len(first) // 2]
+        state.add_lines(graph.read_new_lines(self.URI, state))
+        # The poller finishes the first segment and starts a second.
+        self.gsutil.objects[self.segment(0)] = first
+        self.gsutil.objects[self.segment(1)] = ''.join(
+            line + '\n' for line in self.lines[1000:])
+        self.write_manifest(2)
+        state.add_lines(graph.read_new_lines(self.URI, state))
+        self.assertEqual(state.offsets, {
+            self.segment(0): None,
+            self.segment(1): len(self.gsutil.objects[self.segment(1)])})
+        self.assert_same(state, self.whole(self.lines))
+        # The finished segment isn't read again.
+        self.gsutil.calls = []
+        self.assertEqual(graph.read_new_lines(self.URI, state), [])
+        self.assertFalse([c for c in self.gsutil.calls if self.segment(0) in c])
+
+    def test_legacy(self):
+        self.gsutil.objects[self.URI] = '\n'.join(self.lines[:10]) + '\n'
+        state = graph.RenderState()
+        self.assertEqual(graph.read_new_lines(self.URI, state), self.lines[:10])
+        self.assertEqual(state.offsets, {self.URI: len(self.gsutil.objects[self.URI])})
+
+    def test_old_segments(self):
+        self.gsutil.objects['%s.manifest' % self.URI] = (
+            '2016-06-01 old.0\n2016-06-02 old.1\n%s new.0\n' % self.day)
+        # only segments which ended within the last days are listed
+        self.assertEqual(graph.list_segments(self.URI), ['old.1', 'new.0'])
+        self.assertEqual(graph.list_segments(self.URI, days=10000),
+                         ['old.0', 'old.1', 'new.0'])
+
+    def test_replayed(self):
+        state = graph.RenderState()
+        state.add_lines(self.lines[:1000])
+        state.add_lines(self.lines[500:2000])  # say, a rewritten segment
+        self.assert_same(state, self.whole(self.lines[:2000]))
+
+
+if __name__ == '__main__':
+    unittest.main()
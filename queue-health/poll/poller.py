@@ -16,50 +16,199 @@
 
 import cStringIO
 import datetime
+import json
+import multiprocessing.pool
+import re
 import subprocess
 import sys
 import time
 import traceback
 
 import requests
+import requests.adapters
 
 
-def get_submit_queue_json(path):
+# Start a new history segment once the current one would grow past this.
+SEGMENT_BYTES = 1024 * 1024
+
+# Endpoints fetched by each poll, all at once.
+ENDPOINTS = ['prs', 'github-e2e-queue', 'sq-stats', 'health']
+
+SESSION = requests.Session()
+SESSION.mount('http://', requests.adapters.HTTPAdapter(
+    pool_connections=1, pool_maxsize=len(ENDPOINTS)))
+POOL = multiprocessing.pool.ThreadPool(len(ENDPOINTS))
+
+# Endpoints whose payloads are only counted, and the keys to count.
+COUNTED = {
+    'prs': ['PRStatus'],
+    'github-e2e-queue': ['E2EQueue', 'E2ERunning'],
+}
+
+# A string (with its closing quote in group 1 if it has one), a structural
+# character, or a number/true/false/null.
+JSON_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*(")?|[{}\[\],]|[^\s{}\[\],:"]+')
+COLON = re.compile(r'\s*:\s*')
+DECODER = json.JSONDecoder()
+
+
+def get_submit_queue(path, stream=False):
     for n in range(3):
         uri = 'http://submit-queue.k8s.io/%s' % path
         print >>sys.stderr, 'GET %s' % uri
-        resp = requests.get(uri)
+        resp = SESSION.get(uri, stream=stream)
         if resp.ok:
             break
+        resp.close()
         time.sleep(2**n)
     resp.raise_for_status()
-    return resp.json()
+    return resp
+
+
+def get_submit_queue_json(path):
+    return get_submit_queue(path).json()
+
+
+def count_members(chunks, keys):
+    """Count the items in some values of a streamed top-level JSON object.
+
+    Returns {key: number of members or elements of its value}, for each of
+    keys found in the object. Only one item is decoded at a time, and chunks
+    stop being read once every key has been counted.
+    """
+    counts = {}
+    depth = 0
+    key = None  # The last top-level key
+    expect_key = False
+    counting = None  # The key whose value is being counted
+    in_object = False  # Whether that value is an object, rather than a list
+    pending = False  # Whether the next token starts a new item
+    buf = ''
+    pos = 0
+    for chunk in chunks:
+        buf = buf[pos:] + chunk
+        pos = 0
+        while True:
+            match = JSON_TOKEN.search(buf, pos)
+            if not match:
+                pos = len(buf)
+                break
+            token = match.group()
+            if token[0] == '"' and match.group(1) is None:
+                pos = match.start()  # The string ends in the next chunk
+                break
+            if counting and depth == 2 and pending and token not in ',]}':
+                # Skip the whole item with the (fast) decoder.
+                try:
+                    end = match.start()
+                    if in_object:
+                        end = DECODER.raw_decode(buf, end)[1]
+                        colon = COLON.match(buf, end)
+                        if not colon:
+                            raise ValueError('no value for %s' % token)
+                        end = colon.end()
+                    end = DECODER.raw_decode(buf, end)[1]
+                except ValueError:
+                    pos = match.start()  # The item ends in the next chunk
+                    break
+                counts[counting] += 1
+                pending = False
+                pos = end
+                continue
+            pos = match.end()
+            if token in '{[':
+                depth += 1
+                if depth == 1:
+                    expect_key = True
+                elif depth == 2 and key in keys:
+                    counting = key
+                    in_object = token == '{'
+                    counts[key] = 0
+                    pending = True
+            elif token in '}]':
+                depth -= 1
+                if depth == 1 and counting:
+                    counting = None
+                    if len(counts) == len(keys):
+                        return counts
+            elif token == ',':
+                if depth == 1:
+                    expect_key = True
+                elif depth == 2:
+                    pending = True
+            elif depth == 1 and expect_key:
+                key = json.loads(token)
+                expect_key = False
+    return counts
+
+
+def get_submit_queue_counts(path, keys):
+    resp = get_submit_queue(path, stream=True)
+    try:
+        return count_members(resp.iter_content(64 * 1024), keys)
+    finally:
+        resp.close()
+
+
+def timed_get(path):
+    start = time.time()
+    if path in COUNTED:
+        data = get_submit_queue_counts(path, COUNTED[path])
+    else:
+        data = get_submit_queue_json(path)
+    return data, time.time() - start
 
 
-def is_blocked():
-    ci = get_submit_queue_json('health')
+def fetch_all(paths):
+    """GET each path concurrently, returning {path: json}.
+
+    Paths in COUNTED return {key: count} for their keys instead.
+    """
+    results = POOL.map(timed_get, paths)
+    for path, (_, latency) in zip(paths, results):
+        print >>sys.stderr, 'Fetched %s in %.2fs' % (path, latency)
+    return {path: data for path, (data, _) in zip(paths, results)}
+
+
+def is_blocked(ci):
     return ci['MergePossibleNow'] != True
 
 
-def get_stats():
-    stats = get_submit_queue_json('sq-stats')
+def get_stats(stats):
     return stats['Initialized'] == True, stats['MergesSinceRestart']
 
 
 def poll():
-    prs = get_submit_queue_json('prs')
-    e2e = get_submit_queue_json('github-e2e-queue')
-    online, merge_count = get_stats()
+    results = fetch_all(ENDPOINTS)
+    prs = results['prs']
+    e2e = results['github-e2e-queue']
+    online, merge_count = get_stats(results['sq-stats'])
     return (
         online,  # Is mergebot initialized?
-        len(prs['PRStatus']),  # number of open PRs
-        len(e2e['E2EQueue']),  # number of items in the e2e queue
-        len(e2e['E2ERunning']),  # Worthless: number of keys in this dict.
-        is_blocked(),  # Whether we can merge
+        prs['PRStatus'],  # number of open PRs
+        e2e['E2EQueue'],  # number of items in the e2e queue
+        e2e['E2ERunning'],  # Worthless: number of keys in this dict.
+        is_blocked(results['health']),  # Whether we can merge
         merge_count,  # Number of merges the bot has done
     )
 
 
+def stat_exists(uri):
+    """Returns whether uri exists, retrying until gsutil can tell."""
+    while True:
+        # Not -q: it would hide the message that tells missing from failing.
+        proc = subprocess.Popen(
+            ['gsutil', 'stat', uri],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, err = proc.communicate()
+        if not proc.returncode:
+            return True
+        if 'No URLs matched' in err:
+            return False
+        print >>sys.stderr, 'Failed to stat %s: %s' % (uri, err.strip())
+        time.sleep(5)
+
+
 def load_stats(uri):
     while True:
         try:
@@ -82,20 +231,77 @@ def save_stats(uri, buf):
       print >>sys.stderr, 'Failed to copy stats to %s: %d' % (uri, code)
 
 
+def manifest_uri(uri):
+    return '%s.manifest' % uri
+
+
+def parse_manifest(manifest):
+    """Return a list of (start day, segment uri) from manifest text."""
+    return [tuple(line.split(' ', 1)) for line in manifest.splitlines() if line]
+
+
+class History(object):
+    """Appends samples to the history at uri, one small segment at a time.
+
+    Samples go to the current segment, which is all that's uploaded after each
+    sample. A new segment starts every day, or once the current one reaches
+    SEGMENT_BYTES. The manifest at uri.manifest lists each segment's start day
+    and uri, oldest first. A history written before segments existed is kept
+    as the first segment, with a start day of '-'.
+    """
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.segments = []
+        self.buf = cStringIO.StringIO()
+        if stat_exists(manifest_uri(uri)):
+            self.segments = parse_manifest(load_stats(manifest_uri(uri)))
+        elif stat_exists(uri):
+            self.segments = [('-', uri)]
+        if self.segments and self.segments[-1][0] != '-':
+            self.buf.write(load_stats(self.segments[-1][1]))
+
+    def append(self, now, data):
+        day = now.strftime('%Y-%m-%d')
+        rolled = False
+        if (not self.segments or self.segments[-1][0] != day
+                or self.buf.tell() + len(data) > SEGMENT_BYTES):
+            count = sum(1 for start, _ in self.segments if start == day)
+            segment = '%s.%s.%d' % (self.uri, day, count)
+            print >>sys.stderr, 'Starting history segment %s...' % segment
+            self.segments.append((day, segment))
+            self.buf = cStringIO.StringIO()
+            rolled = True
+        self.buf.write(data)
+
+        print >>sys.stderr, 'Saving historical stats to %s...' % self.segments[-1][1]
+        save_stats(self.segments[-1][1], self.buf)
+        if rolled:  # After the segment, so readers of the manifest find it.
+            manifest = cStringIO.StringIO()
+            for start, segment in self.segments:
+                manifest.write('%s %s\n' % (start, segment))
+            save_stats(manifest_uri(self.uri), manifest)
+
+
 def poll_forever(uri, service_account=None):
     if service_account:
       print >>sys.stderr, 'Activating service account using: %s' % service_account
       subprocess.check_call(
           ['gcloud', 'auth', 'activate-service-account', '--key-file=%s' % service_account])
     print >>sys.stderr, 'Loading historical stats from %s...' % uri
-    buf = cStringIO.StringIO()
-    buf.write(load_stats(uri))
+    history = History(uri)
     secs = 60
+    next_poll = time.time() + secs
 
     while True:
         try:
-            print >>sys.stderr, 'Waiting %ds...' % secs
-            time.sleep(secs)
+            # Wait until the next minute is due, so time spent polling and
+            # saving doesn't stretch the interval between samples. Slow polls
+            # push the schedule back rather than bunching samples together.
+            wait = max(0, next_poll - time.time())
+            print >>sys.stderr, 'Waiting %.1fs...' % wait
+            time.sleep(wait)
+            next_poll = max(next_poll, time.time()) + secs
             now = datetime.datetime.now()
             print >>sys.stderr, 'Polling current status...'
             online, prs, queue, running, blocked, merge_count = False, 0, 0, 0, False, 0
@@ -111,10 +317,7 @@ def poll_forever(uri, service_account=None):
 
             data = '{} {} {} {} {} {} {}\n'.format(now, online, prs, queue, running, blocked, merge_count)
             print >>sys.stderr, 'Appending to history: %s' % data
-            buf.write(data)
-
-            print >>sys.stderr, 'Saving historical stats to %s...' % uri
-            save_stats(uri, buf)
+            history.append(now, data)
         except KeyboardInterrupt:
             break
 
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+
+# Copyright 2016 The Kubernetes Authors All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for poller."""
+
+import datetime
+import json
+import threading
+import unittest
+
+import poller
+
+
+PAYLOADS = [
+    # Strings with escaped quotes and backslashes, and nested containers.
+    '{"PRStatus": {"1": {"msg": "say \\"hi\\"", "path": "C:\\\\"}, '
+    '"2": [1, [2, {"3": "]}"}]], "3": {}}, '
+    '"E2EQueue": [{"a": "\\\\\\""}, [], {}, "x,y", 4, null], '
+    '"E2ERunning": []}',
+    # Empty containers, and keys after the counted ones.
+    '{"E2ERunning": {}, "PRStatus": [], "E2EQueue": [[]], "Other": [1, 2]}',
+    # Whitespace everywhere, and a missing key.
+    ' {\n "PRStatus" :\n { "a\\"b" : [ "}" , "{" ] ,\n "c" : 1 } ,'
+    ' "E2EQueue" : [ "\\\\" , "\\"" ] } ',
+]
+KEYS = ['PRStatus', 'E2EQueue', 'E2ERunning']
+
+
+class CountMembersTest(unittest.TestCase):
+    def expected(self, payload):
+        data = json.loads(payload)
+        return {key: len(data[key]) for key in KEYS if key in data}
+
+    def assert_counts(self, payload, chunks):
+        self.assertEqual(''.join(chunks), payload)
+        self.assertEqual(
+            poller.count_members(iter(chunks), KEYS), self.expected(payload),
+            chunks)
+
+    def test_whole(self):
+        for payload in PAYLOADS:
+            self.assert_counts(payload, [payload])
+
+    def test_split_anywhere(self):
+        # Splits inside strings, at escapes, and inside nested items.
+        for payload in PAYLOADS:
+            for n in range(len(payload) + 1):
+                self.assert_counts(payload, [payload[:n], payload[n:]])
+
+    def test_bytes(self):
+        for payload in PAYLOADS:
+            self.assert_counts(payload, list(payload))
+
+    def test_split_escapes(self):
+        payload = PAYLOADS[0]
+        for escape in ['\\"', '\\\\']:
+            start = payload.index(escape)
+            while start >= 0:
+                # Between the backslash and what it escapes, and just after.
+                self.assert_counts(payload, [
+                    payload[:start + 1], payload[start + 1:start + 2],
+                    payload[start + 2:]])
+                start = payload.find(escape, start + 1)
+
+    def test_missing(self):
+        self.assertEqual(poller.count_members(iter(['{"a": [1]}']), KEYS), {})
+        self.assertEqual(poller.count_members(iter(['{}']), KEYS), {})
+
+
+class FakeResponse(object):
+    ok = True
+
+    def __init__(self, content):
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+    def iter_content(self, size):
+        return (self.content[n:n + size]
+                for n in range(0, len(self.content), size))
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeSession(object):
+    """Serves payloads by path, finishing the first request last."""
+    def __init__(self, payloads, first):
+        self.payloads = payloads
+        self.first = first
+        self.lock = threading.Lock()
+        self.pending = len(payloads)
+        self.others_done = threading.Event()
+
+    def get(self, uri, stream=False):
+        path = uri.rsplit('/', 1)[1]
+        if path == self.first:
+            self.others_done.wait(5)
+        payload = self.payloads[path]
+        with self.lock:
+            self.pending -= 1
+            if self.pending == 1:
+                self.others_done.set()
+        if isinstance(payload, Exception):
+            raise payload
+        return FakeResponse(payload)
+
+
+class FetchAllTest(unittest.TestCase):
+    PAYLOADS = {
+        'prs': '{"PRStatus": {"1": {}, "2": {}}}',
+        'github-e2e-queue': '{"E2EQueue": [1, 2, 3], "E2ERunning": []}',
+        'sq-stats': '{"Initialized": true, "MergesSinceRestart": 5}',
+        'health': '{"MergePossibleNow": false}',
+    }
+
+    def fetch(self, payloads):
+        real_session = poller.SESSION
+        poller.SESSION = FakeSession(payloads, poller.ENDPOINTS[0])
+        try:
+            return poller.fetch_all(poller.ENDPOINTS)
+        finally:
+            poller.SESSION = real_session
+
+    def test_results(self):
+        # each path gets its own result, whatever order they finish in
+        self.assertEqual(self.fetch(self.PAYLOADS), {
+            'prs': {'PRStatus': 2},
+            'github-e2e-queue': {'E2EQueue': 3, 'E2ERunning': 0},
+            'sq-stats': {'Initialized': True, 'MergesSinceRestart': 5},
+            'health': {'MergePossibleNow': False},
+        })
+
+    def test_error(self):
+        payloads = dict(self.PAYLOADS, health=IOError('connection reset'))
+        self.assertRaises(IOError, self.fetch, payloads)
+
+
+class FakeProcess(object):
+    def __init__(self, returncode, err=''):
+        self.returncode = returncode
+        self.err = err
+
+    def communicate(self):
+        return '', self.err
+
+
+class HistoryTest(unittest.TestCase):
+    URI = 'gs://bucket/history.txt'
+
+    def setUp(self):
+        self.objects = {}  # {uri: contents}
+        self.saves = []  # uris, in the order they were saved
+        self.real_stat_exists = poller.stat_exists
+        self.stub(poller, 'stat_exists', lambda uri: uri in self.objects)
+        self.stub(poller, 'load_stats', lambda uri: self.objects[uri])
+        self.stub(poller, 'save_stats', self.save_stats)
+
+    def stub(self, obj, name, value):
+        self.addCleanup(setattr, obj, name, getattr(obj, name))
+        setattr(obj, name, value)
+
+    def save_stats(self, uri, buf):
+        self.objects[uri] = buf.getvalue()
+        self.saves.append(uri)
+
+    def manifest(self):
+        return poller.parse_manifest(self.objects[poller.manifest_uri(self.URI)])
+
+    def test_new(self):
+        history = poller.History(self.URI)
+        history.append(datetime.datetime(2016, 7, 1, 12), 'a\n')
+        history.append(datetime.datetime(2016, 7, 1, 13), 'b\n')
+        segment = self.URI + '.2016-07-01.0'
+        self.assertEqual(self.objects[segment], 'a\nb\n')
+        self.assertEqual(self.manifest(), [('2016-07-01', segment)])
+        # the manifest is saved after the segment it lists, and only then
+        manifest = poller.manifest_uri(self.URI)
+        self.assertEqual(self.saves, [segment, manifest, segment])
+
+    def test_daily(self):
+        history = poller.History(self.URI)
+        history.append(datetime.datetime(2016, 7, 1, 23), 'a\n')
+        history.append(datetime.datetime(2016, 7, 2, 0), 'b\n')
+        first = self.URI + '.2016-07-01.0'
+        second = self.URI + '.2016-07-02.0'
+        self.assertEqual(self.objects[first], 'a\n')
+        self.assertEqual(self.objects[second], 'b\n')
+        self.assertEqual(self.manifest(),
+                         [('2016-07-01', first), ('2016-07-02', second)])
+
+    def test_segment_bytes(self):
+        self.stub(poller, 'SEGMENT_BYTES', 4)
+        history = poller.History(self.URI)
+        now = datetime.datetime(2016, 7, 1)
+        for line in ['a\n', 'b\n', 'c\n']:
+            history.append(now, line)
+        first = self.URI + '.2016-07-01.0'
+        second = self.URI + '.2016-07-01.1'
+        self.assertEqual(self.objects[first], 'a\nb\n')
+        self.assertEqual(self.objects[second], 'c\n')
+        self.assertEqual(self.manifest(),
+                         [('2016-07-01', first), ('2016-07-01', second)])
+
+    def test_restart(self):
+        history = poller.History(self.URI)
+        history.append(datetime.datetime(2016, 7, 1), 'a\n')
+        # a restarted poller appends to the current segment...
+        history = poller.History(self.URI)
+        history.append(datetime.datetime(2016, 7, 1), 'b\n')
+        segment = self.URI + '.2016-07-01.0'
+        self.assertEqual(self.objects[segment], 'a\nb\n')
+        # ...and on a later day, starts a new one rather than overwriting it
+        history = poller.History(self.URI)
+        history.append(datetime.datetime(2016, 7, 3), 'c\n')
+        self.assertEqual(self.objects[segment], 'a\nb\n')
+        self.assertEqual(self.manifest(), [
+            ('2016-07-01', segment), ('2016-07-03', self.URI + '.2016-07-03.0')])
+
+    def test_legacy(self):
+        self.objects[self.URI] = 'old\n'
+        history = poller.History(self.URI)
+        history.append(datetime.datetime(2016, 7, 1), 'a\n')
+        segment = self.URI + '.2016-07-01.0'
+        # the old history is kept as is, as the first segment
+        self.assertEqual(self.objects[self.URI], 'old\n')
+        self.assertEqual(self.objects[segment], 'a\n')
+        self.assertEqual(self.manifest(), [('-', self.URI), ('2016-07-01', segment)])
+
+    def test_stat_retries(self):
+        results = [FakeProcess(1, 'ServiceException: 503'),
+                   FakeProcess(1, 'CommandException: No URLs matched: x'),
+                   FakeProcess(1, 'AccessDeniedException: 403'),
+                   FakeProcess(0)]
+        sleeps = []
+        self.stub(poller.subprocess, 'Popen', lambda *a, **kw: results.pop(0))
+        self.stub(poller.time, 'sleep', sleeps.append)
+        # errors are retried, until the object is found or known missing
+        self.assertFalse(self.real_stat_exists(self.URI))
+        self.assertTrue(self.real_stat_exists(self.URI))
+        self.assertEqual(len(sleeps), 2)
+        self.assertEqual(results, [])
+
+
+if __name__ == '__main__':
+    unittest.main()